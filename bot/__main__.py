@@ -1,8 +1,4 @@
-from bot.bot import main
-import logging
-logger = logging.getLogger(__name__)
+from bot.bootstrap import run
 
 if __name__ == "__main__":
-    import asyncio
-    logger.info('Запускаем бота...')
-    asyncio.run(main()) 
\ No newline at end of file
+    run()
@@ -1,16 +1,30 @@
 import logging
+import time
 import datetime as dt
-from openai import AsyncOpenAI
-from bot.config import OPENAI_API_KEY, OPENAI_MODEL, GENNADY_PERSONA
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional, Callable, Awaitable
+from bot.config import OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_MODEL, GENNADY_PERSONA, SUMMARY_CHUNK_MAX_TOKENS, LLM_CACHE_ENABLED
 from bot.dbmap import save_summary_to_db
+from bot.llm_cache import llm_cache, cache_key
+from bot.metrics import llm_request_seconds, llm_tokens, llm_errors
+from bot.llm_scheduler import llm_scheduler, SchedulerBusy, PRIORITY_INTERACTIVE, PRIORITY_SUMMARY, retryable_errors
 
 logger = logging.getLogger(__name__)
-client = AsyncOpenAI(
-    api_key=OPENAI_API_KEY,
-    timeout=30.0,
-    #http_client=httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=500, max_connections=100)),
-    max_retries=0
-)
+
+
+@lru_cache(maxsize=1)
+def get_client():
+    """Клиент OpenAI создаётся при первом запросе: импорт openai заметно удлиняет старт."""
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        timeout=30.0,
+        #http_client=httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=500, max_connections=100)),
+        max_retries=0
+    )
+
 
 DEFAULT_PROMPT = (
     "Прочитай диалог ниже и сделай краткое, интересное и содержательное саммари. "
@@ -19,41 +33,157 @@ DEFAULT_PROMPT = (
 )
 
 
-async def get_summary_llm(
-    history_text: str,
-    style: str = "",
-    chat_id: int = 0,
-    start: dt.datetime = None,
-    end: dt.datetime = None
+SUMMARY_PROMPT = (
+    "Ты — LLM, которая умеет делать саммари из переписок в Telegram. "
+    "Собери суть обсуждения из истории сообщений. Не перечисляй всё по пунктам, "
+    "а напиши связный текст, как будто ты рассказываешь другу, что обсуждали в чате."
+)
+
+CHUNK_PROMPT = (
+    "Ты — LLM, которая конспектирует переписки в Telegram. "
+    "Перед тобой фрагмент длинной переписки. Кратко и по порядку перескажи, "
+    "кто что говорил: сохрани имена, важные моменты, шутки и ироничные реплики. "
+    "Это промежуточный конспект — его потом объединят с конспектами соседних фрагментов."
+)
+
+REDUCE_PROMPT = (
+    "Ты — LLM, которая умеет делать саммари из переписок в Telegram. "
+    "Ниже — конспекты последовательных фрагментов одной переписки. "
+    "Объедини их в одно саммари. Не перечисляй всё по пунктам, "
+    "а напиши связный текст, как будто ты рассказываешь другу, что обсуждали в чате."
+)
+
+
+async def _complete(
+    messages: list[dict],
+    *,
+    max_tokens: int,
+    temperature: float,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    priority: int = PRIORITY_SUMMARY,
+    cache: bool = False
 ) -> str:
-    prompt = (
-        "Ты — LLM, которая умеет делать саммари из переписок в Telegram. "
-        "Собери суть обсуждения из истории сообщений. Не перечисляй всё по пунктам, "
-        "а напиши связный текст, как будто ты рассказываешь другу, что обсуждали в чате."
-    )
+    """
+    Один запрос к chat.completions через llm_scheduler. Если передан on_delta,
+    ответ запрашивается в потоковом режиме и каждый кусок текста сразу
+    отдаётся в on_delta. on_delta выполняется в слоте планировщика и не должен
+    ждать Telegram (StreamingMessage.push только пишет в буфер).
+    Одинаковые непотоковые запросы склеиваются.
+    С cache=True ответ сначала ищется в llm_cache и сохраняется туда.
+    """
+    key = cache_key(OPENAI_MODEL, messages, temperature, max_tokens)
+    if cache and LLM_CACHE_ENABLED:
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            logger.info("Ответ OpenAI взят из кэша")
+            if on_delta is not None:
+                await on_delta(cached)
+            return cached
+        text = await _complete(
+            messages, max_tokens=max_tokens, temperature=temperature,
+            on_delta=on_delta, priority=priority
+        )
+        if text:
+            await llm_cache.put(key, OPENAI_MODEL, text)
+        return text
+
+    if on_delta is None:
+        async def request() -> str:
+            with _observe_llm("complete") as usage:
+                response = await get_client().chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                usage.append(response.usage)
+            return response.choices[0].message.content.strip()
+
+        return await llm_scheduler.submit(request, priority=priority, key=key)
+
+    async def stream_request() -> str:
+        parts = []
+        with _observe_llm("stream") as usage:
+            stream = await get_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                # Последний кусок потока придёт с usage и пустым choices
+                stream_options={"include_usage": True}
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage.append(chunk.usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        await on_delta(delta)
+            except retryable_errors() as e:
+                if parts:
+                    # Часть ответа уже показана — повтор продублировал бы текст
+                    raise StreamInterrupted(str(e)) from e
+                raise
+        return "".join(parts).strip()
+
+    return await llm_scheduler.submit(stream_request, priority=priority)
 
+
+@contextmanager
+def _observe_llm(mode: str):
+    """Время, токены и ошибки одного обращения к API (без учёта ожидания в очереди)."""
+    started = time.perf_counter()
+    usage = []
+    status = "ok"
+    try:
+        yield usage
+    except Exception as e:
+        status = "error"
+        llm_errors.inc(type(e).__name__)
+        raise
+    finally:
+        llm_request_seconds.observe(time.perf_counter() - started, mode, status)
+        for u in usage:
+            if u is not None:
+                llm_tokens.inc("prompt", amount=u.prompt_tokens)
+                llm_tokens.inc("completion", amount=u.completion_tokens)
+
+
+class StreamInterrupted(Exception):
+    """Потоковый ответ оборвался после того, как часть текста уже была отдана."""
+
+
+def _summary_system_prompt(base: str, style: str = "") -> str:
+    prompt = base
     if style:
         prompt += f"\nСтиль: {style}"
-
     if GENNADY_PERSONA:
         prompt += f"\nРоль: {GENNADY_PERSONA['description']}"
+    return prompt
+
 
+async def get_summary_llm(
+    history_text: str,
+    style: str = "",
+    chat_id: int = 0,
+    start: dt.datetime = None,
+    end: dt.datetime = None,
+    *,
+    prompt: str = SUMMARY_PROMPT,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
     messages = [
-        {"role": "system", "content": prompt},
+        {"role": "system", "content": _summary_system_prompt(prompt, style)},
         {"role": "user", "content": history_text}
     ]
 
     try:
         logger.info("Отправка запроса к OpenAI (get_summary_llm)")
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            temperature=0.9,
-            max_tokens=2000
-        )
-        summary_text = response.choices[0].message.content.strip()
+        summary_text = await _complete(messages, temperature=0.9, max_tokens=2000, on_delta=on_delta, cache=True)
 
-        save_summary_to_db(
+        await save_summary_to_db(
             chat_id=chat_id,
             author=OPENAI_MODEL,
             text=summary_text,
@@ -64,12 +194,31 @@ async def get_summary_llm(
 
         return summary_text
 
+    except SchedulerBusy:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при обращении к OpenAI: {e}")
         return f"Ошибка при обращении к OpenAI: {e}"
 
 
-async def get_character_reply(text: str, persona: dict = GENNADY_PERSONA) -> str:
+async def summarize_chunk(history_text: str, max_tokens: int = SUMMARY_CHUNK_MAX_TOKENS) -> str:
+    """
+    Промежуточный конспект фрагмента переписки для map-reduce саммари.
+    Ничего не сохраняет в БД, ошибки пробрасывает вызывающему.
+    """
+    logger.info("Отправка запроса к OpenAI (summarize_chunk)")
+    messages = [
+        {"role": "system", "content": CHUNK_PROMPT},
+        {"role": "user", "content": history_text}
+    ]
+    return await _complete(messages, temperature=0.3, max_tokens=max_tokens, cache=True)
+
+
+async def get_character_reply(
+    text: str,
+    persona: dict = GENNADY_PERSONA,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
     messages = [
         {"role": "system", "content": persona["description"]},
         {"role": "user", "content": text},
@@ -77,14 +226,12 @@ async def get_character_reply(text: str, persona: dict = GENNADY_PERSONA) -> str
 
     try:
         logger.info(f'Отправка запроса к OpenAI (get_character_reply)')
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            max_tokens=100,
-            temperature=0.8,
+        return await _complete(
+            messages, max_tokens=100, temperature=0.8, on_delta=on_delta, priority=PRIORITY_INTERACTIVE
         )
-        return response.choices[0].message.content.strip()
 
+    except SchedulerBusy:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации реплики персонажа: {e}")
         return f"Ошибка: {e}"
@@ -0,0 +1,293 @@
+"""
+Холодный архив истории сообщений.
+
+Месяцы старше ARCHIVE_AFTER_MONTHS выносятся из таблицы messages в сжатые
+JSONL-файлы ARCHIVE_DIR/<chat_id>/<ГГГГ-ММ>.jsonl.gz (по строке на сообщение,
+автор, текст исходного сообщения ответа, реакции и итоги опроса — прямо в строке). Список
+вынесенных месяцев хранится в archived_periods. Таблица messages и её
+индексы перестают расти вместе со всей историей.
+
+Чтение прозрачное: iter_messages_by_chat_and_range (саммари) сначала отдаёт
+строки из архива, search_messages дополняет выдачу совпадениями из архива,
+если задан период (не больше ARCHIVE_SEARCH_MAX_MONTHS последних месяцев).
+Счётчики /statistic не пересчитываются и архив не трогают.
+
+Запуск вручную:
+    python -m bot.archive [--months 6]
+"""
+import asyncio
+import datetime as dt
+import gzip
+import json
+import logging
+import os
+import re
+from collections import namedtuple, deque
+from typing import AsyncIterator, Optional
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.orm import aliased
+from bot.config import ARCHIVE_AFTER_MONTHS, ARCHIVE_DIR, ARCHIVE_CHECK_HOURS, ARCHIVE_SEARCH_MAX_MONTHS, setup_logging
+from bot.dbmap import Session, ReadSession, TgMessage, TgUser, TgArchivedPeriod, TgMessageReaction, MessageRow, POLL_PREFIX, get_reactions_text, get_poll_results
+
+logger = logging.getLogger(__name__)
+
+SearchHit = namedtuple("SearchHit", "date username first_name last_name snippet")
+# Сколько распакованных байт архива читать за одно обращение к потоку
+READ_CHUNK_BYTES = 256 * 1024
+
+
+def month_start(date: dt.datetime) -> dt.datetime:
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: dt.datetime, months: int) -> dt.datetime:
+    year, index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return month.replace(year=year, month=index + 1)
+
+
+def archive_path(chat_id: int, month: dt.datetime) -> str:
+    return os.path.join(ARCHIVE_DIR, str(chat_id), f"{month:%Y-%m}.jsonl.gz")
+
+
+def _read_archive(path: str) -> list[dict]:
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        logger.error(f"[archive] Файл архива не найден: {path}")
+        return []
+
+
+def _write_archive(path: str, rows: list[dict]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+
+
+def _row_from_dict(d: dict) -> MessageRow:
+    return MessageRow(
+        dt.datetime.fromisoformat(d["date"]), d["text"], d["username"], d["first_name"],
+        d["last_name"], d["reply_text"], d["token_count"], d.get("reactions"), d.get("poll_results")
+    )
+
+
+async def _archived_periods(chat_id: int, start: Optional[dt.datetime], end: Optional[dt.datetime]) -> list[TgArchivedPeriod]:
+    stmt = select(TgArchivedPeriod).where(TgArchivedPeriod.chat_id == chat_id)
+    if start is not None:
+        stmt = stmt.where(TgArchivedPeriod.month_start >= month_start(start))
+    if end is not None:
+        stmt = stmt.where(TgArchivedPeriod.month_start < end)
+    async with ReadSession() as session:
+        return (await session.execute(stmt.order_by(TgArchivedPeriod.month_start))).scalars().all()
+
+
+# --- Чтение ---
+
+def _open_archive(path: str):
+    try:
+        return gzip.open(path, "rt", encoding="utf-8")
+    except FileNotFoundError:
+        logger.error(f"[archive] Файл архива не найден: {path}")
+        return None
+
+
+async def iter_archived(chat_id: int, start: dt.datetime, end: dt.datetime) -> AsyncIterator[MessageRow]:
+    """
+    Сообщения чата за [start, end) из архивных месяцев, по порядку месяцев.
+    Файл читается потоково, порциями по READ_CHUNK_BYTES, а не целиком.
+    """
+    for period in await _archived_periods(chat_id, start, end):
+        f = await asyncio.to_thread(_open_archive, period.path)
+        if f is None:
+            continue
+        try:
+            while lines := await asyncio.to_thread(f.readlines, READ_CHUNK_BYTES):
+                for line in lines:
+                    row = _row_from_dict(json.loads(line))
+                    if start <= row.date < end:
+                        yield row
+        finally:
+            f.close()
+
+
+def _snippet(text: str, words: list[str], width: int = 80) -> str:
+    lowered = text.lower()
+    positions = [lowered.find(w) for w in words if lowered.find(w) >= 0]
+    pos = min(positions) if positions else 0
+    begin = max(0, pos - width)
+    snippet = text[begin:pos + width]
+    for word in words:
+        snippet = re.sub(rf"(?i)\b({re.escape(word)}\w*)", r"«\1»", snippet)
+    return ("…" if begin else "") + snippet + ("…" if pos + width < len(text) else "")
+
+
+def _search_file(
+    path: str,
+    words: list[str],
+    start: dt.datetime,
+    end: Optional[dt.datetime],
+    limit: int
+) -> list[SearchHit]:
+    """Последние limit совпадений в файле месяца, от новых к старым; файл читается построчно."""
+    hits: deque[SearchHit] = deque(maxlen=limit)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                d = json.loads(line)
+                date = dt.datetime.fromisoformat(d["date"])
+                if date < start or (end is not None and date >= end):
+                    continue
+                tokens = re.findall(r"\w+", (d["text"] or "").lower())
+                if all(any(t.startswith(w) for t in tokens) for w in words):
+                    hits.append(SearchHit(date, d["username"], d["first_name"], d["last_name"], _snippet(d["text"], words)))
+    except FileNotFoundError:
+        logger.error(f"[archive] Файл архива не найден: {path}")
+    return list(reversed(hits))
+
+
+async def search_archived(
+    chat_id: int,
+    query: str,
+    start: dt.datetime,
+    end: Optional[dt.datetime] = None,
+    limit: int = 10,
+    max_months: int = ARCHIVE_SEARCH_MAX_MONTHS
+) -> list[SearchHit]:
+    """
+    Поиск по архивным месяцам периода, от новых к старым, не больше
+    max_months месяцев: все слова запроса должны быть началами слов
+    сообщения (как префиксный поиск FTS).
+    """
+    words = re.findall(r"\w+", query.lower())
+    if not words or limit <= 0:
+        return []
+    hits = []
+    periods = await _archived_periods(chat_id, start, end)
+    for period in periods[::-1][:max_months]:
+        hits += await asyncio.to_thread(_search_file, period.path, words, start, end, limit - len(hits))
+        if len(hits) >= limit:
+            break
+    return hits
+
+
+# --- Архивация ---
+
+async def archive_month(chat_id: int, month: dt.datetime) -> int:
+    """
+    Выносит сообщения чата за месяц в архивный файл. Возвращает число сообщений.
+    Выборка идёт через читателей, файл пишется без открытой сессии записи:
+    писатель SQLite (один на процесс) занят только удалением строк.
+    """
+    month_end = add_months(month, 1)
+    in_month = (TgMessage.chat_id == chat_id, TgMessage.date >= month, TgMessage.date < month_end)
+    reply = aliased(TgMessage)
+    async with ReadSession() as session:
+        result = await session.execute(
+            select(
+                TgMessage.id, TgMessage.date, TgMessage.text, TgMessage.token_count, TgMessage.tg_message_id,
+                TgMessage.from_user, TgUser.username, TgUser.first_name, TgUser.last_name, reply.text,
+            )
+            .outerjoin(TgUser, TgUser.id == TgMessage.from_user)
+            .outerjoin(reply, reply.id == TgMessage.reply_to_message_id)
+            .where(*in_month)
+            .order_by(TgMessage.date)
+        )
+        result = result.all()
+        if not result:
+            return 0
+        reactions = await get_reactions_text([row[0] for row in result], session)
+        polls = await get_poll_results(chat_id, [row[4] for row in result if (row[2] or "").startswith(POLL_PREFIX)], session)
+        existing = await session.get(TgArchivedPeriod, (chat_id, month))
+    rows = [
+        {
+            "date": date.isoformat(), "text": text, "token_count": token_count,
+            "tg_message_id": tg_message_id, "from_user": from_user, "username": username,
+            "first_name": first_name, "last_name": last_name, "reply_text": reply_text,
+            "reactions": reactions.get(msg_id), "poll_results": polls.get(tg_message_id),
+        }
+        for msg_id, date, text, token_count, tg_message_id, from_user, username, first_name, last_name, reply_text in result
+    ]
+    # Удаляются ровно прочитанные строки: сообщения, записанные после выборки, имеют id больше
+    max_id = max(row[0] for row in result)
+
+    path = archive_path(chat_id, month)
+    if existing is not None:
+        # Месяц уже в архиве, а в БД появились его сообщения — дописываем
+        rows = await asyncio.to_thread(_read_archive, existing.path) + rows
+        rows.sort(key=lambda row: row["date"])
+    # Сначала файл, потом удаление из БД: при сбое файл просто перезапишется
+    await asyncio.to_thread(_write_archive, path, rows)
+
+    async with Session() as session:
+        ids = select(TgMessage.id).where(*in_month, TgMessage.id <= max_id).scalar_subquery()
+        # Ответы на архивируемые сообщения из более поздних месяцев теряют ссылку
+        await session.execute(
+            update(TgMessage).where(TgMessage.reply_to_message_id.in_(ids)).values(reply_to_message_id=None)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(
+            delete(TgMessageReaction).where(TgMessageReaction.message_id.in_(ids))
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(
+            delete(TgMessage).where(*in_month, TgMessage.id <= max_id).execution_options(synchronize_session=False)
+        )
+        period = await session.get(TgArchivedPeriod, (chat_id, month))
+        if period is None:
+            session.add(TgArchivedPeriod(chat_id=chat_id, month_start=month, path=path, message_count=len(rows)))
+        else:
+            period.path, period.message_count = path, len(rows)
+        await session.commit()
+    logger.info(f"[archive] Чат {chat_id}, {month:%Y-%m}: {len(rows)} сообщений вынесено в {path}")
+    return len(rows)
+
+
+async def archive_old_months(months: int = ARCHIVE_AFTER_MONTHS, now: Optional[dt.datetime] = None) -> int:
+    """Архивирует все месяцы, закончившиеся больше months месяцев назад."""
+    cutoff = add_months(month_start(now or dt.datetime.now()), -months)
+    # Поиск старых месяцев — только чтение: писатель в это время свободен для записи
+    async with ReadSession() as session:
+        oldest = (await session.execute(
+            select(TgMessage.chat_id, func.min(TgMessage.date))
+            .where(TgMessage.date < cutoff)
+            .group_by(TgMessage.chat_id)
+        )).all()
+    total = 0
+    for chat_id, first_date in oldest:
+        month = month_start(first_date)
+        while month < cutoff:
+            total += await archive_month(chat_id, month)
+            month = add_months(month, 1)
+    return total
+
+
+async def run_archiver():
+    """Фоновая архивация раз в ARCHIVE_CHECK_HOURS часов."""
+    while True:
+        try:
+            archived = await archive_old_months()
+            if archived:
+                logger.info(f"[archive] Всего вынесено в архив: {archived}")
+        except Exception as e:
+            logger.exception(f"[archive] Ошибка архивации: {e}")
+        await asyncio.sleep(ARCHIVE_CHECK_HOURS * 3600)
+
+
+async def _main(months: int):
+    from bot.dbmap import init_db, close_db
+    try:
+        await init_db()
+        print(f"Вынесено в архив: {await archive_old_months(months)}")
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    import argparse
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Архивация старых месяцев истории")
+    parser.add_argument("--months", type=int, default=ARCHIVE_AFTER_MONTHS or 6)
+    asyncio.run(_main(parser.parse_args().months))
@@ -0,0 +1,369 @@
+"""
+Офлайн-бенчмарк конвейера апдейтов.
+
+Апдейты генерируются детерминированно (--seed) и прогоняются через настоящие
+Dispatcher и router. Telegram подменён сессией-заглушкой (FakeSession), OpenAI —
+локальным OpenAI-совместимым сервером с фиксированной задержкой. БД — свежая
+SQLite во временном каталоге.
+
+По каждому виду апдейтов печатается: апдейтов в секунду, p50/p99 времени
+обработки и число SQL-запросов на апдейт (с учётом сброса буфера записи).
+
+    python -m bot.benchmark
+    python -m bot.benchmark --messages 5000 --chats 20 --json bench.json
+
+Окружение настраивается до импорта модулей бота, поэтому они импортируются
+внутри функций.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+from itertools import count
+
+BOT_ID = 900000
+BOT_USERNAME = "bench_bot"
+WORDS = (
+    "привет как дела кто идёт вечером в бар завтра работа отпуск море кот пицца "
+    "дедлайн релиз созвон погода футбол сериал кофе чай ужин почему опять"
+).split()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+# --- Заглушка OpenAI ---
+
+async def start_llm_stub(port: int, latency: float):
+    from aiohttp import web
+
+    reply = "Ну что сказать, обсуждали всё подряд, как обычно. " * 3
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await asyncio.sleep(latency)
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 3
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": 30, "total_tokens": prompt_tokens + 30}
+        base = {"id": "bench", "created": 0, "model": body["model"]}
+        if not body.get("stream"):
+            return web.json_response({
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in reply.split(" "):
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        final = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+        await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+# --- Заглушка Telegram ---
+
+def make_fake_session():
+    from aiogram.client.session.base import BaseSession
+
+    class FakeSession(BaseSession):
+        """Отвечает на методы Bot API без сети, как это сделал бы Telegram."""
+
+        def __init__(self):
+            super().__init__()
+            self.message_ids = count(10_000_000)
+            self.poll_ids: list[str] = []
+            self.calls = 0
+
+        def _message(self, chat_id, **extra) -> dict:
+            return {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME},
+                **extra,
+            }
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls += 1
+            name = method.__api_method__
+            if name == "getMe":
+                result = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+            elif name in ("sendMessage", "editMessageText"):
+                result = self._message(method.chat_id, text=method.text)
+            elif name == "sendPoll":
+                poll_id = f"bench-poll-{len(self.poll_ids)}"
+                self.poll_ids.append(poll_id)
+                result = self._message(method.chat_id, poll={
+                    "id": poll_id,
+                    "question": method.question,
+                    "options": [
+                        {"text": o if isinstance(o, str) else o.text, "voter_count": 0}
+                        for o in method.options
+                    ],
+                    "total_voter_count": 0,
+                    "is_closed": False,
+                    "is_anonymous": bool(method.is_anonymous),
+                    "type": "regular",
+                    "allows_multiple_answers": bool(method.allows_multiple_answers),
+                })
+            else:
+                result = True
+            content = json.dumps({"ok": True, "result": result})
+            return self.check_response(bot, method, 200, content).result
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            # Скачивание файлов в бенчмарке не участвует: отдаём пустое содержимое
+            yield b""
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+
+# --- Генерация апдейтов ---
+
+class UpdateFactory:
+    def __init__(self, seed: int, chats: int, users_per_chat: int = 20):
+        self.rng = random.Random(seed)
+        self.chats = [-1001000000000 - i for i in range(chats)]
+        self.users = [
+            {"id": 1000 + i, "is_bot": False, "first_name": f"User{i}", "username": f"user{i}"}
+            for i in range(users_per_chat)
+        ]
+        self.update_ids = count(1)
+        self.message_ids = {chat: count(1) for chat in self.chats}
+        self.sent: dict[int, list[int]] = {chat: [] for chat in self.chats}
+
+    def _text(self, words: int = 8) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(2, words)))
+
+    def _message(self, chat: int, **extra) -> dict:
+        message_id = next(self.message_ids[chat])
+        self.sent[chat].append(message_id)
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat, "type": "supergroup", "title": "bench"},
+                "from": self.rng.choice(self.users),
+                **extra,
+            },
+        }
+
+    def message(self) -> dict:
+        chat = self.rng.choice(self.chats)
+        extra = {"text": self._text(20)}
+        if self.sent[chat] and self.rng.random() < 0.3:
+            extra["reply_to_message"] = {
+                "message_id": self.rng.choice(self.sent[chat][-50:]),
+                "date": int(time.time()),
+                "chat": {"id": chat, "type": "supergroup", "title": "bench"},
+                "text": "...",
+            }
+        return self._message(chat, **extra)
+
+    def reaction(self) -> dict:
+        chat = self.rng.choice([c for c in self.chats if self.sent[c]])
+        return {
+            "update_id": next(self.update_ids),
+            "message_reaction": {
+                "chat": {"id": chat, "type": "supergroup", "title": "bench"},
+                "message_id": self.rng.choice(self.sent[chat]),
+                "user": self.rng.choice(self.users),
+                "date": int(time.time()),
+                "old_reaction": [],
+                "new_reaction": [{"type": "emoji", "emoji": self.rng.choice("👍🔥😁❤")}],
+            },
+        }
+
+    def poll(self) -> dict:
+        chat = self.rng.choice(self.chats)
+        return self._message(chat, poll={
+            "id": f"source-{next(self.update_ids)}",
+            "question": self._text(6) + "?",
+            "options": [{"text": self._text(3), "voter_count": 0} for _ in range(3)],
+            "total_voter_count": 0,
+            "is_closed": False,
+            "is_anonymous": False,
+            "type": "regular",
+            "allows_multiple_answers": False,
+        })
+
+    def poll_answer(self, poll_ids: list[str]) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "poll_answer": {
+                "poll_id": self.rng.choice(poll_ids),
+                "user": self.rng.choice(self.users),
+                "option_ids": [self.rng.randrange(3)],
+            },
+        }
+
+    def mention(self) -> dict:
+        mention = f"@{BOT_USERNAME}"
+        return self._message(
+            self.rng.choice(self.chats),
+            text=f"{mention} {self._text(10)}?",
+            entities=[{"type": "mention", "offset": 0, "length": len(mention)}],
+        )
+
+    def summary(self) -> dict:
+        return self._message(
+            self.rng.choice(self.chats),
+            text="/summary",
+            entities=[{"type": "bot_command", "offset": 0, "length": 8}],
+        )
+
+
+# --- Прогон ---
+
+async def run_phase(name: str, updates: list[dict], dp, bot, queries: list[int]) -> dict:
+    """
+    Апдейты одного чата идут строго по порядку, разные чаты — параллельно
+    (как при шардировании). В конце сбрасывается буфер записи.
+    """
+    from bot.ingest import ingest_queue
+    from bot.sharding import shard_key
+
+    by_chat: dict[int, list[dict]] = {}
+    for update in updates:
+        by_chat.setdefault(shard_key(update), []).append(update)
+    latencies: list[float] = []
+
+    async def run_chat(chat_updates: list[dict]):
+        for update in chat_updates:
+            started = time.perf_counter()
+            await dp.feed_raw_update(bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    queries[0] = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(run_chat(chat_updates) for chat_updates in by_chat.values()))
+    await ingest_queue.flush()
+    elapsed = time.perf_counter() - started
+    return {
+        "kind": name,
+        "updates": len(updates),
+        "updates_per_sec": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "queries_per_update": round(queries[0] / len(updates), 2) if updates else 0.0,
+    }
+
+
+async def run(args) -> list[dict]:
+    from sqlalchemy import event
+    from bot.config import setup_logging
+    from bot.dbmap import init_db, close_db, engine, read_engine
+    from bot.ingest import ingest_queue
+    import bot.bot as bot_module
+    from aiogram import Bot
+
+    setup_logging()
+    stub = await start_llm_stub(args.llm_port, args.llm_latency_ms / 1000)
+    await init_db()
+    queries = [0]
+    for db_engine in {engine, read_engine}:
+        event.listen(db_engine.sync_engine, "before_cursor_execute", lambda *a: queries.__setitem__(0, queries[0] + 1))
+
+    session = make_fake_session()
+    bot = Bot(token="42:bench", session=session)
+    dp = bot_module.build_dispatcher()
+    await bot_module.init_bot_info(bot, dp)
+    await ingest_queue.start()
+
+    factory = UpdateFactory(args.seed, args.chats)
+    results = []
+    try:
+        results.append(await run_phase("message", [factory.message() for _ in range(args.messages)], dp, bot, queries))
+        results.append(await run_phase("reaction", [factory.reaction() for _ in range(args.reactions)], dp, bot, queries))
+        results.append(await run_phase("poll", [factory.poll() for _ in range(args.polls)], dp, bot, queries))
+        results.append(await run_phase(
+            "poll_answer", [factory.poll_answer(session.poll_ids) for _ in range(args.polls * 10)], dp, bot, queries
+        ))
+        results.append(await run_phase("mention", [factory.mention() for _ in range(args.mentions)], dp, bot, queries))
+        results.append(await run_phase("summary", [factory.summary() for _ in range(args.summaries)], dp, bot, queries))
+    finally:
+        await ingest_queue.stop()
+        await stub.cleanup()
+        await close_db()
+    return results
+
+
+def print_table(results: list[dict]):
+    header = f"{'kind':<12}{'updates':>9}{'upd/s':>11}{'p50 ms':>10}{'p99 ms':>10}{'queries/upd':>13}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['kind']:<12}{r['updates']:>9}{r['updates_per_sec']:>11}"
+            f"{r['p50_ms']:>10}{r['p99_ms']:>10}{r['queries_per_update']:>13}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработки апдейтов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--reactions", type=int, default=500)
+    parser.add_argument("--polls", type=int, default=50)
+    parser.add_argument("--mentions", type=int, default=50)
+    parser.add_argument("--summaries", type=int, default=10)
+    parser.add_argument("--llm-latency-ms", type=float, default=20)
+    parser.add_argument("--workdir", help="каталог для БД и логов (по умолчанию временный)")
+    parser.add_argument("--json", help="куда сохранить результаты для сравнения версий")
+    args = parser.parse_args()
+    args.llm_port = _free_port()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chat_mix_bench_")
+    os.makedirs(os.path.join(workdir, "db"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    os.chdir(workdir)
+    os.environ.update({
+        "DB_TYPE": "sqlite",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+        "LLM_CACHE_ENABLED": "0",
+        "METRICS_PORT": "0",
+    })
+    random.seed(args.seed)
+
+    results = asyncio.run(run(args))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"seed": args.seed, "chats": args.chats, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
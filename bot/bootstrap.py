@@ -0,0 +1,110 @@
+"""
+Запуск бота и отчёт о холодном старте.
+
+Импорт модулей бота не обращается к БД и сети и не настраивает логирование:
+всё это делается явно, по шагам. Схема БД проверяется один раз в init_db
+(DB_SCHEMA_CHECK=0 — только сверка версии), бот-пользователь запрашивается
+в start_bot, кодировка tiktoken загружается в потоке до приёма апдейтов,
+клиент OpenAI создаётся при первом запросе к LLM.
+Длительность шагов собирается в startup_report и попадает в лог перед
+началом приёма апдейтов.
+
+    python -m bot                     # запуск бота
+    python -m bot.bootstrap --report  # замер старта без Telegram: импорты, схема БД
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from bot.config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """Длительность шагов запуска."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps: list[tuple[str, float]] = []
+        self.notes: list[str] = []
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started))
+
+    def note(self, text: str):
+        self.notes.append(text)
+
+    def render(self) -> str:
+        total = time.perf_counter() - self.started
+        width = max([len(name) for name, _ in self.steps] + [5])
+        lines = ["Время запуска:"]
+        lines += [f"  {name:<{width}} {seconds * 1000:8.1f} мс" for name, seconds in self.steps]
+        lines.append(f"  {'всего':<{width}} {total * 1000:8.1f} мс")
+        lines += [f"  {note}" for note in self.notes]
+        return "\n".join(lines)
+
+
+startup_report = StartupReport()
+
+
+def run():
+    """Точка входа python -m bot."""
+    with startup_report.step("логирование"):
+        setup_logging()
+    with startup_report.step("импорт модулей"):
+        from bot.bot import main
+    logger.info('Запускаем бота...')
+    asyncio.run(_start(main))
+
+
+async def _start(main):
+    await load_tokenizer()
+    await main()
+
+
+async def load_tokenizer():
+    """Кодировка tiktoken грузится в потоке до приёма апдейтов; результат попадает в отчёт."""
+    from bot.tokens import load_encoding
+    with startup_report.step("кодировка tiktoken"):
+        name = await asyncio.to_thread(load_encoding)
+    startup_report.note(
+        f"tiktoken: кодировка {name}" if name
+        else "tiktoken: кодировка не загружена, токены считаются приблизительно"
+    )
+
+
+async def _report():
+    # Тяжёлые зависимости отдельно, чтобы было видно, что стоит импорт самого бота
+    with startup_report.step("импорт aiogram"):
+        import aiogram  # noqa: F401
+    with startup_report.step("импорт sqlalchemy"):
+        import sqlalchemy.ext.asyncio  # noqa: F401
+    with startup_report.step("импорт модулей бота"):
+        import bot.bot  # noqa: F401
+        from bot.dbmap import init_db, close_db
+    await load_tokenizer()
+    try:
+        with startup_report.step("схема БД"):
+            await init_db()
+    finally:
+        await close_db()
+    # Отложенный импорт: платится первым запросом к LLM, а не запуском
+    with startup_report.step("клиент OpenAI (при первом запросе)"):
+        from bot.ai import get_client
+        get_client()
+    print(startup_report.render())
+
+
+if __name__ == '__main__':
+    import sys
+    if '--report' not in sys.argv:
+        print(__doc__)
+        raise SystemExit(1)
+    setup_logging()
+    asyncio.run(_report())
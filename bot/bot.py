@@ -1,45 +1,79 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from bot.config import TG_TOKEN
-from bot.dbmap import session, TgUser
+from bot.config import TG_TOKEN, BOT_MODE, BOT_WORKERS, LOG_UPDATE_SAMPLE, ARCHIVE_AFTER_MONTHS, SQLITE_WAL
+from bot.dbmap import init_db, close_db, get_user, engine, run_checkpointer
 from bot.middlewares.error_handler import NetworkErrorMiddleware
+from bot.middlewares.metrics import MetricsMiddleware
+from bot.middlewares.updates import AllUpdatesMiddleware
+from bot.middlewares.outbound import OutboundLimiter
 from bot.handlers import router
+from bot.ingest import ingest_queue
+from bot.webhook import run_webhook
+from bot.sharding import run_sharded
+from bot.metrics import start_metrics_server
+from bot.archive import run_archiver
+from bot.bootstrap import startup_report
 
-bot = None
-self_user = None
-bot_username = None
 logger = logging.getLogger(__name__)
 
-async def init_bot_info(bot):
-    global self_user, bot_username
+async def init_bot_info(bot: Bot, dp: Dispatcher):
+    """Данные бота для обработчиков: приходят им аргументами bot_username и self_user."""
     me = await bot.get_me()
-    bot_username = me.username.lower()
-    self_user = session.query(TgUser).filter(TgUser.tg_id == me.id).scalar()
-    if not self_user:
-        self_user = TgUser(
-            tg_id=me.id,
-            username=me.username,
-            first_name=me.first_name,
-            last_name=me.last_name
-        )
-        session.add(self_user)
-        session.commit()
-        logger.info(f"Добавлен бот-пользователь в БД: {self_user}")
-    else:
-        logger.info(f"Бот-пользователь уже в БД: {self_user}")
+    dp["bot_username"] = me.username.lower()
+    dp["self_user"] = await get_user(me)
+    logger.info(f"Бот-пользователь в БД: {dp['self_user']}")
 
-async def main() -> None:
-    global bot
-    bot = Bot(token=TG_TOKEN)
+def build_dispatcher() -> Dispatcher:
     dp = Dispatcher()
     dp.include_router(router)
+    if LOG_UPDATE_SAMPLE > 0:
+        dp.update.outer_middleware(AllUpdatesMiddleware())
     dp.message.middleware(NetworkErrorMiddleware())
     dp.callback_query.middleware(NetworkErrorMiddleware())
-    await bot.delete_webhook(drop_pending_updates=True)
-    await init_bot_info(bot)
-    await dp.start_polling(bot)
+    # После NetworkErrorMiddleware: сетевые ошибки попадают в status=error до того, как их погасят
+    for observer in (dp.message, dp.callback_query, dp.poll_answer, dp.message_reaction):
+        observer.middleware(MetricsMiddleware())
+    return dp
 
-# if __name__ == '__main__':
-#     logger.info('Запускаем бота...')
-#     asyncio.run(main())
\ No newline at end of file
+async def start_bot() -> tuple[Bot, Dispatcher]:
+    """Создаёт бота и диспетчер текущего процесса."""
+    bot = Bot(token=TG_TOKEN)
+    # Лимиты Telegram, очередность по чатам и повторы на 429/сетевых сбоях
+    bot.session.middleware(OutboundLimiter())
+    dp = build_dispatcher()
+    await init_bot_info(bot, dp)
+    return bot, dp
+
+async def main() -> None:
+    with startup_report.step("схема БД"):
+        await init_db()
+    archiver = asyncio.create_task(run_archiver()) if ARCHIVE_AFTER_MONTHS > 0 else None
+    # Один чекпоинтер на файл БД — и при нескольких процессах-обработчиках
+    checkpointer = asyncio.create_task(run_checkpointer()) if engine.dialect.name == 'sqlite' and SQLITE_WAL else None
+    try:
+        if BOT_WORKERS > 1:
+            logger.info(startup_report.render())
+            await run_sharded(BOT_WORKERS)
+            return
+        with startup_report.step("Telegram: getMe"):
+            bot, dp = await start_bot()
+        with startup_report.step("буфер записи и метрики"):
+            await ingest_queue.start()
+            metrics = await start_metrics_server()
+        logger.info(startup_report.render())
+        try:
+            if BOT_MODE == 'webhook':
+                await run_webhook(bot, dp)
+            else:
+                await bot.delete_webhook(drop_pending_updates=True)
+                await dp.start_polling(bot)
+        finally:
+            await ingest_queue.stop()
+            if metrics:
+                await metrics.cleanup()
+    finally:
+        for task in (archiver, checkpointer):
+            if task:
+                task.cancel()
+        await close_db()
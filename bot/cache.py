@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from bot.config import USER_CACHE_SIZE, POLL_CACHE_SIZE
+
+
+@dataclass
+class CachedUser:
+    """Лёгкая копия строки users, живущая в памяти без сессии."""
+    id: int
+    tg_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+    @classmethod
+    def from_row(cls, user) -> "CachedUser":
+        return cls(
+            id=user.id,
+            tg_id=user.tg_id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+        )
+
+    def same_names(self, username, first_name, last_name) -> bool:
+        return (self.username, self.first_name, self.last_name) == (username, first_name, last_name)
+
+    def __repr__(self):
+        return f'{self.username} ({self.first_name} {self.last_name})'
+
+
+class LRUCache:
+    """
+    Ограниченный LRU-кэш. Ключ записи берётся из неё самой методом key,
+    при переполнении вытесняется давно не читанная запись.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, item):
+        raise NotImplementedError
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, item):
+        key = self.key(item)
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class UserCache(LRUCache):
+    """Кэш пользователей по Telegram id."""
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE):
+        super().__init__(maxsize)
+
+    def key(self, user: CachedUser) -> int:
+        return user.tg_id
+
+
+user_cache = UserCache()
+
+
+@dataclass
+class CachedPoll:
+    """Опрос из tg_polls с уже разобранным списком вариантов."""
+    id: int
+    poll_id: str
+    chat_id: Optional[int]
+    tg_message_id: Optional[int]
+    question: str
+    options: list[str]
+
+    @classmethod
+    def from_row(cls, poll) -> "CachedPoll":
+        return cls(
+            id=poll.id,
+            poll_id=poll.poll_id,
+            chat_id=poll.chat_id,
+            tg_message_id=poll.tg_message_id,
+            question=poll.question,
+            options=list(poll.options or []),
+        )
+
+    def option_text(self, index: int) -> str:
+        return self.options[index] if 0 <= index < len(self.options) else "<неизвестный вариант>"
+
+
+class PollCache(LRUCache):
+    """Кэш опросов по poll_id: голос не требует похода в БД."""
+
+    def __init__(self, maxsize: int = POLL_CACHE_SIZE):
+        super().__init__(maxsize)
+
+    def key(self, poll: CachedPoll) -> str:
+        return poll.poll_id
+
+
+poll_cache = PollCache()
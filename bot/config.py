@@ -1,28 +1,121 @@
 import os
 from logging.config import dictConfig
 from logging import getLogger, StreamHandler
+from logging.handlers import QueueHandler
+from bot.logs import start_log_queue
 
 # BASE_DIR = Path(__file__).resolve().parent.parent
 ADMIN_LIST = [id.strip() for id in os.environ.get('ADMIN_LIST','99129974').split(',')]
 
 TG_TOKEN = os.environ.get('TG_TOKEN', '')
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8080'))
+# Метрики Prometheus: порт HTTP-сервера (0 — выключено) и сэмплирующий профайлер
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_PROFILER = os.environ.get('METRICS_PROFILER', '0') == '1'
+# Число процессов-обработчиков; больше 1 — апдейты раскладываются по процессам по chat_id
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+# Сколько секунд при остановке (SIGTERM) ждать апдейты, которые ещё обрабатываются;
+# меньше stop_grace_period в docker-compose.yml
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '20'))
+
+# Исходящие запросы к Telegram: общий лимит бота (в секунду, делится между процессами),
+# лимиты на чат (личный — в секунду, группа — в минуту) и число повторов при сбоях
+OUTBOUND_GLOBAL_PER_SEC = float(os.environ.get('OUTBOUND_GLOBAL_PER_SEC', '30'))
+OUTBOUND_PRIVATE_PER_SEC = float(os.environ.get('OUTBOUND_PRIVATE_PER_SEC', '1'))
+OUTBOUND_GROUP_PER_MIN = int(os.environ.get('OUTBOUND_GROUP_PER_MIN', '20'))
+OUTBOUND_RETRIES = int(os.environ.get('OUTBOUND_RETRIES', '3'))
+
 DB_USER = os.environ.get('POSTGRES_USER')
 DB_PASSWORD = os.environ.get('POSTGRES_PASSWORD')
 DB_HOST = 'db_kot'
 DB_PORT = '5432'
 DB_NAME = os.environ.get('POSTGRES_DB')
 if os.environ.get('DB_TYPE') == 'postgres':
-	DB_STRING = f'postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+	DB_STRING = f'postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 else:
-	DB_STRING = 'sqlite:///db/db.sqlite3'
+	DB_STRING = 'sqlite+aiosqlite:///db/db.sqlite3'
+
+# SQLite: WAL, один соединение-писатель и пул читателей (SQLITE_WAL=0 — прежний режим
+# с настройками по умолчанию), ожидание блокировки и период чекпоинта WAL в секундах
+SQLITE_WAL = os.getenv('SQLITE_WAL', '1') == '1'
+SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '4'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CHECKPOINT_SECONDS = float(os.getenv('SQLITE_CHECKPOINT_SECONDS', '300'))
+
+# Буфер записи сообщений: сброс в БД каждые N записей или M миллисекунд
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '100'))
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv('INGEST_FLUSH_INTERVAL_MS', '500'))
+
+# Сколько пользователей держать в LRU-кэше get_user
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+# Сколько разобранных опросов держать в памяти для подсчёта голосов
+POLL_CACHE_SIZE = int(os.getenv('POLL_CACHE_SIZE', '256'))
+
+# Кольцевой буфер последних сообщений чата: глубина и лимит текста (в символах) на чат
+RECENT_MESSAGES_DEPTH = int(os.getenv('RECENT_MESSAGES_DEPTH', '50'))
+RECENT_MESSAGES_MAX_CHARS = int(os.getenv('RECENT_MESSAGES_MAX_CHARS', '65536'))
 
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+# OpenAI-совместимый сервер вместо api.openai.com (прокси, локальная модель, заглушка бенчмарка)
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
 OPENAI_MODEL = 'gpt-4o-mini'
+# Потоковый вывод ответов LLM правкой сообщения-заглушки; пауза между правками в секундах
+# в личке и в группах (в группе Telegram даёт около 20 сообщений и правок в минуту)
+LLM_STREAMING = os.getenv('LLM_STREAMING', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv('STREAM_EDIT_INTERVAL_GROUP', '3.0'))
+
+# Планировщик запросов к LLM: параллельность, предел очереди, повторы и базовая пауза (с)
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '4'))
+LLM_QUEUE_LIMIT = int(os.getenv('LLM_QUEUE_LIMIT', '50'))
+LLM_RETRIES = int(os.getenv('LLM_RETRIES', '3'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '1.0'))
+
+# Локальный кэш ответов LLM для саммари (отдельный SQLite-файл)
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'db/llm_cache.sqlite3')
+LLM_CACHE_TTL_HOURS = float(os.getenv('LLM_CACHE_TTL_HOURS', '720'))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '5000'))
+
+# Map-reduce саммари: бюджет входа одного запроса (в токенах), размер
+# промежуточного конспекта и число фрагментов, суммаризируемых параллельно
+SUMMARY_CONTEXT_TOKENS = int(os.getenv('SUMMARY_CONTEXT_TOKENS', '12000'))
+SUMMARY_CHUNK_MAX_TOKENS = int(os.getenv('SUMMARY_CHUNK_MAX_TOKENS', '700'))
+SUMMARY_PARALLELISM = int(os.getenv('SUMMARY_PARALLELISM', '4'))
+# Бюджет контекста (в токенах) для ответов бота на упоминания
+REPLY_CONTEXT_TOKENS = int(os.getenv('REPLY_CONTEXT_TOKENS', '1500'))
+# Размер корзины кэшируемых конспектов, в минутах (должен делить сутки)
+SUMMARY_ROLLUP_MINUTES = int(os.getenv('SUMMARY_ROLLUP_MINUTES', '60'))
 
-LOG_LEVEL = os.getenv('LOG_LEVEL','DEBUG')
+# Архив: месяцы старше ARCHIVE_AFTER_MONTHS (0 — не архивировать) уносятся из messages
+# в сжатые JSONL-файлы в ARCHIVE_DIR; саммари и поиск читают их прозрачно
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '0'))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'db/archive')
+ARCHIVE_CHECK_HOURS = float(os.getenv('ARCHIVE_CHECK_HOURS', '24'))
+# /search заглядывает в архив, только если задан период, и не дальше N последних месяцев периода
+ARCHIVE_SEARCH_MAX_MONTHS = int(os.getenv('ARCHIVE_SEARCH_MAX_MONTHS', '12'))
+
+LOG_LEVEL = os.getenv('LOG_LEVEL','INFO')
 LOG_FILE = os.getenv('LOG_FILE',f'logs/{LOG_LEVEL.lower()}.log')
+# Ротация файла логов: размер одного файла и число сжатых архивов
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+# Полные дампы апдейтов (уровень DEBUG): доля попадающих в лог и предел в минуту
+LOG_UPDATE_SAMPLE = float(os.getenv('LOG_UPDATE_SAMPLE', '0.01'))
+LOG_UPDATE_MAX_PER_MIN = int(os.getenv('LOG_UPDATE_MAX_PER_MIN', '30'))
 LOGGER_NAME = os.getenv('LOGGER_NAME','chat_mix_bot')
 
+# Проверять и применять миграции схемы при старте (0 — только сверить версию;
+# миграции тогда запускаются отдельно: python -m bot.migrations)
+DB_SCHEMA_CHECK = os.getenv('DB_SCHEMA_CHECK', '1') == '1'
+
 GENNADY_PERSONA = {
     "name": "Геннадий",
     "description": (
@@ -39,9 +132,12 @@ HELP_TEXT = '''
 
 /help — показать справку  
 /summary <дата1> <время1> <дата2> <время2> — создать саммари сообщений за указанный период
+/statistic — статистика чата: сообщения, самые активные, реакции, активность по часам
+/search <запрос> [период] — найти сообщения; период — 12h, 7d, 2w или <дата1> <время1> <дата2> <время2> (старые месяцы из архива ищутся только с периодом)
 
 Пример:
   /summary 01.07.2025 10:00 01.07.2025 15:00
+  /search отпуск 7d
 
 Обычные сообщения, реакции, опросы и ответы сохраняются, чтобы потом их можно было удобно анализировать или пересматривать.
 Сообщения в ответах сохраняются с привязкой к исходному, а GPT-саммари учитывает, кто кому отвечал.
@@ -49,38 +145,65 @@ HELP_TEXT = '''
 По всем вопросам — обращайтесь к администратору.
 '''
 
-dictConfig({
-	'version': 1,
-	'disable_existing_loggers': False,
-	'formatters': 
-		{
-		'default': 
+_logging_ready = False
+
+
+def setup_logging(log_queue=None):
+	"""
+	Настраивает логирование (stdout и файл за очередью). Вызывается точками
+	входа, а не при импорте: импорт config не открывает файлов и не запускает потоков.
+	С log_queue (процесс-обработчик при BOT_WORKERS > 1) записи только
+	пересылаются в очередь фронт-процесса, файл пишет он один.
+	"""
+	global _logging_ready
+	if _logging_ready:
+		return
+	_logging_ready = True
+	if log_queue is not None:
+		root = getLogger()
+		root.setLevel(LOG_LEVEL)
+		root.addHandler(QueueHandler(log_queue))
+		start_log_queue()
+		return
+	if os.path.dirname(LOG_FILE):
+		os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+	dictConfig({
+		'version': 1,
+		'disable_existing_loggers': False,
+		'formatters': 
 			{
-			'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+			'default': 
+				{
+				'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+				}
+			},
+		'handlers': 
+			{
+			'stdout': 
+				{
+				'class': 'logging.StreamHandler',
+				'formatter': 'default', 
+				'stream': 'ext://sys.stdout',
+				},
+			'file':{
+				'formatter':'default',
+				'class':'bot.logs.CompressedRotatingFileHandler',
+				'filename': LOG_FILE,
+				'maxBytes': LOG_MAX_BYTES,
+				'backupCount': LOG_BACKUP_COUNT,
+				'encoding': 'utf-8',
 			}
-		},
-	'handlers': 
-		{
-		'stdout': 
+		}, 
+		'loggers': 
 			{
-			'class': 'logging.StreamHandler',
-			'formatter': 'default', 
-			'stream': 'ext://sys.stdout',
-			},
-		'file':{
-			'formatter':'default',
-			'class':'logging.FileHandler',
-			'filename': LOG_FILE
-		}
-	}, 
-	'loggers': 
-		{
-		'': 
-			{                  
-			'handlers': ['stdout', 'file'],    
-			'level': LOG_LEVEL,    
-			'propagate': True 
+			'': 
+				{                  
+				'handlers': ['stdout', 'file'],    
+				'level': LOG_LEVEL,    
+				'propagate': True 
+				}
 			}
 		}
-	}
-)
\ No newline at end of file
+	)
+	# Запись в stdout и файл — в фоновом потоке, не в event loop
+	start_log_queue()
@@ -0,0 +1,73 @@
+"""
+Сборка контекста для LLM по бюджету токенов.
+
+Используются счётчики, посчитанные при записи сообщения (MessageRow.token_count),
+поэтому историю не приходится токенизировать заново.
+"""
+from bot.config import REPLY_CONTEXT_TOKENS, SUMMARY_CONTEXT_TOKENS
+from bot.tokens import count_tokens, truncate_to_tokens, HEADER_TOKENS, REPLY_EXCERPT_TOKENS
+
+
+def row_tokens(row) -> int:
+    return (
+        row.token_count + HEADER_TOKENS
+        + (REPLY_EXCERPT_TOKENS if row.reply_text else 0)
+        + (count_tokens(row.reactions) if row.reactions else 0)
+        + (count_tokens(row.poll_results) if row.poll_results else 0)
+    )
+
+
+def reply_context(rows: list, budget: int = REPLY_CONTEXT_TOKENS) -> list:
+    """
+    Самые свежие сообщения, влезающие в budget токенов, в хронологическом порядке.
+    Последнее сообщение берётся всегда, даже если оно одно больше бюджета.
+    """
+    picked = []
+    used = 0
+    for row in reversed(rows):
+        tokens = row_tokens(row)
+        if picked and used + tokens > budget:
+            break
+        picked.append(row)
+        used += tokens
+    picked.reverse()
+    return picked
+
+
+class ChunkPacker:
+    """
+    Склеивает блоки (сообщения или конспекты) во фрагменты не больше budget токенов.
+    Блоки не разрываются; блок больше бюджета обрезается и идёт отдельным фрагментом.
+    """
+
+    def __init__(self, budget: int = SUMMARY_CONTEXT_TOKENS):
+        self.budget = budget
+        self.chunks: list[str] = []
+        self._current: list[str] = []
+        self._current_tokens = 0
+        self.blocks = 0
+
+    def add(self, block: str, tokens: int):
+        self.blocks += 1
+        if tokens > self.budget:
+            block = truncate_to_tokens(block, self.budget)
+            tokens = self.budget
+        if self._current and self._current_tokens + tokens > self.budget:
+            self.chunks.append("\n".join(self._current))
+            self._current, self._current_tokens = [], 0
+        self._current.append(block)
+        self._current_tokens += tokens
+
+    def finish(self) -> list[str]:
+        if self._current:
+            self.chunks.append("\n".join(self._current))
+            self._current, self._current_tokens = [], 0
+        return self.chunks
+
+
+def split_by_budget(blocks: list[str], budget: int = SUMMARY_CONTEXT_TOKENS) -> list[str]:
+    """Нарезка готовых текстов (например, конспектов) по бюджету."""
+    packer = ChunkPacker(budget)
+    for block in blocks:
+        packer.add(block, count_tokens(block))
+    return packer.finish()
@@ -0,0 +1,182 @@
+"""
+Бенчмарк одновременного чтения и записи SQLite.
+
+Процесс-писатель пишет сообщения пакетами, как буфер записи (write_messages_batch),
+в это же время несколько задач другого процесса читают, как /summary,
+/statistic и /search (отдельные процессы — чтобы мерить блокировки SQLite,
+а не общий event loop).
+Прогон делается дважды в отдельных процессах, на свежей БД с одинаковой
+историей: SQLITE_WAL=0 (настройки SQLite по умолчанию) и SQLITE_WAL=1 (WAL,
+писатель и пул читателей). Печатается пропускная способность и задержки.
+
+    python -m bot.db_benchmark
+    python -m bot.db_benchmark --seconds 20 --readers 8 --json db_bench.json
+"""
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+PROFILES = (("default", "0"), ("wal", "1"))
+WORDS = "привет отпуск море кот пицца работа релиз созвон кофе ужин погода футбол".split()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+
+
+async def _child(args) -> dict:
+    from aiogram.types import User
+    from bot.config import setup_logging
+    from bot.dbmap import init_db, close_db, get_user, write_messages_batch
+    from bot.dbmap import iter_messages_by_chat_and_range, get_statistic, search_messages
+    from bot.ingest import MessageRecord
+
+    setup_logging()
+    # Роли в разных процессах, чтобы мерить блокировки SQLite, а не общий event loop
+    rng = random.Random(f"{args.seed}-{args.child}")
+    chats = [-100 - i for i in range(args.chats)]
+    now = dt.datetime.now()
+    if args.child == "seed":
+        await init_db()
+    users = [await get_user(User(id=1000 + i, is_bot=False, first_name=f"u{i}")) for i in range(20)]
+    tg_ids = {chat_id: 0 if args.child == "seed" else args.history for chat_id in chats}
+
+    def record(date: dt.datetime) -> MessageRecord:
+        chat_id = rng.choice(chats)
+        tg_ids[chat_id] += 1
+        return MessageRecord(rng.choice(users).id, chat_id, _text(rng), tg_message_id=tg_ids[chat_id], date=date)
+
+    deadline = time.monotonic() + args.seconds
+    result = {}
+    latencies: dict[str, list[float]] = {}
+    errors = [0]
+
+    async def timed(kind: str, coro):
+        started = time.perf_counter()
+        try:
+            await coro
+        except Exception:
+            errors[0] += 1
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    async def write_batch(batch):
+        await write_messages_batch(batch)
+
+    async def summary(chat_id: int):
+        async for _ in iter_messages_by_chat_and_range(chat_id, now - dt.timedelta(days=1), dt.datetime.now()):
+            pass
+
+    async def reader(index: int):
+        while time.monotonic() < deadline:
+            chat_id = rng.choice(chats)
+            kind = ("summary", "statistic", "search")[index % 3]
+            index += 1
+            if kind == "summary":
+                await timed(kind, summary(chat_id))
+            elif kind == "statistic":
+                await timed(kind, get_statistic(chat_id))
+            else:
+                await timed(kind, search_messages(chat_id, rng.choice(WORDS)))
+
+    try:
+        if args.child == "seed":
+            # История за сутки до начала замера
+            for start in range(0, args.history, args.batch):
+                await write_messages_batch([
+                    record(now - dt.timedelta(seconds=(args.history - i) * 86400 / args.history))
+                    for i in range(start, min(start + args.batch, args.history))
+                ])
+            return {}
+        if args.child == "writer":
+            while time.monotonic() < deadline:
+                await timed("write_batch", write_batch([record(dt.datetime.now()) for _ in range(args.batch)]))
+            writes = len(latencies.get("write_batch", [])) - errors[0]
+            result["writes_per_sec"] = round(writes * args.batch / args.seconds, 1)
+        else:
+            await asyncio.gather(*(reader(i) for i in range(args.readers)))
+    finally:
+        await close_db()
+
+    for kind, values in latencies.items():
+        if kind != "write_batch":
+            result[f"{kind}_per_sec"] = round(len(values) / args.seconds, 1)
+        result[f"{kind}_p99_ms"] = round(percentile(values, 0.99) * 1000, 1)
+    result[f"{args.child}_errors"] = errors[0]
+    return result
+
+
+def _run_profile(args, name: str, wal: str) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"chat_mix_db_bench_{name}_")
+    os.makedirs(os.path.join(workdir, "db"))
+    os.makedirs(os.path.join(workdir, "logs"))
+    env = dict(
+        os.environ, DB_TYPE="sqlite", SQLITE_WAL=wal, LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+        PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])),
+    )
+
+    def command(role: str) -> list[str]:
+        return [
+            sys.executable, "-m", "bot.db_benchmark", "--child", role,
+            "--seconds", str(args.seconds), "--readers", str(args.readers), "--chats", str(args.chats),
+            "--history", str(args.history), "--batch", str(args.batch), "--seed", str(args.seed),
+        ]
+
+    subprocess.run(command("seed"), cwd=workdir, env=env, check=True, capture_output=True)
+    processes = [
+        subprocess.Popen(command(role), cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+        for role in ("writer", "reader")
+    ]
+    result = {"profile": name}
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"процесс бенчмарка завершился с кодом {process.returncode}")
+        result.update(json.loads(output.strip().splitlines()[-1]))
+    return result
+
+
+def print_table(results: list[dict]):
+    columns = [key for key in results[0] if key != "profile"]
+    print(f"{'':<22}" + "".join(f"{r['profile']:>12}" for r in results))
+    for key in columns:
+        print(f"{key:<22}" + "".join(f"{r[key]:>12}" for r in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк одновременного чтения и записи SQLite")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--history", type=int, default=20000, help="сообщений в БД до начала замера")
+    parser.add_argument("--batch", type=int, default=50, help="размер пакета записи")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="куда сохранить результаты")
+    parser.add_argument("--child", choices=("seed", "writer", "reader"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(_child(args))))
+        return
+    results = [_run_profile(args, name, wal) for name, wal in PROFILES]
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,91 @@
 import os
 import re
 import datetime as dt
-from bot.config import DB_STRING
-from sqlalchemy import create_engine, Column, Integer, Boolean, String, String, DateTime, ForeignKey, Text, desc, JSON
-from sqlalchemy.orm import scoped_session, declarative_base, sessionmaker, relationship, Mapper, joinedload
-from sqlalchemy.orm.exc import DetachedInstanceError
+from bot.config import (
+    DB_STRING, SUMMARY_ROLLUP_MINUTES, DB_SCHEMA_CHECK,
+    SQLITE_WAL, SQLITE_READ_POOL_SIZE, SQLITE_BUSY_TIMEOUT_MS, SQLITE_CHECKPOINT_SECONDS,
+)
+from bot.cache import CachedUser, user_cache, CachedPoll, poll_cache
+from bot.tokens import count_tokens
+from sqlalchemy import Column, Integer, Boolean, String, String, DateTime, ForeignKey, Text, desc, JSON, Index, select, delete, func, and_, or_, text, event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Mapper, joinedload, aliased
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from aiogram.types import Message, Poll
 from aiogram.types.user import User as TelegramUser
-from typing import Optional
+from typing import Optional, AsyncIterator
+import asyncio
 import logging
 import json
 logger = logging.getLogger(__name__)
 
 Base = declarative_base()
-engine = create_engine(DB_STRING)
-session = scoped_session(sessionmaker(bind=engine))
 
-Base.query = session.query_property()
+
+def _sqlite_pragmas(*pragmas: str):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+    return on_connect
+
+
+if DB_STRING.startswith('sqlite') and SQLITE_WAL:
+    # WAL: чтение не ждёт записи. Пишет одно соединение (очередь писателей — в пуле,
+    # а не в SQLITE_BUSY), длинные выборки /summary, /statistic и /search идут
+    # через отдельный пул соединений только для чтения
+    engine = create_async_engine(DB_STRING, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0)
+    read_engine = create_async_engine(
+        DB_STRING, poolclass=AsyncAdaptedQueuePool, pool_size=SQLITE_READ_POOL_SIZE, max_overflow=0
+    )
+    _common = (f"busy_timeout={SQLITE_BUSY_TIMEOUT_MS}", "temp_store=MEMORY", "cache_size=-16000")
+    event.listen(engine.sync_engine, "connect", _sqlite_pragmas(
+        "journal_mode=WAL", "synchronous=NORMAL", *_common
+    ))
+    event.listen(read_engine.sync_engine, "connect", _sqlite_pragmas(
+        "query_only=ON", "mmap_size=268435456", *_common
+    ))
+else:
+    engine = create_async_engine(DB_STRING)
+    read_engine = engine
+# expire_on_commit=False: объекты остаются читаемыми после закрытия сессии,
+# без ленивых запросов, которые в asyncio недоступны
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Только чтение; для PostgreSQL и SQLite без WAL — тот же движок
+ReadSession = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def close_db():
+    """Закрывает соединения обоих движков (потоки aiosqlite иначе держат процесс)."""
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+
+
+async def run_checkpointer(interval: float = SQLITE_CHECKPOINT_SECONDS):
+    """
+    Периодический чекпоинт WAL. Автоматический чекпоинт SQLite не уменьшает
+    файл -wal и пропускает страницы, которые держат долгие читатели;
+    TRUNCATE переносит всё и обрезает файл, когда читатели не мешают.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with engine.connect() as conn:
+                busy, log_pages, moved = (await conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))).one()
+            logger.debug(f"[db] Чекпоинт WAL: страниц {log_pages}, перенесено {moved}, busy={busy}")
+        except Exception as e:
+            logger.exception(f"[db] Ошибка чекпоинта WAL: {e}")
 
 
 class TgUser(Base):
 	__tablename__ = 'users'
-	__tableargs__ = {
-		'comment': 'Пользователи'
-	}
+	__table_args__ = (
+		Index('uq_users_tg_id', 'tg_id', unique=True),
+		{'comment': 'Пользователи'},
+	)
 	id = Column(Integer,nullable=False,unique=True,primary_key=True,autoincrement=True)
 	tg_id = Column(Integer, comment='ID TG')
 	username = Column(String(128), comment='username')
@@ -35,7 +97,11 @@ class TgUser(Base):
 
 class TgMessage(Base):
     __tablename__ = 'messages'
-    __table_args__ = {'comment': 'Сообщения Telegram'}
+    __table_args__ = (
+        Index('ix_messages_chat_date', 'chat_id', 'date'),
+        Index('ix_messages_chat_tg_msg', 'chat_id', 'tg_message_id'),
+        {'comment': 'Сообщения Telegram'},
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     
@@ -47,6 +113,9 @@ class TgMessage(Base):
     # Telegram message_id (нужен для reply-to сопоставления)
     tg_message_id = Column(Integer, comment='ID сообщения в Telegram-чате')
 
+    # Считается один раз при записи, чтобы не токенизировать историю заново
+    token_count = Column(Integer, nullable=True, comment='Число токенов в тексте')
+
     # Ответ на сообщение (внутри базы)
     reply_to_message_id = Column(Integer, ForeignKey('messages.id'), nullable=True, comment="Ответ на сообщение")
     reply_to_message = relationship("TgMessage", remote_side=[id], backref="replies")
@@ -56,9 +125,10 @@ class TgMessage(Base):
 
 class TgSummary(Base):
 	__tablename__ = 'summaries'
-	__tableargs__ = {
-		'comment': 'История сгенерированных саммари'
-	}
+	__table_args__ = (
+		Index('ix_summaries_chat_created', 'chat_id', 'created_at'),
+		{'comment': 'История сгенерированных саммари'},
+	)
 
 	id = Column(Integer, primary_key=True, autoincrement=True)
 	chat_id = Column(Integer, comment='ID чата')
@@ -69,6 +139,65 @@ class TgSummary(Base):
 	range_end = Column(DateTime, comment='Конец диапазона')
 	style = Column(Text, nullable=True, comment='Стиль, заданный пользователем')
 
+class TgSummaryRollup(Base):
+    __tablename__ = 'summary_rollups'
+    __table_args__ = (
+        Index('uq_summary_rollups_chat_span', 'chat_id', 'bucket_start', 'bucket_end', unique=True),
+        {'comment': 'Промежуточные конспекты чата по отрезкам из соседних временных корзин'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Integer, comment='ID чата')
+    bucket_start = Column(DateTime, comment='Начало отрезка (первой корзины)')
+    bucket_end = Column(DateTime, comment='Конец отрезка (последней корзины)')
+    message_count = Column(Integer, comment='Сколько сообщений вошло в конспект')
+    text = Column(Text, comment='Конспект отрезка (пустой, если сообщений не было)')
+    created_at = Column(DateTime, default=dt.datetime.utcnow, comment='Время генерации')
+
+class TgMessageReaction(Base):
+    __tablename__ = 'message_reactions'
+    __table_args__ = {'comment': 'Число реакций на сообщение по каждому эмодзи'}
+
+    message_id = Column(Integer, ForeignKey('messages.id'), primary_key=True, autoincrement=False, comment='Сообщение')
+    emoji = Column(String(32), primary_key=True, comment='Эмодзи')
+    count = Column(Integer, nullable=False, default=0, comment='Сколько раз поставлена')
+
+class TgChatStats(Base):
+    __tablename__ = 'chat_stats'
+    __table_args__ = {'comment': 'Счётчики чата, обновляются при записи'}
+
+    chat_id = Column(Integer, primary_key=True, autoincrement=False, comment='ID чата')
+    messages = Column(Integer, nullable=False, default=0, comment='Сообщений (без реакций)')
+    reactions = Column(Integer, nullable=False, default=0, comment='Реакций')
+    summaries = Column(Integer, nullable=False, default=0, comment='Сгенерированных саммари')
+
+class TgChatUserStats(Base):
+    __tablename__ = 'chat_user_stats'
+    __table_args__ = {'comment': 'Счётчики участника чата, обновляются при записи'}
+
+    chat_id = Column(Integer, primary_key=True, autoincrement=False, comment='ID чата')
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, autoincrement=False, comment='Участник')
+    messages = Column(Integer, nullable=False, default=0, comment='Сообщений (без реакций)')
+    reactions_received = Column(Integer, nullable=False, default=0, comment='Реакций на его сообщения')
+
+class TgChatHourStats(Base):
+    __tablename__ = 'chat_hour_stats'
+    __table_args__ = {'comment': 'Активность чата по часам суток'}
+
+    chat_id = Column(Integer, primary_key=True, autoincrement=False, comment='ID чата')
+    hour = Column(Integer, primary_key=True, autoincrement=False, comment='Час (0-23)')
+    messages = Column(Integer, nullable=False, default=0, comment='Сообщений в этот час')
+
+class TgArchivedPeriod(Base):
+    __tablename__ = 'archived_periods'
+    __table_args__ = {'comment': 'Месяцы истории чата, вынесенные в архивные файлы'}
+
+    chat_id = Column(Integer, primary_key=True, autoincrement=False, comment='ID чата')
+    month_start = Column(DateTime, primary_key=True, comment='Первое число месяца')
+    path = Column(String(512), comment='Файл архива (JSONL, gzip)')
+    message_count = Column(Integer, comment='Сколько сообщений в архиве')
+    archived_at = Column(DateTime, default=dt.datetime.utcnow, comment='Время архивации')
+
 class TgPoll(Base):
     __tablename__ = "tg_polls"
     id = Column(Integer, primary_key=True)
@@ -76,21 +205,95 @@ class TgPoll(Base):
     chat_id = Column(Integer, nullable=True)
     question = Column(String, nullable=False)
     options = Column(JSON, nullable=False)  # Сохраняем список текстов
+    tg_message_id = Column(Integer, nullable=True)  # Исходное сообщение с опросом в messages
+
+
+class TgPollVote(Base):
+    __tablename__ = 'poll_votes'
+    __table_args__ = {'comment': 'Текущие голоса в опросах: по строке на выбранный вариант'}
+
+    poll_id = Column(Integer, ForeignKey('tg_polls.id'), primary_key=True, autoincrement=False, comment='Опрос')
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, autoincrement=False, comment='Проголосовавший')
+    option_index = Column(Integer, primary_key=True, autoincrement=False, comment='Номер варианта')
+
+
+class MessageRow:
+    """
+    Компактное представление сообщения для построения контекста:
+    без сессии, ленивых связей и прочего ORM-багажа.
+    """
+    __slots__ = ('date', 'text', 'username', 'first_name', 'last_name', 'reply_text', 'token_count', 'reactions', 'poll_results')
+
+    def __init__(self, date, text, username=None, first_name=None, last_name=None, reply_text=None, token_count=None, reactions=None, poll_results=None):
+        self.date = date
+        self.text = text
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.reply_text = reply_text
+        # Для строк, записанных до появления messages.token_count, считаем на лету
+        self.token_count = token_count if token_count is not None else count_tokens(text)
+        # Свёрнутые реакции, например "👍×3 🔥"
+        self.reactions = reactions
+        # Текущие итоги, если сообщение — опрос: "Да — 3, Нет — 1"
+        self.poll_results = poll_results
+
+    @classmethod
+    def from_message(cls, m: "TgMessage") -> "MessageRow":
+        user = m.messages_from_user
+        return cls(
+            date=m.date,
+            text=m.text,
+            username=user.username if user else None,
+            first_name=user.first_name if user else None,
+            last_name=user.last_name if user else None,
+            token_count=m.token_count,
+        )
+
+    def size(self) -> int:
+        """Примерный объём текста в символах — для лимита памяти кольцевого буфера."""
+        return len(self.text or '') + len(self.reply_text or '')
 
 # Создаем таблицы
 #======================================
 
-Base.metadata.create_all(bind=engine)
-self_user = session.query(TgUser).filter(TgUser.tg_id==0).scalar()
-admin_user = session.query(TgUser).filter(TgUser.id==1).scalar()
-if not self_user:
-	self_user = TgUser(tg_id=0, username='Bot', first_name='', last_name='')
-session.add(self_user)
-session.commit()
+self_user = None
+
+
+async def init_db(check_schema: bool = DB_SCHEMA_CHECK):
+    """
+    Применяет миграции схемы и создаёт служебного пользователя бота (tg_id=0).
+    Вызывается один раз при старте, до начала обработки апдейтов; импорт
+    модулей к БД не обращается. С check_schema=False миграции не запускаются,
+    только сверяется версия схемы.
+    """
+    from bot.migrations import migrate, current_version, LATEST_VERSION
+    global self_user
+    if check_schema:
+        await migrate()
+    else:
+        version = await current_version()
+        if version is None or version < LATEST_VERSION:
+            raise RuntimeError(
+                f"Версия схемы БД {version}, нужна {LATEST_VERSION}: запустите python -m bot.migrations"
+            )
+    async with Session() as session:
+        self_user = (await session.execute(
+            select(TgUser).where(TgUser.tg_id == 0)
+        )).scalar()
+        if not self_user:
+            self_user = TgUser(tg_id=0, username='Bot', first_name='', last_name='')
+            session.add(self_user)
+            await session.commit()
 
 #======================================
 
-def get_user(telegram_user: TelegramUser) -> TgUser:
+async def get_user(telegram_user: TelegramUser) -> CachedUser:
+    """
+    Возвращает пользователя по данным из Telegram, создавая его при необходимости.
+    Сначала смотрит в user_cache; в БД идёт только при промахе или если
+    у пользователя сменились username/имя/фамилия — тогда строка обновляется.
+    """
     if telegram_user is None:
         raise ValueError("telegram_user is None")
 
@@ -99,86 +302,183 @@ def get_user(telegram_user: TelegramUser) -> TgUser:
     last_name = telegram_user.last_name
     username = telegram_user.username
 
-    user = session.query(TgUser).filter(TgUser.tg_id == tg_id).scalar()
-
-    if not user:
-        logger.info(f'Пользователь {username} ({first_name} {last_name}) не найден в БД')
-        user = TgUser(
-            tg_id=tg_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
-        )
-        session.add(user)
-        session.commit()
-        logger.info(f'Создан пользователь: {user}')
-
-    return user
-
-
-def write_msg_to_db(
-    *,
-    text: str,
-    from_user: TgUser,
-    chat_id: int,
-    tg_message_id: Optional[int] = None,
-    reply_to_tg_msg_id: Optional[int] = None
-):
-    try:
-        # Найдём базовое сообщение, если текущее — это ответ
-        reply_to_msg = None
-        if reply_to_tg_msg_id:
-            reply_to_msg = session.query(TgMessage).filter_by(
-                chat_id=chat_id,
-                tg_message_id=reply_to_tg_msg_id
-            ).first()
-
-        message = TgMessage(
-            from_user=from_user.id,
-            chat_id=chat_id,
-            text=text,
-            date=dt.datetime.now(),
-            tg_message_id=tg_message_id,
-            reply_to_message_id=reply_to_msg.id if reply_to_msg else None
-        )
-        session.add(message)
-        session.commit()
-        return message
-    except Exception as e:
-        logger.exception(f"[DB] Ошибка при сохранении сообщения: {e}")
-        session.rollback()
-
-
-def get_messages_by_chat_and_range(chat_id: int, start: dt.datetime, end: dt.datetime) -> list[TgMessage]:
+    cached = user_cache.get(tg_id)
+    if cached and cached.same_names(username, first_name, last_name):
+        return cached
+
+    async with Session() as session:
+        user = (await session.execute(
+            select(TgUser).where(TgUser.tg_id == tg_id)
+        )).scalar()
+
+        if not user:
+            logger.info(f'Пользователь {username} ({first_name} {last_name}) не найден в БД')
+            user = TgUser(
+                tg_id=tg_id,
+                username=username,
+                first_name=first_name,
+                last_name=last_name
+            )
+            session.add(user)
+            try:
+                await session.commit()
+                logger.info(f'Создан пользователь: {user}')
+            except IntegrityError:
+                # Параллельный апдейт уже создал этого пользователя
+                await session.rollback()
+                user = (await session.execute(
+                    select(TgUser).where(TgUser.tg_id == tg_id)
+                )).scalar_one()
+        elif (user.username, user.first_name, user.last_name) != (username, first_name, last_name):
+            logger.info(f'Пользователь {user} сменил имя на {username} ({first_name} {last_name})')
+            user.username = username
+            user.first_name = first_name
+            user.last_name = last_name
+            await session.commit()
+
+    cached = CachedUser.from_row(user)
+    user_cache.put(cached)
+    return cached
+
+
+async def iter_messages_by_chat_and_range(
+	chat_id: int,
+	start: dt.datetime,
+	end: dt.datetime,
+	batch_size: int = 500
+) -> AsyncIterator[MessageRow]:
 	"""
-	Возвращает список сообщений из указанного чата в диапазоне времени [start, end).
+	Потоково отдаёт сообщения чата за [start, end) в виде MessageRow.
+	Один запрос: автор и текст сообщения, на которое дан ответ, приходят
+	в той же строке (без N+1), ORM-объекты не создаются, строки читаются
+	пачками по batch_size — память не растёт с длиной периода.
+	Реакции и итоги опросов подтягиваются одним запросом на пачку.
 	"""
-	messages = (
-		session.query(TgMessage)
-		.options(joinedload(TgMessage.messages_from_user))
-		.filter(
+	reply = aliased(TgMessage)
+	stmt = (
+		select(
+			TgMessage.id,
+			TgMessage.tg_message_id,
+			TgMessage.date,
+			TgMessage.text,
+			TgMessage.token_count,
+			TgUser.username,
+			TgUser.first_name,
+			TgUser.last_name,
+			reply.text,
+		)
+		.outerjoin(TgUser, TgUser.id == TgMessage.from_user)
+		.outerjoin(reply, reply.id == TgMessage.reply_to_message_id)
+		.where(
 			TgMessage.chat_id == chat_id,
 			TgMessage.date >= start,
 			TgMessage.date < end
 		)
 		.order_by(TgMessage.date)
-		.all()
 	)
-	return messages
+	# Старые месяцы могут быть вынесены в архив — они идут первыми
+	from bot.archive import iter_archived
+	async for row in iter_archived(chat_id, start, end):
+		yield row
+	async with ReadSession() as session:
+		result = await session.stream(stmt)
+		async for partition in result.partitions(batch_size):
+			# Та же сессия: второе соединение из пула читателей на каждую пачку не нужно
+			reactions = await get_reactions_text([row[0] for row in partition], session)
+			polls = await get_poll_results(
+				chat_id, [row[1] for row in partition if (row[3] or "").startswith(POLL_PREFIX)], session
+			)
+			for msg_id, tg_message_id, date, text, token_count, username, first_name, last_name, reply_text in partition:
+				yield MessageRow(
+					date, text, username, first_name, last_name, reply_text, token_count,
+					reactions.get(msg_id), polls.get(tg_message_id)
+				)
+
+
+def fts_query(query: str) -> str:
+    """
+    Запрос пользователя -> выражение FTS5: каждое слово ищется как префикс
+    (чтобы находились другие падежи и формы), все слова обязательны.
+    Спецсимволы FTS5 из запроса не попадают.
+    """
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", query))
 
 
-def get_last_messages(chat_id: int, limit: int = 10) -> list[TgMessage]:
+async def search_messages(
+    chat_id: int,
+    query: str,
+    start: Optional[dt.datetime] = None,
+    end: Optional[dt.datetime] = None,
+    limit: int = 10
+) -> list:
+    """
+    Полнотекстовый поиск по сообщениям чата (см. миграцию 5).
+    Возвращает до limit строк (date, username, first_name, last_name, snippet),
+    самые релевантные первыми.
+    """
+    params = {"chat_id": chat_id, "limit": limit}
+    period = ""
+    if start is not None:
+        period += " AND m.date >= :start"
+        params["start"] = start
+    if end is not None:
+        period += " AND m.date < :end"
+        params["end"] = end
+    if engine.dialect.name == 'sqlite':
+        params["q"] = fts_query(query)
+        if not params["q"]:
+            return []
+        sql = f"""
+            SELECT m.date, u.username, u.first_name, u.last_name,
+                   snippet(messages_fts, 0, '«', '»', '…', 16) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            LEFT JOIN users u ON u.id = m.from_user
+            WHERE messages_fts MATCH :q AND m.chat_id = :chat_id{period}
+            ORDER BY bm25(messages_fts)
+            LIMIT :limit
+        """
+    else:
+        params["q"] = query
+        # ts_headline дорогой — считаем его только для отобранных строк
+        sql = f"""
+            SELECT m.date, u.username, u.first_name, u.last_name,
+                   ts_headline('russian', m.text, hits.q,
+                               'StartSel=«, StopSel=», MaxWords=25, MinWords=10') AS snippet
+            FROM (
+                SELECT m.id, q, ts_rank(m.text_tsv, q) AS rank
+                FROM messages m, websearch_to_tsquery('russian', :q) q
+                WHERE m.text_tsv @@ q AND m.chat_id = :chat_id{period}
+                ORDER BY rank DESC
+                LIMIT :limit
+            ) hits
+            JOIN messages m ON m.id = hits.id
+            LEFT JOIN users u ON u.id = m.from_user
+            ORDER BY hits.rank DESC
+        """
+    async with ReadSession() as session:
+        hits = (await session.execute(text(sql).columns(date=DateTime), params)).all()
+    if len(hits) < limit and start is not None:
+        # Не хватило совпадений в БД — смотрим вынесенные в архив месяцы периода;
+        # без периода архив не читается: пришлось бы распаковать его целиком
+        from bot.archive import search_archived
+        hits += await search_archived(chat_id, query, start, end, limit - len(hits))
+    return hits
+
+
+async def get_last_messages(chat_id: int, limit: int = 10) -> list[TgMessage]:
     """
     Возвращает последние `limit` сообщений из указанного чата по дате (от старых к новым).
     """
-    messages = (
-        session.query(TgMessage)
-        .options(joinedload(TgMessage.messages_from_user))
-        .filter(TgMessage.chat_id == chat_id)
-        .order_by(desc(TgMessage.date))
-        .limit(limit)
-        .all()
-    )
+    async with ReadSession() as session:
+        result = await session.execute(
+            select(TgMessage)
+            .options(joinedload(TgMessage.messages_from_user))
+            .filter(TgMessage.chat_id == chat_id)
+            .order_by(desc(TgMessage.date))
+            .limit(limit)
+        )
+        messages = result.scalars().all()
     return list(reversed(messages))  # чтобы были в хронологическом порядке
 
 
@@ -210,7 +510,45 @@ def get_text_for_message(msg: Message) -> str:
     return f"{label} {caption}".strip()
 
 
-def save_summary_to_db(
+def rollup_bucket_start(date: dt.datetime) -> dt.datetime:
+    """Начало корзины конспектов, в которую попадает date (SUMMARY_ROLLUP_MINUTES должно делить сутки)."""
+    minutes = (date.hour * 60 + date.minute) // SUMMARY_ROLLUP_MINUTES * SUMMARY_ROLLUP_MINUTES
+    return date.replace(hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0)
+
+
+async def get_rollups(chat_id: int, start: dt.datetime, end: dt.datetime) -> list[TgSummaryRollup]:
+    """
+    Сохранённые конспекты чата, целиком лежащие в [start, end), по порядку.
+    С одного начала может быть несколько отрезков разной длины.
+    """
+    async with ReadSession() as session:
+        result = await session.execute(
+            select(TgSummaryRollup).where(
+                TgSummaryRollup.chat_id == chat_id,
+                TgSummaryRollup.bucket_start >= start,
+                TgSummaryRollup.bucket_end <= end
+            ).order_by(TgSummaryRollup.bucket_start, TgSummaryRollup.bucket_end)
+        )
+        return result.scalars().all()
+
+
+async def save_rollup(chat_id: int, bucket_start: dt.datetime, bucket_end: dt.datetime, text: str, message_count: int):
+    async with Session() as session:
+        try:
+            session.add(TgSummaryRollup(
+                chat_id=chat_id,
+                bucket_start=bucket_start,
+                bucket_end=bucket_end,
+                text=text,
+                message_count=message_count
+            ))
+            await session.commit()
+        except IntegrityError:
+            # Этот отрезок уже законспектировал параллельный /summary
+            await session.rollback()
+
+
+async def save_summary_to_db(
     chat_id: int,
     author: str,
     text: str,
@@ -226,91 +564,415 @@ def save_summary_to_db(
         range_end=end,
         style=style
     )
-    session.add(summary)
-    session.commit()
+    async with Session() as session:
+        session.add(summary)
+        await _increment(session, TgChatStats, {"chat_id": chat_id}, {"summaries": 1})
+        await session.commit()
 
 
-def get_last_summary(chat_id: int) -> TgSummary | None:
-    return session.query(TgSummary)\
-        .filter(TgSummary.chat_id == chat_id)\
-        .order_by(TgSummary.created_at.desc())\
-        .first()
+async def get_last_summary(chat_id: int) -> TgSummary | None:
+    async with ReadSession() as session:
+        return (await session.execute(
+            select(TgSummary)
+            .filter(TgSummary.chat_id == chat_id)
+            .order_by(TgSummary.created_at.desc())
+            .limit(1)
+        )).scalar()
 
 
-def get_statistic() -> str:
-    from sqlalchemy import func
-    logger.info('Делаем запросы статистики к бд...')
-    count_users = session.query(func.count(TgUser.id)).scalar()
-    count_messages = session.query(func.count(TgMessage.id)).scalar()
-    count_summaries = session.query(func.count(TgSummary.id)).scalar()
+HOUR_BARS = "▁▂▃▄▅▆▇█"
 
-    return (
-        f"📊 Статистика:\n"
-        f"👤 Пользователей: {count_users}\n"
-        f"💬 Сообщений: {count_messages}\n"
-        f"🧠 Саммари: {count_summaries}"
-    )
+
+async def get_statistic(chat_id: int, top: int = 5) -> str:
+    """
+    Статистика чата из предрасчитанных счётчиков (chat_stats, chat_user_stats,
+    chat_hour_stats) — стоимость не зависит от объёма истории.
+    """
+    async with ReadSession() as session:
+        chat = await session.get(TgChatStats, chat_id)
+        user_rows = (await session.execute(
+            select(TgChatUserStats.messages, TgChatUserStats.reactions_received, TgUser)
+            .join(TgUser, TgUser.id == TgChatUserStats.user_id)
+            .where(TgChatUserStats.chat_id == chat_id)
+        )).all()
+        hours = dict((await session.execute(
+            select(TgChatHourStats.hour, TgChatHourStats.messages)
+            .where(TgChatHourStats.chat_id == chat_id)
+        )).all())
+
+    if chat is None:
+        return "📊 В этом чате пока нет статистики."
+    lines = [
+        "📊 Статистика чата:",
+        f"👤 Участников: {sum(1 for messages, _, _ in user_rows if messages)}",
+        f"💬 Сообщений: {chat.messages}",
+        f"❤️ Реакций: {chat.reactions}",
+        f"🧠 Саммари: {chat.summaries}",
+    ]
+    active = sorted((r for r in user_rows if r[0]), key=lambda r: r[0], reverse=True)[:top]
+    if active:
+        lines.append("\n🏆 Самые активные:")
+        lines += [f"{get_display_name(user)} — {messages}" for messages, _, user in active]
+    liked = sorted((r for r in user_rows if r[1]), key=lambda r: r[1], reverse=True)[:top]
+    if liked:
+        lines.append("\n⭐ Больше всего реакций:")
+        lines += [f"{get_display_name(user)} — {received}" for _, received, user in liked]
+    if hours:
+        peak = max(hours.values())
+        bars = "".join(HOUR_BARS[hours.get(h, 0) * (len(HOUR_BARS) - 1) // peak] for h in range(24))
+        busiest = max(hours, key=hours.get)
+        lines.append(f"\n🕐 Активность по часам (0–23):\n{bars}\nПик: {busiest:02d}:00")
+    return "\n".join(lines)
 
 
-def write_poll_to_db(poll: Poll, chat_id: int):
-    data = poll.model_dump()
-    data["options"] = [opt.model_dump() for opt in poll.options]
+POLL_PREFIX = "Опрос:"
 
+
+async def write_poll_to_db(poll: Poll, chat_id: int, tg_message_id: Optional[int] = None) -> CachedPoll:
     poll_entry = TgPoll(
         poll_id=poll.id,
         question=poll.question,
-        options=json.dumps(data, ensure_ascii=False),  # читаемо
-        chat_id=chat_id
+        options=[opt.text for opt in poll.options],
+        chat_id=chat_id,
+        tg_message_id=tg_message_id
     )
-    session.add(poll_entry)
-    session.commit()
+    async with Session() as session:
+        session.add(poll_entry)
+        await session.commit()
+        cached = CachedPoll.from_row(poll_entry)
+    poll_cache.put(cached)
+    return cached
+
+
+async def get_poll(poll_id: str) -> Optional[CachedPoll]:
+    """Опрос по poll_id: из кэша, при промахе — из БД с разбором вариантов один раз."""
+    cached = poll_cache.get(poll_id)
+    if cached:
+        return cached
+    async with ReadSession() as session:
+        poll = (await session.execute(
+            select(TgPoll).filter_by(poll_id=poll_id).limit(1)
+        )).scalar()
+    if poll is None:
+        return None
+    cached = CachedPoll.from_row(poll)
+    poll_cache.put(cached)
+    return cached
+
+
+async def write_poll_votes_batch(records: list):
+    """
+    Пакетная запись голосов (см. bot.ingest.PollVoteRecord). Голос пользователя
+    целиком заменяет предыдущий, пустой список вариантов — отзыв голоса;
+    из нескольких голосов одного пользователя в пакете действует последний.
+    """
+    if records:
+        await _write_batch("голоса в опросах", records, _write_poll_votes)
+
+
+async def _write_poll_votes(records: list):
+    latest = {}
+    for r in records:
+        latest[(r.poll_id, r.user_id)] = r
+    async with Session() as session:
+        await session.execute(delete(TgPollVote).where(or_(*(
+            and_(TgPollVote.poll_id == poll_id, TgPollVote.user_id == user_id)
+            for poll_id, user_id in latest
+        ))))
+        session.add_all(
+            TgPollVote(poll_id=r.poll_id, user_id=r.user_id, option_index=index)
+            for r in latest.values()
+            for index in set(r.option_ids)
+        )
+        # Итоги выводятся в истории под опросом — конспекты их корзин устарели
+        wanted = {(r.chat_id, r.tg_message_id) for r in records if r.chat_id is not None and r.tg_message_id is not None}
+        if wanted:
+            rows = await session.execute(
+                select(TgMessage.chat_id, TgMessage.date).where(or_(*(
+                    and_(TgMessage.chat_id == chat_id, TgMessage.tg_message_id == tg_message_id)
+                    for chat_id, tg_message_id in wanted
+                )))
+            )
+            await _invalidate_rollups(session, set(rows.all()))
+        await session.commit()
+
+
+async def get_poll_results(chat_id: int, tg_message_ids: list[int], session=None) -> dict[int, str]:
+    """Текущие итоги опросов чата по tg_message_id исходных сообщений: 'Да — 3, Нет — 1'."""
+    if not tg_message_ids:
+        return {}
+    if session is None:
+        async with ReadSession() as own_session:
+            return await get_poll_results(chat_id, tg_message_ids, own_session)
+    polls = (await session.execute(
+        select(TgPoll.id, TgPoll.tg_message_id, TgPoll.options)
+        .where(TgPoll.chat_id == chat_id, TgPoll.tg_message_id.in_(tg_message_ids))
+    )).all()
+    if not polls:
+        return {}
+    votes = (await session.execute(
+        select(TgPollVote.poll_id, TgPollVote.option_index, func.count())
+        .where(TgPollVote.poll_id.in_([poll_id for poll_id, _, _ in polls]))
+        .group_by(TgPollVote.poll_id, TgPollVote.option_index)
+    )).all()
+    counts = {(poll_id, option_index): count for poll_id, option_index, count in votes}
+    return {
+        tg_message_id: ", ".join(
+            f"{text} — {counts.get((poll_id, index), 0)}" for index, text in enumerate(options or [])
+        )
+        for poll_id, tg_message_id, options in polls
+    }
 
 
-def get_poll_from_db(poll_id: str) -> TgPoll | None:
-    return session.query(TgPoll).filter_by(poll_id=poll_id).first()
+def get_display_name(user: TgUser | CachedUser) -> str:
+    return user.first_name or user.username or "пользователя"
 
 
-def get_display_name(user: TgUser) -> str:
-    return user.first_name or user.username or "пользователя"
+def format_reactions(counts: dict[str, int]) -> str:
+    """{'👍': 3, '🔥': 1} -> '👍×3 🔥' (самые частые первыми)."""
+    return " ".join(
+        emoji if count == 1 else f"{emoji}×{count}"
+        for emoji, count in sorted(counts.items(), key=lambda item: -item[1])
+    )
 
 
-def get_user_by_tg_id(tg_id: int) -> Optional[TgUser]:
-    return session.query(TgUser).filter(TgUser.tg_id == tg_id).one_or_none()
+async def get_reactions_text(message_ids: list[int], session=None) -> dict[int, str]:
+    """Свёрнутые реакции для списка сообщений: message_id -> '👍×3 🔥'."""
+    if not message_ids:
+        return {}
+    stmt = (
+        select(TgMessageReaction.message_id, TgMessageReaction.emoji, TgMessageReaction.count)
+        .where(TgMessageReaction.message_id.in_(message_ids), TgMessageReaction.count > 0)
+    )
+    if session is None:
+        async with ReadSession() as own_session:
+            rows = (await own_session.execute(stmt)).all()
+    else:
+        rows = (await session.execute(stmt)).all()
+    counts: dict[int, dict[str, int]] = {}
+    for message_id, emoji, count in rows:
+        counts.setdefault(message_id, {})[emoji] = count
+    return {message_id: format_reactions(c) for message_id, c in counts.items()}
+
+
+async def _increment(session, model, keys: dict, counts: dict):
+    """INSERT ... ON CONFLICT DO UPDATE: прибавляет counts к строке с ключом keys."""
+    if engine.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    table = model.__table__
+    stmt = insert(table).values(**keys, **counts)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: table.c[name] + stmt.excluded[name] for name in counts}
+    )
+    await session.execute(stmt)
 
 
-def build_history_text(messages: list[TgMessage]) -> str:
-    lines = []
-    for m in messages:
-        user = m.messages_from_user
-        dt_str = m.date.strftime("%d-%m-%Y %H:%M")
-        username = user.username or "no_username"
-        full_name = f"{user.last_name or ''} {user.first_name or ''}".strip()
-        line = f"{dt_str} {username} {full_name}:\n"
+async def _update_message_stats(session, records: list):
+    """
+    Счётчики для /statistic по пакету записей. Считаем в памяти и делаем
+    по одному upsert на чат, участника и час, а не на каждое сообщение.
+    """
+    chats, users, hours = {}, {}, {}
+    for r in records:
+        chats[r.chat_id] = chats.get(r.chat_id, 0) + 1
+        users[(r.chat_id, r.from_user_id)] = users.get((r.chat_id, r.from_user_id), 0) + 1
+        hours[(r.chat_id, r.date.hour)] = hours.get((r.chat_id, r.date.hour), 0) + 1
+    for chat_id, count in chats.items():
+        await _increment(session, TgChatStats, {"chat_id": chat_id}, {"messages": count})
+    for (chat_id, user_id), count in users.items():
+        await _increment(session, TgChatUserStats, {"chat_id": chat_id, "user_id": user_id}, {"messages": count})
+    for (chat_id, hour), count in hours.items():
+        await _increment(session, TgChatHourStats, {"chat_id": chat_id, "hour": hour}, {"messages": count})
+
+
+async def _invalidate_rollups(session, keys: set):
+    """
+    Удаляет конспекты отрезков из закрытых корзин, в которых что-то поменялось.
+    keys: {(chat_id, date)}; отрезок может покрывать несколько корзин.
+    """
+    now = dt.datetime.now()
+    stale = {
+        (chat_id, date) for chat_id, date in keys
+        if rollup_bucket_start(date) + dt.timedelta(minutes=SUMMARY_ROLLUP_MINUTES) <= now
+    }
+    if stale:
+        await session.execute(
+            delete(TgSummaryRollup).where(or_(*(
+                and_(
+                    TgSummaryRollup.chat_id == chat_id,
+                    TgSummaryRollup.bucket_start <= date,
+                    TgSummaryRollup.bucket_end > date
+                )
+                for chat_id, date in stale
+            )))
+        )
 
-        # Проверим, является ли сообщение ответом
-        if m.reply_to_message:
-            try:
-                original_text = m.reply_to_message.text.strip()
-                short_original = (original_text[:300] + "...") if len(original_text) > 300 else original_text
-                line += f"*это ответ на это сообщение:* '{short_original}':\n"
-            except DetachedInstanceError:
-                line += "*это ответ на сообщение, которое не удалось загрузить*\n"
-
-        line += f"{m.text.strip()}\n"
-        lines.append(line)
-    return "\n".join(lines)
+
+# Повторы пакетной записи при временных ошибках БД (SQLite: database is locked)
+WRITE_RETRIES = 4
+WRITE_RETRY_DELAY = 0.2
+
+
+async def _with_retries(write, records: list):
+    for attempt in range(WRITE_RETRIES):
+        try:
+            return await write(records)
+        except OperationalError as e:
+            if attempt == WRITE_RETRIES - 1:
+                raise
+            delay = WRITE_RETRY_DELAY * 2 ** attempt
+            logger.warning(f"[DB] Временная ошибка записи ({e.orig}), повтор через {delay:.1f}s")
+            await asyncio.sleep(delay)
 
 
-def get_msg_by_tg_msg_id(chat_id: int, tg_message_id: int) -> Optional[TgMessage]:
+async def _write_batch(kind: str, records: list, write) -> list:
     """
-    Возвращает сообщение из базы данных по chat_id и Telegram message_id.
+    Пишет пакет одной транзакцией write(records), временные ошибки повторяет.
+    Если пакет так и не записался, записи пишутся по одной: одна плохая
+    строка не теряет остальные. Возвращает объединённый результат write.
     """
     try:
-        return (
-            session.query(TgMessage)
-            .filter_by(chat_id=chat_id, tg_message_id=tg_message_id)
-            .first()
-        )
+        return await _with_retries(write, records) or []
     except Exception as e:
-        logger.exception(f"[DB] Ошибка при поиске сообщения по tg_message_id={tg_message_id}: {e}")
-        return None
\ No newline at end of file
+        if len(records) == 1:
+            logger.exception(f"[DB] Не записаны {kind}: {records[0]}: {e}")
+            return []
+        logger.warning(f"[DB] Пакет ({kind}, {len(records)} шт.) не записан: {e}; пишем по одной")
+    written = []
+    for index, record in enumerate(records):
+        try:
+            written += await _with_retries(write, [record]) or []
+        except OperationalError as e:
+            logger.exception(f"[DB] БД недоступна, не записаны {kind}: {len(records) - index} шт.: {e}")
+            break
+        except Exception as e:
+            logger.exception(f"[DB] Не записаны {kind}: {record}: {e}")
+    return written
+
+
+async def write_messages_batch(records: list) -> list[TgMessage]:
+    """
+    Пакетная запись сообщений (см. bot.ingest.MessageRecord) одной транзакцией.
+    Ответы резолвятся одним запросом на весь пакет; если исходное сообщение
+    лежит в этом же пакете, связь проставляется через relationship.
+    """
+    if not records:
+        return []
+    return await _write_batch("сообщения", records, _write_messages)
+
+
+async def _write_messages(records: list) -> list[TgMessage]:
+    async with Session() as session:
+        wanted = {}
+        for r in records:
+            if r.reply_to_tg_msg_id:
+                wanted.setdefault(r.chat_id, set()).add(r.reply_to_tg_msg_id)
+
+        found = {}
+        if wanted:
+            rows = await session.execute(
+                select(TgMessage.id, TgMessage.chat_id, TgMessage.tg_message_id)
+                .where(or_(*(
+                    and_(TgMessage.chat_id == chat_id, TgMessage.tg_message_id.in_(ids))
+                    for chat_id, ids in wanted.items()
+                )))
+                .order_by(TgMessage.id)
+            )
+            for msg_id, chat_id, tg_message_id in rows:
+                found.setdefault((chat_id, tg_message_id), msg_id)
+
+        in_batch = {}
+        messages = []
+        for r in records:
+            message = TgMessage(
+                from_user=r.from_user_id,
+                chat_id=r.chat_id,
+                text=r.text,
+                date=r.date,
+                tg_message_id=r.tg_message_id,
+                token_count=r.token_count,
+            )
+            if r.reply_to_tg_msg_id:
+                key = (r.chat_id, r.reply_to_tg_msg_id)
+                if key in found:
+                    message.reply_to_message_id = found[key]
+                elif key in in_batch:
+                    message.reply_to_message = in_batch[key]
+            if r.tg_message_id:
+                in_batch.setdefault((r.chat_id, r.tg_message_id), message)
+            messages.append(message)
+
+        session.add_all(messages)
+        await _update_message_stats(session, records)
+        # Сообщения в уже закрытых корзинах делают их конспекты устаревшими
+        await _invalidate_rollups(session, {(r.chat_id, r.date) for r in records})
+
+        await session.commit()
+        return messages
+
+
+async def write_reactions_batch(records: list):
+    """
+    Пакетное применение изменений реакций (см. bot.ingest.ReactionRecord).
+    Сообщения ищутся одним запросом; счётчики по эмодзи меняются upsert'ом
+    на разницу old_reaction/new_reaction, нулевые строки удаляются.
+    Вызывается после write_messages_batch, поэтому реакции на только что
+    записанные сообщения тоже находятся.
+    """
+    if records:
+        await _write_batch("изменения реакций", records, _write_reactions)
+
+
+async def _write_reactions(records: list):
+    wanted = {}
+    for r in records:
+        wanted.setdefault(r.chat_id, set()).add(r.tg_message_id)
+    async with Session() as session:
+        rows = await session.execute(
+            select(TgMessage.id, TgMessage.chat_id, TgMessage.tg_message_id, TgMessage.from_user, TgMessage.date)
+            .where(or_(*(
+                and_(TgMessage.chat_id == chat_id, TgMessage.tg_message_id.in_(ids))
+                for chat_id, ids in wanted.items()
+            )))
+            .order_by(TgMessage.id)
+        )
+        found = {}
+        for msg_id, chat_id, tg_message_id, author, date in rows:
+            found.setdefault((chat_id, tg_message_id), (msg_id, author, date))
+
+        deltas: dict[tuple[int, str], int] = {}
+        chats, authors, touched = {}, {}, set()
+        for r in records:
+            original = found.get((r.chat_id, r.tg_message_id))
+            if original is None:
+                logger.warning(f"Оригинальное сообщение {r.tg_message_id} для реакции не найдено в БД.")
+                continue
+            msg_id, author, date = original
+            changes = [(emoji, 1) for emoji in r.added] + [(emoji, -1) for emoji in r.removed]
+            for emoji, delta in changes:
+                deltas[(msg_id, emoji)] = deltas.get((msg_id, emoji), 0) + delta
+                chats[r.chat_id] = chats.get(r.chat_id, 0) + delta
+                if author is not None:
+                    authors[(r.chat_id, author)] = authors.get((r.chat_id, author), 0) + delta
+            touched.add((r.chat_id, date))
+
+        for (msg_id, emoji), delta in deltas.items():
+            if delta:
+                await _increment(session, TgMessageReaction, {"message_id": msg_id, "emoji": emoji}, {"count": delta})
+        if deltas:
+            await session.execute(delete(TgMessageReaction).where(
+                TgMessageReaction.message_id.in_({msg_id for msg_id, _ in deltas}),
+                TgMessageReaction.count <= 0
+            ))
+        for chat_id, delta in chats.items():
+            if delta:
+                await _increment(session, TgChatStats, {"chat_id": chat_id}, {"reactions": delta})
+        for (chat_id, user_id), delta in authors.items():
+            if delta:
+                await _increment(session, TgChatUserStats, {"chat_id": chat_id, "user_id": user_id}, {"reactions_received": delta})
+        # Реакции меняют текст истории — конспекты закрытых корзин устаревают
+        await _invalidate_rollups(session, touched)
+        await session.commit()
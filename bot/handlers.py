@@ -1,31 +1,38 @@
 import logging
-from aiogram import Router, F
+from aiogram import Bot, Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, PollAnswer, MessageReactionUpdated
 from aiogram.exceptions import TelegramBadRequest
-from bot.config import HELP_TEXT, GENNADY_PERSONA
-from bot.dbmap import get_user, write_msg_to_db, get_display_name, get_user_by_tg_id, get_msg_by_tg_msg_id, get_statistic, get_last_messages, get_messages_by_chat_and_range, get_last_summary, write_poll_to_db, get_poll_from_db
-from bot.ai import get_summary_llm, get_character_reply
-from bot.utils import parse_datetime_args, build_history_text, maybe_bot_reply, get_text_for_message
+from bot.config import HELP_TEXT, GENNADY_PERSONA, LLM_STREAMING, RECENT_MESSAGES_DEPTH
+from bot.cache import CachedUser
+from bot.dbmap import POLL_PREFIX, get_user, get_display_name, get_statistic, get_last_summary, write_poll_to_db, get_poll, search_messages
+from bot.ingest import enqueue_message, enqueue_reaction, enqueue_poll_vote
+from bot.recent import recent_messages
+from bot.context import reply_context
+from bot.ai import get_character_reply
+from bot.summarizer import summarize_range
+from bot.streaming import StreamingMessage
+from bot.llm_scheduler import SchedulerBusy
+from bot.utils import parse_datetime_args, parse_search_args, build_history_text, maybe_bot_reply, get_text_for_message
 
 router = Router(name=__name__)
 logger = logging.getLogger(__name__)
 
+BUSY_TEXT = "Сейчас слишком много запросов к нейросети, попробуйте через пару минут."
+
 # --- HANDLERS ---
 
 @router.message(Command('start'))
-async def process_start_command(message: Message):
-    from bot.bot import bot
+async def process_start_command(message: Message, bot: Bot):
     await bot.send_message(message.from_user.id, 'Здравствуйте.\n' + HELP_TEXT)
 
 @router.message(Command('help'))
-async def process_help_command(message: Message):
-    from bot.bot import bot
+async def process_help_command(message: Message, bot: Bot):
     await bot.send_message(message.from_user.id, HELP_TEXT)
 
 @router.message(Command("statistic"))
 async def cmd_statistic(msg: Message):
-    stat_text = get_statistic()
+    stat_text = await get_statistic(msg.chat.id)
     await msg.reply(stat_text)
 
 @router.message(Command("summary"))
@@ -37,21 +44,46 @@ async def summary_command(msg: Message):
         return
     start, end = parsed
     chat_id = msg.chat.id
-    messages = get_messages_by_chat_and_range(chat_id, start, end)
-    if not messages:
+    placeholder = await msg.answer("Создаю саммари, подождите...")
+    style = "напиши с юмором, подкалывая некоторых участников чата. Не бойся быть дерзким, чтобы было еще смешнее"
+    try:
+        if LLM_STREAMING:
+            async with StreamingMessage(placeholder) as stream:
+                summary = await summarize_range(chat_id, start, end, style, on_delta=stream.push)
+                await stream.finish(summary or "В указанный период сообщений не найдено.")
+            return
+        summary = await summarize_range(chat_id, start, end, style)
+    except SchedulerBusy:
+        # Правки не ждут лимитов чата: finish повторит её после паузы
+        await StreamingMessage(placeholder).finish(BUSY_TEXT)
+        return
+    if summary is None:
         await msg.answer("В указанный период сообщений не найдено.")
         return
-    history_text = build_history_text(messages)
-    await msg.answer("Создаю саммари, подождите...")
-    style = "напиши с юмором, подкалывая некоторых участников чата. Не бойся быть дерзким, чтобы было еще смешнее"
-    summary = await get_summary_llm(history_text, style)
     for i in range(0, len(summary), 4000):
         await msg.answer(summary[i:i+4000])
 
+@router.message(Command("search"))
+async def search_command(msg: Message):
+    query, start, end = parse_search_args(msg.text.strip().split()[1:])
+    if not query:
+        await msg.answer("Укажите, что искать.\nПример: /search отпуск 7d")
+        return
+    hits = await search_messages(msg.chat.id, query, start, end)
+    if not hits:
+        await msg.answer("Ничего не найдено.")
+        return
+    lines = []
+    for hit in hits:
+        author = hit.username or f"{hit.first_name or ''} {hit.last_name or ''}".strip() or "кто-то"
+        snippet = " ".join(hit.snippet.split())
+        lines.append(f"{hit.date.strftime('%d.%m.%Y %H:%M')} {author}: {snippet}")
+    await msg.answer("\n\n".join(lines)[:4000])
+
 @router.message(Command("lastsummary"))
 async def last_summary_command(msg: Message):
     chat_id = msg.chat.id
-    summary = get_last_summary(chat_id)
+    summary = await get_last_summary(chat_id)
     if not summary:
         await msg.answer("Саммари в этом чате ещё не создавались.")
         return
@@ -67,8 +99,7 @@ async def last_summary_command(msg: Message):
         await msg.answer(summary.text[i:i+4000])
 
 @router.message(F.poll)
-async def handle_poll_message(msg: Message):
-    from bot.bot import bot
+async def handle_poll_message(msg: Message, bot: Bot):
     poll = msg.poll
     chat_id = msg.chat.id
     question = poll.question
@@ -76,16 +107,16 @@ async def handle_poll_message(msg: Message):
     is_anonymous = poll.is_anonymous
     allows_multiple_answers = poll.allows_multiple_answers
     user = msg.from_user
-    db_user = get_user(user)
+    db_user = await get_user(user)
     prefix = f"Опрос от {get_display_name(db_user)}"
     try:
         await bot.delete_message(chat_id=chat_id, message_id=msg.message_id)
     except TelegramBadRequest:
         pass
-    poll_text = f"Опрос: {question}\nВарианты:\n"
+    poll_text = f"{POLL_PREFIX} {question}\nВарианты:\n"
     for opt in poll.options:
         poll_text += f"- {opt.text}\n"
-    write_msg_to_db(
+    enqueue_message(
         text=poll_text.strip(),
         from_user=db_user,
         chat_id=chat_id,
@@ -98,70 +129,49 @@ async def handle_poll_message(msg: Message):
         is_anonymous=is_anonymous,
         allows_multiple_answers=allows_multiple_answers
     )
-    write_poll_to_db(new_poll.poll, chat_id=chat_id)
+    await write_poll_to_db(new_poll.poll, chat_id=chat_id, tg_message_id=msg.message_id)
 
 @router.poll_answer()
 async def handle_poll_answer(poll_answer: PollAnswer):
     logger.info("Получен ответ на опрос")
-    user = get_user_by_tg_id(poll_answer.user.id)
-    poll = get_poll_from_db(poll_id=poll_answer.poll_id)
-    if not user:
-        logger.warning(f"Пользователь не найден в БД: {poll_answer.user}")
+    if not poll_answer.user:
+        logger.warning(f"Ответ на опрос {poll_answer.poll_id} без пользователя, пропускаем")
         return
+    poll = await get_poll(poll_answer.poll_id)
     if not poll:
         logger.warning(f"Опрос с poll_id={poll_answer.poll_id} не найден в БД")
         return
     try:
-        selected_options = poll_answer.option_ids
-        import json
-        poll_data = json.loads(poll.options)
-        question = poll_data.get("question", "<вопрос не найден>")
-        options = poll_data.get("options", [])
-        for option_index in selected_options:
-            try:
-                option_text = options[option_index]["text"]
-            except IndexError:
-                option_text = "<неизвестный вариант>"
-            full_text = (
-                f"Опрос: {question}\n"
-                f"Варианты: \n{chr(10).join('- ' + opt['text'] for opt in options)}\n"
-                f"{user} проголосовал за: '{option_text}'"
-            )
-            write_msg_to_db(
-                text=full_text,
-                from_user=user,
-                chat_id=poll.chat_id or 0,
-            )
-            logger.info(f"{user} проголосовал за '{option_text}'")
+        # Один голос пользователя заменяет предыдущий; история покажет итог опроса, а не каждый голос
+        user = await get_user(poll_answer.user)
+        enqueue_poll_vote(poll=poll, user_id=user.id, option_ids=poll_answer.option_ids)
+        if poll_answer.option_ids:
+            chosen = ", ".join(f"'{poll.option_text(i)}'" for i in poll_answer.option_ids)
+            logger.info(f"{user} проголосовал за {chosen}")
+        else:
+            logger.info(f"{user} отозвал голос в опросе '{poll.question}'")
     except Exception as e:
         logger.exception(f"Ошибка при обработке ответа на опрос: {e}")
 
 @router.message_reaction()
 async def handle_reaction(event: MessageReactionUpdated):
-    chat_id = event.chat.id
-    reacting_user = get_user(event.user)
-    tg_message_id = event.message_id
-    original_msg = get_msg_by_tg_msg_id(chat_id, tg_message_id)
-    if not original_msg:
-        logger.warning(f"Оригинальное сообщение {tg_message_id} не найдено в БД.")
+    # Храним не сообщение на каждую реакцию, а счётчики по эмодзи: пишем разницу old/new
+    old = [r.emoji for r in event.old_reaction if hasattr(r, 'emoji')]
+    new = [r.emoji for r in event.new_reaction if hasattr(r, 'emoji')]
+    added = [emoji for emoji in new if emoji not in old]
+    removed = [emoji for emoji in old if emoji not in new]
+    if not added and not removed:
+        logger.debug(f"Реакция на {event.message_id} не содержит эмодзи.")
         return
-    reactions = [
-        r.emoji for r in event.new_reaction if hasattr(r, 'emoji')
-    ]
-    if not reactions:
-        logger.warning(f"Реакция {tg_message_id} не содержит текста.")
-        return 
-    text = f"Реакция: {''.join(reactions)}"
-    write_msg_to_db(
-        text=text,
-        from_user=reacting_user,
-        chat_id=chat_id,
-        reply_to_tg_msg_id=tg_message_id
+    enqueue_reaction(
+        chat_id=event.chat.id,
+        tg_message_id=event.message_id,
+        added=added,
+        removed=removed,
     )
 
 @router.message(F.entities, ~F.text.startswith("/"))
-async def handle_bot_mention(msg: Message):
-    from bot.bot import bot_username
+async def handle_bot_mention(msg: Message, bot_username: str, self_user: CachedUser):
     if not msg.entities or not msg.text:
         return
     if not any(
@@ -169,59 +179,68 @@ async def handle_bot_mention(msg: Message):
         for ent in msg.entities
     ):
         return
+    # Сам вопрос — сообщение чата: без него ответ Геннадия в истории висит без контекста
+    user = await get_user(msg.from_user)
+    enqueue_message(
+        text=msg.text,
+        from_user=user,
+        chat_id=msg.chat.id,
+        tg_message_id=msg.message_id,
+        reply_to_tg_msg_id=msg.reply_to_message.message_id if msg.reply_to_message else None
+    )
     text_clean = msg.text.replace(f"@{bot_username}", "").strip()
     if not text_clean:
         await msg.reply("Ну и чего ты хотел, тегнул и молчишь?")
         return
     try:
         thinking_msg = await msg.reply("Дай подумать...")
-        messages = get_last_messages(chat_id=msg.chat.id, limit=10)
-        history_lines = []
-        for m in messages:
-            user = m.messages_from_user
-            if user is None:
-                continue
-            dt_str = m.date.strftime("%d-%m-%Y %H:%M")
-            username = user.username or "no_username"
-            full_name = f"{user.last_name or ''} {user.first_name or ''}".strip()
-            history_lines.append(f"{dt_str} {username} {full_name}:\n{m.text.strip()}\n")
-        history_text = "\n".join(history_lines)
-        reply_text = await get_character_reply(f'{text_clean}\nКонтекст:\n{history_text}', persona=GENNADY_PERSONA)
-        await thinking_msg.delete()
-        response_msg = await msg.reply(reply_text)
-        write_msg_to_db(
+        messages = await recent_messages.get(msg.chat.id, limit=RECENT_MESSAGES_DEPTH)
+        history_text = build_history_text(reply_context(messages))
+        prompt = f'{text_clean}\nКонтекст:\n{history_text}'
+        if LLM_STREAMING:
+            async with StreamingMessage(thinking_msg) as stream:
+                reply_text = await get_character_reply(prompt, persona=GENNADY_PERSONA, on_delta=stream.push)
+                await stream.finish(reply_text)
+            response_msg = stream.last_message
+        else:
+            reply_text = await get_character_reply(prompt, persona=GENNADY_PERSONA)
+            await thinking_msg.delete()
+            response_msg = await msg.reply(reply_text)
+        enqueue_message(
             text=reply_text,
-            from_user=user,
+            from_user=self_user,
             chat_id=msg.chat.id,
-            tg_message_id=msg.message_id,
-            reply_to_tg_msg_id=msg.reply_to_message.message_id if msg.reply_to_message else None
+            tg_message_id=response_msg.message_id,
+            reply_to_tg_msg_id=msg.message_id
         )
+    except SchedulerBusy:
+        await StreamingMessage(thinking_msg).finish("Слишком много желающих пообщаться, дай передохнуть минутку.")
     except Exception as e:
         await msg.reply("Геннадий временно молчит. Скажите, чтобы @iromess проверил.")
-        logger.error("handle_bot_mention error:")
+        logger.exception(f"Ошибка ответа на упоминание: {e}")
 
 @router.message(~F.text.startswith("/"))
 async def handle_all_messages(msg: Message):
-    user = get_user(msg.from_user)
+    user = await get_user(msg.from_user)
     text = get_text_for_message(msg)
     if not text:
         return
-    write_msg_to_db(
+    enqueue_message(
         text=text,
         from_user=user,
         chat_id=msg.chat.id,
         tg_message_id=msg.message_id,
         reply_to_tg_msg_id=msg.reply_to_message.message_id if msg.reply_to_message else None
     )
-    # await maybe_bot_reply(msg, probability=0.05, recent_limit=15)
+    # await maybe_bot_reply(msg, bot, bot_username, probability=0.05, recent_limit=15)
 
 @router.message()
 async def catch_all(msg: Message):
-    user = get_user(msg.from_user)
+    user = await get_user(msg.from_user)
     text = get_text_for_message(msg)
     if not text:
         return
-    write_msg_to_db(
+    enqueue_message(
         text=text,
         from_user=user,
         chat_id=msg.chat.id,
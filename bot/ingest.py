@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+import datetime as dt
+from dataclasses import dataclass, field
+from typing import Optional
+from bot.config import INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_MS
+from bot.dbmap import write_messages_batch, write_reactions_batch, write_poll_votes_batch, MessageRow
+from bot.recent import recent_messages
+from bot.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MessageRecord:
+    """Сообщение, ожидающее записи в БД."""
+    from_user_id: int
+    chat_id: int
+    text: str
+    tg_message_id: Optional[int] = None
+    reply_to_tg_msg_id: Optional[int] = None
+    token_count: Optional[int] = None
+    date: dt.datetime = field(default_factory=dt.datetime.now)
+
+
+@dataclass
+class ReactionRecord:
+    """Изменение реакций одного пользователя на сообщение: что поставил и что снял."""
+    chat_id: int
+    tg_message_id: int
+    added: list[str]
+    removed: list[str]
+
+
+@dataclass
+class PollVoteRecord:
+    """Голос пользователя в опросе; пустой option_ids — отзыв голоса."""
+    poll_id: int
+    chat_id: Optional[int]
+    tg_message_id: Optional[int]
+    user_id: int
+    option_ids: list[int]
+
+
+class IngestQueue:
+    """
+    Буфер отложенной записи сообщений.
+
+    Хендлеры кладут записи через put() без ожидания БД, фоновая задача
+    сбрасывает их пакетами: как только набралось batch_size записей
+    или прошло flush_interval секунд с последнего сброса. Изменения
+    реакций и голоса в опросах копятся рядом и пишутся после сообщений
+    того же сброса.
+    """
+
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE, flush_interval: float = INGEST_FLUSH_INTERVAL_MS / 1000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: list[MessageRecord] = []
+        self._reactions: list[ReactionRecord] = []
+        self._votes: list[PollVoteRecord] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Статистика для подбора размеров буфера
+        self.flushed_total = 0
+        self.batches_total = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._buffer) + len(self._reactions) + len(self._votes)
+
+    def put(self, record: MessageRecord):
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def put_reaction(self, record: ReactionRecord):
+        self._reactions.append(record)
+        if len(self._reactions) >= self.batch_size:
+            self._wakeup.set()
+
+    def put_vote(self, record: PollVoteRecord):
+        self._votes.append(record)
+        if len(self._votes) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Записывает в БД всё, что накопилось в буфере."""
+        async with self._lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                started = time.perf_counter()
+                await write_messages_batch(batch)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.flushed_total += len(batch)
+                self.batches_total += 1
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                logger.debug(
+                    f"[ingest] Записано {len(batch)} сообщений за {elapsed_ms:.1f} мс, "
+                    f"в очереди: {self.depth}"
+                )
+            # Реакции — после сообщений, чтобы находились только что записанные оригиналы
+            while self._reactions:
+                batch = self._reactions[:self.batch_size]
+                del self._reactions[:self.batch_size]
+                await write_reactions_batch(batch)
+            while self._votes:
+                batch = self._votes[:self.batch_size]
+                del self._votes[:self.batch_size]
+                await write_poll_votes_batch(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"[ingest] Ошибка при сбросе буфера: {e}")
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(
+                f"[ingest] Буфер записи запущен: batch_size={self.batch_size}, "
+                f"flush_interval={self.flush_interval}s"
+            )
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает остаток буфера."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        logger.info(f"[ingest] Буфер записи остановлен, всего записано: {self.flushed_total}")
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "flushed_total": self.flushed_total,
+            "batches_total": self.batches_total,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "max_flush_ms": round(self.max_flush_ms, 1),
+        }
+
+
+ingest_queue = IngestQueue()
+
+
+def enqueue_message(
+    *,
+    text: str,
+    from_user,
+    chat_id: int,
+    tg_message_id: Optional[int] = None,
+    reply_to_tg_msg_id: Optional[int] = None
+):
+    """
+    Ставит сообщение в буфер отложенной записи (см. write_messages_batch).
+    Заодно пополняет кольцевой буфер последних сообщений чата.
+    """
+    record = MessageRecord(
+        from_user_id=from_user.id,
+        chat_id=chat_id,
+        text=text,
+        tg_message_id=tg_message_id,
+        reply_to_tg_msg_id=reply_to_tg_msg_id,
+        token_count=count_tokens(text),
+    )
+    ingest_queue.put(record)
+    recent_messages.append(chat_id, MessageRow(
+        date=record.date,
+        text=text,
+        username=from_user.username,
+        first_name=from_user.first_name,
+        last_name=from_user.last_name,
+        token_count=record.token_count,
+    ))
+
+
+def enqueue_reaction(*, chat_id: int, tg_message_id: int, added: list[str], removed: list[str]):
+    """Кладёт в буфер изменение реакций (разницу old_reaction/new_reaction)."""
+    if added or removed:
+        ingest_queue.put_reaction(ReactionRecord(chat_id, tg_message_id, added, removed))
+
+
+def enqueue_poll_vote(*, poll, user_id: int, option_ids: list[int]):
+    """Кладёт в буфер голос в опросе (poll — bot.cache.CachedPoll)."""
+    ingest_queue.put_vote(PollVoteRecord(poll.id, poll.chat_id, poll.tg_message_id, user_id, list(option_ids)))
@@ -0,0 +1,114 @@
+"""
+Локальный кэш ответов LLM, адресуемый содержимым запроса.
+
+Ключ — sha256 от модели, всех сообщений (системный промпт со стилем
+и сама история) и параметров генерации, поэтому повторный /summary
+по тому же закрытому периоду отдаётся из кэша без запроса к OpenAI.
+Хранится в отдельном SQLite-файле, не зависит от основной БД.
+Записи живут LLM_CACHE_TTL_HOURS часов; сверх LLM_CACHE_MAX_ENTRIES
+вытесняются давно не использованные.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+from bot.config import LLM_CACHE_PATH, LLM_CACHE_TTL_HOURS, LLM_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+# Как часто (в записях) чистить просроченное и лишнее
+CLEANUP_EVERY = 100
+
+
+def cache_key(model: str, messages: list[dict], temperature: float, max_tokens: int) -> str:
+    payload = json.dumps([model, messages, temperature, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_hours: float = LLM_CACHE_TTL_HOURS, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, "
+                "created_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed ON llm_cache (accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            response, created_at = row
+            now = time.time()
+            if now - created_at > self.ttl:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return response
+
+    def _put(self, key: str, model: str, response: str):
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now)
+            )
+            self._puts += 1
+            if self._puts % CLEANUP_EVERY == 0:
+                conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN ("
+                    "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            conn.commit()
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            response = await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as e:
+            logger.warning(f"[llm_cache] Не удалось прочитать кэш: {e}")
+            return None
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    async def put(self, key: str, model: str, response: str):
+        try:
+            await asyncio.to_thread(self._put, key, model, response)
+        except sqlite3.Error as e:
+            logger.warning(f"[llm_cache] Не удалось записать в кэш: {e}")
+
+
+llm_cache = LLMCache()
@@ -0,0 +1,159 @@
+"""
+Центральный планировщик запросов к LLM.
+
+- не больше LLM_CONCURRENCY запросов одновременно;
+- интерактивные запросы (ответы на упоминания) обгоняют саммари;
+- одинаковые запросы, которые уже выполняются, не дублируются —
+  второй вызывающий ждёт результат первого;
+- временные ошибки OpenAI повторяются с экспоненциальной паузой и джиттером;
+- если очередь переполнена, запрос сразу отклоняется с SchedulerBusy.
+"""
+import asyncio
+import itertools
+import logging
+import random
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from bot.config import LLM_CONCURRENCY, LLM_QUEUE_LIMIT, LLM_RETRIES, LLM_BACKOFF_BASE
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SUMMARY = 10
+
+
+@lru_cache(maxsize=1)
+def retryable_errors() -> tuple[type[Exception], ...]:
+    """Временные ошибки OpenAI; openai импортируется только при первом запросе."""
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+class SchedulerBusy(Exception):
+    """Очередь запросов к LLM переполнена."""
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        queue_limit: int = LLM_QUEUE_LIMIT,
+        retries: int = LLM_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE
+    ):
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: list[asyncio.Task] = []
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self._seq = itertools.count()
+        self.in_progress = 0
+        self.coalesced_total = 0
+        self.retried_total = 0
+        self.rejected_total = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def _worker(self):
+        while True:
+            _, _, factory, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            self.in_progress += 1
+            try:
+                future.set_result(await self._run_with_retries(factory))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.in_progress -= 1
+
+    async def _run_with_retries(self, factory: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            try:
+                return await factory()
+            except retryable_errors() as e:
+                if attempt >= self.retries:
+                    raise
+                # Full jitter: пауза случайна в [0, base * 2^attempt]
+                delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+                attempt += 1
+                self.retried_total += 1
+                logger.warning(f"[llm] {type(e).__name__}, повтор {attempt}/{self.retries} через {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def coalesce(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет factory, если задача с таким ключом ещё не идёт,
+        иначе дожидается результата уже идущей.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced_total += 1
+            logger.info(f"[llm] Запрос {key!r} уже выполняется, ждём его результат")
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await factory()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Чтобы не было предупреждения о непрочитанном исключении
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def submit(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        *,
+        priority: int = PRIORITY_SUMMARY,
+        key: Optional[Hashable] = None
+    ) -> Any:
+        """Ставит запрос в очередь и ждёт результат."""
+        if key is not None:
+            return await self.coalesce(key, lambda: self.submit(factory, priority=priority))
+        self._ensure_workers()
+        if self._queue.qsize() >= self.queue_limit:
+            self.rejected_total += 1
+            raise SchedulerBusy(f"в очереди уже {self._queue.qsize()} запросов к LLM")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), factory, future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "in_progress": self.in_progress,
+            "coalesced_total": self.coalesced_total,
+            "retried_total": self.retried_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,100 @@
+"""
+Логирование без задержек в event loop.
+
+Все обработчики корневого логгера переносятся за очередь: в потоке,
+который пишет лог, запись только кладётся в queue.SimpleQueue, а
+форматирование, вывод в stdout и в файл делает фоновый поток
+QueueListener. Аргументы записи (logger.debug("%s", obj)) тоже
+форматируются в фоновом потоке.
+
+Файл логов ротируется по размеру, старые части сжимаются gzip.
+
+При нескольких процессах (BOT_WORKERS > 1) stdout и файл пишет только
+фронт-процесс: обработчики пересылают ему записи через multiprocessing.Queue
+(start_log_receiver), иначе каждый процесс ротировал бы общий файл сам.
+"""
+import atexit
+import copy
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from typing import Optional
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler, который сжимает ротированные файлы: debug.log.1.gz, ..."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source: str, dest: str):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке:
+    msg % args и трейсбек превращаются в текст уже в QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return copy.copy(record)
+
+
+def start_log_queue():
+    """Переносит обработчики корневого логгера за очередь с фоновым писателем."""
+    global _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if not handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_log_queue)
+
+
+def start_log_receiver(log_queue) -> Optional[logging.handlers.QueueListener]:
+    """
+    Во фронт-процессе: записи процессов-обработчиков из log_queue
+    пишутся теми же обработчиками (stdout, файл), что и свои.
+    """
+    if _listener is None:
+        return None
+    receiver = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    receiver.start()
+    return receiver
+
+
+def stop_log_queue():
+    """Дописывает всё, что осталось в очереди (вызывается при выходе)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LazyDump:
+    """Аргумент для logger.debug("%s", LazyDump(obj)): JSON строится, только если запись выводится."""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return self.obj.model_dump_json(exclude_none=True)
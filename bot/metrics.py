@@ -0,0 +1,249 @@
+"""
+Метрики в формате Prometheus и сэмплирующий профайлер.
+
+Что собирается:
+- время работы хендлеров (middlewares/metrics.py);
+- число и время SQL-запросов по функциям dbmap (события SQLAlchemy);
+- время, токены и ошибки запросов к LLM (bot/ai.py);
+- текущее состояние очередей и кэшей (снимается в момент запроса /metrics).
+
+Сервер поднимается на METRICS_HOST:METRICS_PORT (0 — выключен):
+    GET /metrics                     — метрики
+    GET /debug/profile?seconds=10    — стеки event loop в формате collapsed
+                                       (для flamegraph.pl / speedscope), если METRICS_PROFILER=1
+"""
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import greenlet
+from collections import Counter as StackCounter
+from typing import Callable, Optional
+from aiohttp import web
+from bot.config import METRICS_HOST, METRICS_PORT, METRICS_PROFILER
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels_text(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счётчики по корзинам (не накопительные), сумма, количество]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+        self._gauges: list[tuple[str, Callable[[], dict]]] = []
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauges(self, prefix: str, collect: Callable[[], dict]):
+        """Числовые значения из collect() (например, queue.stats()) на момент запроса."""
+        self._gauges.append((prefix, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for prefix, collect in self._gauges:
+            try:
+                values = collect()
+            except Exception as e:
+                logger.warning(f"[metrics] Не удалось снять {prefix}: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "bot_handler_seconds", "Время работы хендлера", ("handler", "status")
+)
+db_query_seconds = registry.histogram(
+    "bot_db_query_seconds", "Время SQL-запроса по функциям dbmap", ("function",)
+)
+llm_request_seconds = registry.histogram(
+    "bot_llm_request_seconds", "Время запроса к LLM", ("mode", "status")
+)
+llm_tokens = registry.counter(
+    "bot_llm_tokens_total", "Токены, потраченные на запросы к LLM", ("kind",)
+)
+llm_errors = registry.counter(
+    "bot_llm_errors_total", "Ошибки запросов к LLM", ("error",)
+)
+telegram_wait_seconds = registry.histogram(
+    "bot_telegram_wait_seconds", "Ожидание лимита перед запросом к Telegram", ("method",)
+)
+telegram_retries = registry.counter(
+    "bot_telegram_retries_total", "Повторы запросов к Telegram", ("method", "error")
+)
+
+
+# --- SQL-запросы ---
+
+def _dbmap_function() -> str:
+    """
+    Имя функции dbmap, из которой выполняется запрос. SQLAlchemy asyncio
+    выполняет запрос в дочернем greenlet, а корутины вызывающего кода стоят
+    на стеке родительского — ищем там самый глубокий кадр из bot.dbmap.
+    """
+    current = greenlet.getcurrent()
+    frame = current.parent.gr_frame if current.parent is not None else sys._getframe()
+    while frame is not None:
+        if frame.f_globals.get("__name__") == "bot.dbmap":
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "other"
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append((time.perf_counter(), _dbmap_function()))
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started, function = conn.info["metrics_query_start"].pop()
+        db_query_seconds.observe(time.perf_counter() - started, function)
+
+    def error(context):
+        # Запрос упал — after_cursor_execute не будет, снимаем отметку здесь
+        if context.connection is not None and context.connection.info.get("metrics_query_start"):
+            context.connection.info["metrics_query_start"].pop()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before)
+    event.listen(engine.sync_engine, "after_cursor_execute", after)
+    event.listen(engine.sync_engine, "handle_error", error)
+
+
+# --- Профайлер ---
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = 0.005) -> str:
+    """
+    Раз в interval секунд снимает стек потока thread_id.
+    Результат — строки "func;func;func count", самые частые первыми.
+    """
+    stacks = StackCounter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+# --- HTTP ---
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def _profile(request: web.Request) -> web.Response:
+    seconds = min(float(request.query.get("seconds", 10)), 120)
+    loop_thread = threading.get_ident()
+    logger.info(f"[metrics] Профилирование на {seconds}s")
+    text = await asyncio.to_thread(sample_stacks, loop_thread, seconds)
+    return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    if not port:
+        return None
+    from bot.dbmap import engine, read_engine
+    from bot.ingest import ingest_queue
+    from bot.llm_scheduler import llm_scheduler
+    from bot.llm_cache import llm_cache
+
+    instrument_engine(engine)
+    if read_engine is not engine:
+        instrument_engine(read_engine)
+    registry.gauges("bot_ingest", ingest_queue.stats)
+    registry.gauges("bot_llm_scheduler", llm_scheduler.stats)
+    registry.gauges("bot_llm_cache", lambda: {"hits": llm_cache.hits, "misses": llm_cache.misses})
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    if METRICS_PROFILER:
+        app.router.add_get("/debug/profile", _profile)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=METRICS_HOST, port=port).start()
+    logger.info(f"[metrics] Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+    return runner
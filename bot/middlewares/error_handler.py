@@ -16,6 +16,6 @@ class NetworkErrorMiddleware(BaseMiddleware):
         try:
             return await handler(event, data)
         except TelegramNetworkError as e:
+            # Повторы уже сделал OutboundLimiter — сюда доходят только исчерпавшие их
             logger.warning(f"Сетевая ошибка Telegram API: {e}")
-            # можно тут сделать retry или отправку в очередь
             return None
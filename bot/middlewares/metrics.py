@@ -0,0 +1,27 @@
+import time
+from aiogram import BaseMiddleware
+from typing import Callable, Awaitable, Dict, Any
+from aiogram.types import TelegramObject
+from bot.metrics import handler_seconds
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время работы хендлера (bot_handler_seconds) с разбивкой по имени и исходу."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name, status)
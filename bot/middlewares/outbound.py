@@ -0,0 +1,187 @@
+"""
+Лимиты исходящих запросов к Telegram.
+
+Все запросы с chat_id (send_*, edit_*, delete_message, ...) проходят через
+OutboundLimiter, подключённый к bot.session:
+- общий лимит бота и лимит чата (в личке — в секунду, в группе — в минуту)
+  соблюдаются ожиданием, а не ошибкой 429; минутный лимит группы тратят
+  только новые сообщения (send*), правки и удаления его не расходуют;
+- запросы одного чата выполняются строго по очереди, поэтому части длинного
+  саммари не перемешиваются и не обгоняют повтор предыдущей;
+- на 429 чат замораживается на retry_after и запрос повторяется, сетевые
+  сбои и 5xx повторяются с нарастающей паузой.
+
+Правки сообщений (edit_message_text) не ждут ни лимитов, ни очереди чата:
+если отправить правку сейчас нельзя, она сразу отклоняется с
+TelegramRetryAfter, а на 429 не повторяется. StreamingMessage пропускает
+такую правку (следующая всё равно перерисует текст), а итоговую повторяет
+после паузы.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Optional
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from bot.config import (
+    OUTBOUND_GLOBAL_PER_SEC, OUTBOUND_PRIVATE_PER_SEC, OUTBOUND_GROUP_PER_MIN, OUTBOUND_RETRIES, BOT_WORKERS,
+)
+from bot.metrics import telegram_wait_seconds, telegram_retries
+
+logger = logging.getLogger(__name__)
+
+# Эти запросы не ждут лимитов и не повторяются: вызывающий код сам отрисует свежую версию
+NON_BLOCKING = {"editMessageText"}
+# Сколько чатов держать, прежде чем чистить простаивающие
+MAX_IDLE_CHATS = 10000
+
+
+class SlidingWindow:
+    """Не больше limit запросов за любые period секунд."""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = max(1, limit)
+        self.period = period
+        self.sent: deque[float] = deque()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до следующего разрешённого запроса."""
+        while self.sent and self.sent[0] <= now - self.period:
+            self.sent.popleft()
+        wait = self.blocked_until - now
+        if len(self.sent) >= self.limit:
+            wait = max(wait, self.sent[0] + self.period - now)
+        return max(wait, 0.0)
+
+    def record(self, now: float):
+        self.sent.append(now)
+
+    def idle(self, now: float) -> bool:
+        return self.blocked_until <= now and (not self.sent or self.sent[-1] <= now - self.period)
+
+
+class ChatState:
+    __slots__ = ("lock", "window", "group")
+
+    def __init__(self, window: SlidingWindow, group: bool):
+        self.lock = asyncio.Lock()
+        self.window = window
+        self.group = group
+
+    def counts(self, api_method: str) -> bool:
+        """Расходует ли запрос лимит чата: в группе — только отправка сообщений."""
+        return not self.group or api_method.startswith("send")
+
+    def delay(self, api_method: str, now: float) -> float:
+        if self.counts(api_method):
+            return self.window.delay(now)
+        return max(self.window.blocked_until - now, 0.0)
+
+    def record(self, api_method: str, now: float):
+        if self.counts(api_method):
+            self.window.record(now)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(
+        self,
+        global_per_sec: float = OUTBOUND_GLOBAL_PER_SEC / max(BOT_WORKERS, 1),
+        private_per_sec: float = OUTBOUND_PRIVATE_PER_SEC,
+        group_per_min: int = OUTBOUND_GROUP_PER_MIN,
+        retries: int = OUTBOUND_RETRIES,
+    ):
+        self.global_window = SlidingWindow(int(global_per_sec), 1)
+        self.private_per_sec = private_per_sec
+        self.group_per_min = group_per_min
+        self.retries = retries
+        self.chats: dict[int | str, ChatState] = {}
+
+    def _chat(self, chat_id: int | str) -> ChatState:
+        state = self.chats.get(chat_id)
+        if state is None:
+            if len(self.chats) >= MAX_IDLE_CHATS:
+                self._prune()
+            # Группы и каналы — отрицательные id или @username
+            if isinstance(chat_id, int) and chat_id > 0:
+                state = ChatState(SlidingWindow(1, 1 / self.private_per_sec), group=False)
+            else:
+                state = ChatState(SlidingWindow(self.group_per_min, 60), group=True)
+            self.chats[chat_id] = state
+        return state
+
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id in [k for k, s in self.chats.items() if not s.lock.locked() and s.window.idle(now)]:
+            del self.chats[chat_id]
+
+    async def _wait_turn(self, state: ChatState, api_method: str):
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            wait = max(state.delay(api_method, now), self.global_window.delay(now))
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        state.record(api_method, now)
+        self.global_window.record(now)
+        telegram_wait_seconds.observe(now - started, api_method)
+
+    async def _send_now(self, state: ChatState, make_request, bot, method: TelegramMethod[TelegramType]):
+        """Отправляет запрос, только если это можно сделать без ожидания."""
+        api_method = method.__api_method__
+        now = time.monotonic()
+        wait = max(state.delay(api_method, now), self.global_window.delay(now))
+        if wait > 0 or state.lock.locked():
+            telegram_retries.inc(api_method, "dropped")
+            raise TelegramRetryAfter(
+                method=method, message="Лимит чата исчерпан, запрос не отправлен",
+                retry_after=max(1, math.ceil(wait)),
+            )
+        async with state.lock:
+            state.record(api_method, now)
+            self.global_window.record(now)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                state.window.blocked_until = time.monotonic() + e.retry_after
+                telegram_retries.inc(api_method, "retry_after")
+                raise
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id: Optional[int | str] = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        api_method = method.__api_method__
+        state = self._chat(chat_id)
+        if api_method in NON_BLOCKING:
+            return await self._send_now(state, make_request, bot, method)
+        async with state.lock:
+            attempt = 0
+            while True:
+                await self._wait_turn(state, api_method)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    state.window.blocked_until = time.monotonic() + e.retry_after
+                    telegram_retries.inc(api_method, "retry_after")
+                    if attempt >= self.retries:
+                        raise
+                    logger.warning(f"[outbound] {api_method} в чат {chat_id}: Telegram просит подождать {e.retry_after}s")
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    telegram_retries.inc(api_method, type(e).__name__)
+                    if attempt >= self.retries:
+                        raise
+                    delay = 2 ** attempt
+                    logger.warning(f"[outbound] {api_method} в чат {chat_id}: {e}, повтор через {delay}s")
+                    await asyncio.sleep(delay)
+                attempt += 1
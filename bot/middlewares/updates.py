@@ -2,15 +2,43 @@ from aiogram.types import Update
 from aiogram import BaseMiddleware
 from typing import Callable, Awaitable, Dict, Any
 import logging
+import random
+import time
+from bot.config import LOG_UPDATE_SAMPLE, LOG_UPDATE_MAX_PER_MIN
+from bot.logs import LazyDump
 
 logger = logging.getLogger(__name__)
 
 class AllUpdatesMiddleware(BaseMiddleware):
+    """
+    Пишет в DEBUG полный дамп апдейта — но только долю LOG_UPDATE_SAMPLE
+    и не больше LOG_UPDATE_MAX_PER_MIN в минуту. JSON строится в потоке
+    логирования и только для записей, которые реально выводятся.
+    """
+
+    def __init__(self, sample: float = LOG_UPDATE_SAMPLE, max_per_min: int = LOG_UPDATE_MAX_PER_MIN):
+        self.sample = sample
+        self.max_per_min = max_per_min
+        self._window_start = 0.0
+        self._window_count = 0
+
+    def _should_log(self) -> bool:
+        if not logger.isEnabledFor(logging.DEBUG) or random.random() >= self.sample:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 60:
+            self._window_start, self._window_count = now, 0
+        if self._window_count >= self.max_per_min:
+            return False
+        self._window_count += 1
+        return True
+
     async def __call__(
         self,
         handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
         event: Update,
         data: Dict[str, Any]
     ) -> Any:
-        logger.debug(f"Incoming update:\n{event.model_dump_json(indent=2)}")
+        if self._should_log():
+            logger.debug("Incoming update: %s", LazyDump(event))
         return await handler(event, data)
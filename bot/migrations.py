@@ -0,0 +1,376 @@
+"""
+Версионированные миграции схемы БД.
+
+Текущая версия хранится в таблице schema_version. Новая БД создаётся
+сразу по моделям из dbmap и помечается последней версией; существующая
+БД без schema_version считается базовой (версия 1) и догоняется
+миграциями по порядку. Каждая миграция — отдельная транзакция.
+
+Запуск вручную:
+    python -m bot.migrations          # применить миграции
+    python -m bot.migrations --check  # проверить, что запросы используют индексы
+"""
+import asyncio
+import logging
+import datetime as dt
+import json
+from typing import Optional
+from sqlalchemy import text, inspect, update
+from bot.dbmap import engine, close_db, Base, TgSummaryRollup, TgArchivedPeriod, TgPoll
+
+logger = logging.getLogger(__name__)
+
+
+async def _hot_path_indexes(conn):
+    # Перед уникальным индексом схлопываем возможные дубли пользователей:
+    # сообщения переназначаем на самую раннюю запись с тем же tg_id
+    await conn.execute(text("""
+        UPDATE messages SET from_user = (
+            SELECT MIN(u2.id) FROM users u1 JOIN users u2 ON u1.tg_id = u2.tg_id
+            WHERE u1.id = messages.from_user
+        )
+        WHERE from_user IN (
+            SELECT u.id FROM users u
+            WHERE EXISTS (SELECT 1 FROM users d WHERE d.tg_id = u.tg_id AND d.id < u.id)
+        )
+    """))
+    await conn.execute(text("""
+        DELETE FROM users
+        WHERE EXISTS (SELECT 1 FROM users d WHERE d.tg_id = users.tg_id AND d.id < users.id)
+    """))
+    await conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_users_tg_id ON users (tg_id)"))
+    await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_chat_date ON messages (chat_id, date)"))
+    await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_chat_tg_msg ON messages (chat_id, tg_message_id)"))
+    await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_summaries_chat_created ON summaries (chat_id, created_at)"))
+
+
+async def _summary_rollups(conn):
+    await conn.run_sync(lambda sync_conn: TgSummaryRollup.__table__.create(sync_conn, checkfirst=True))
+
+
+def _column_names(sync_conn, table: str) -> set[str]:
+    return {c['name'] for c in inspect(sync_conn).get_columns(table)}
+
+
+async def _message_token_count(conn):
+    columns = await conn.run_sync(_column_names, 'messages')
+    if 'token_count' not in columns:
+        # Старые строки остаются с NULL — для них счёт делается при чтении
+        await conn.execute(text("ALTER TABLE messages ADD COLUMN token_count INTEGER"))
+
+
+async def _full_text_search(conn):
+    """
+    Полнотекстовый индекс по messages.text.
+    SQLite: FTS5-таблица над messages (external content), синхронизируется триггерами.
+    PostgreSQL: вычисляемая колонка tsvector и GIN-индекс по ней.
+    В обоих случаях индекс обновляется в той же транзакции, что и запись сообщения.
+    """
+    if conn.dialect.name == 'sqlite':
+        await conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ))
+        await conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+            END
+        """))
+        await conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END
+        """))
+        await conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+            END
+        """))
+        # Индексируем уже накопленную историю
+        await conn.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+    else:
+        columns = await conn.run_sync(_column_names, 'messages')
+        if 'text_tsv' not in columns:
+            await conn.execute(text(
+                "ALTER TABLE messages ADD COLUMN text_tsv tsvector "
+                "GENERATED ALWAYS AS (to_tsvector('russian', coalesce(text, ''))) STORED"
+            ))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_text_tsv ON messages USING GIN (text_tsv)"))
+
+
+# До версии 8 реакции хранились в messages как ответ с текстом "Реакция: ..."
+_IS_REACTION = "CASE WHEN m.text LIKE 'Реакция:%' THEN 1 ELSE 0 END"
+
+
+async def _chat_stats(conn):
+    """Заполняет счётчики /statistic по уже накопленной истории (таблицы создаются по моделям)."""
+    hour = (
+        "CAST(strftime('%H', m.date) AS INTEGER)" if conn.dialect.name == 'sqlite'
+        else "CAST(EXTRACT(HOUR FROM m.date) AS INTEGER)"
+    )
+    for table in ('chat_stats', 'chat_user_stats', 'chat_hour_stats'):
+        await conn.execute(text(f"DELETE FROM {table}"))
+    await conn.execute(text(f"""
+        INSERT INTO chat_stats (chat_id, messages, reactions, summaries)
+        SELECT chat_id, SUM(messages), SUM(reactions), SUM(summaries) FROM (
+            SELECT m.chat_id, 1 - {_IS_REACTION} AS messages, {_IS_REACTION} AS reactions, 0 AS summaries
+            FROM messages m
+            UNION ALL
+            SELECT chat_id, 0, 0, 1 FROM summaries
+        ) t
+        WHERE chat_id IS NOT NULL
+        GROUP BY chat_id
+    """))
+    await conn.execute(text(f"""
+        INSERT INTO chat_user_stats (chat_id, user_id, messages, reactions_received)
+        SELECT chat_id, user_id, SUM(messages), SUM(reactions) FROM (
+            SELECT m.chat_id, m.from_user AS user_id, 1 AS messages, 0 AS reactions
+            FROM messages m WHERE {_IS_REACTION} = 0
+            UNION ALL
+            SELECT o.chat_id, o.from_user, 0, 1
+            FROM messages m JOIN messages o ON o.id = m.reply_to_message_id
+            WHERE {_IS_REACTION} = 1
+        ) t
+        WHERE chat_id IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY chat_id, user_id
+    """))
+    await conn.execute(text(f"""
+        INSERT INTO chat_hour_stats (chat_id, hour, messages)
+        SELECT m.chat_id, {hour}, COUNT(*)
+        FROM messages m
+        WHERE {_IS_REACTION} = 0 AND m.chat_id IS NOT NULL AND m.date IS NOT NULL
+        GROUP BY m.chat_id, {hour}
+    """))
+
+
+async def _archived_periods(conn):
+    await conn.run_sync(lambda sync_conn: TgArchivedPeriod.__table__.create(sync_conn, checkfirst=True))
+
+
+# Символы, которые продолжают предыдущий эмодзи: вариационные селекторы,
+# модификаторы тона кожи, keycap и склейка ZWJ (❤️‍🔥, 👨‍💻)
+_EMOJI_JOINERS = {'\ufe0e', '\ufe0f', '\u20e3', '\u200d'} | {chr(c) for c in range(0x1f3fb, 0x1f400)}
+
+
+def _split_emoji(reactions: str) -> list[str]:
+    """'👍❤️‍🔥' -> ['👍', '❤️‍🔥']: старый формат писал эмодзи подряд без разделителя."""
+    emoji = []
+    for char in reactions:
+        if emoji and (char in _EMOJI_JOINERS or emoji[-1].endswith('\u200d')):
+            emoji[-1] += char
+        elif not char.isspace():
+            emoji.append(char)
+    return emoji
+
+
+async def _aggregated_reactions(conn):
+    """
+    Строки "Реакция: ..." из messages сворачиваются в счётчики message_reactions
+    (таблица создаётся по моделям). Старый формат на каждое изменение писал
+    весь текущий набор эмодзи пользователя, поэтому в счёт идёт только его
+    последняя строка на сообщение, разобранная на отдельные эмодзи.
+    Счётчики реакций в статистике пересчитываются по получившимся данным.
+    """
+    rows = await conn.execute(text(f"""
+        SELECT m.reply_to_message_id, m.from_user, m.text
+        FROM messages m
+        WHERE {_IS_REACTION} = 1 AND m.reply_to_message_id IS NOT NULL
+        ORDER BY m.id
+    """))
+    latest = {}
+    for message_id, user_id, reaction in rows:
+        latest[(message_id, user_id)] = reaction[len('Реакция:'):]
+    counts: dict[tuple[int, str], int] = {}
+    for (message_id, _), reaction in latest.items():
+        for emoji in set(_split_emoji(reaction)):
+            key = (message_id, emoji[:32])
+            counts[key] = counts.get(key, 0) + 1
+    if counts:
+        await conn.execute(
+            text("INSERT INTO message_reactions (message_id, emoji, count) VALUES (:m, :e, :c)"),
+            [{"m": message_id, "e": emoji, "c": count} for (message_id, emoji), count in counts.items()]
+        )
+    await conn.execute(text(f"""
+        UPDATE messages SET reply_to_message_id = NULL
+        WHERE reply_to_message_id IN (SELECT m.id FROM messages m WHERE {_IS_REACTION} = 1)
+    """))
+    await conn.execute(text(f"DELETE FROM messages WHERE id IN (SELECT m.id FROM messages m WHERE {_IS_REACTION} = 1)"))
+    await conn.execute(text("""
+        UPDATE chat_stats SET reactions = COALESCE((
+            SELECT SUM(r.count) FROM message_reactions r JOIN messages o ON o.id = r.message_id
+            WHERE o.chat_id = chat_stats.chat_id
+        ), 0)
+    """))
+    await conn.execute(text("""
+        UPDATE chat_user_stats SET reactions_received = COALESCE((
+            SELECT SUM(r.count) FROM message_reactions r JOIN messages o ON o.id = r.message_id
+            WHERE o.chat_id = chat_user_stats.chat_id AND o.from_user = chat_user_stats.user_id
+        ), 0)
+    """))
+
+
+async def _poll_votes(conn):
+    """
+    Голоса хранятся в poll_votes (таблица создаётся по моделям). tg_polls
+    получает ссылку на исходное сообщение, а options вместо JSON-строки с
+    дампом всего опроса — просто список текстов вариантов. Старые строки
+    "... проголосовал за" в messages остаются как есть.
+    """
+    columns = await conn.run_sync(_column_names, 'tg_polls')
+    if 'tg_message_id' not in columns:
+        await conn.execute(text("ALTER TABLE tg_polls ADD COLUMN tg_message_id INTEGER"))
+    rows = (await conn.execute(text("SELECT id, options FROM tg_polls"))).all()
+    for poll_id, options in rows:
+        # Раньше в JSON-колонку писался уже сериализованный json.dumps(...)
+        while isinstance(options, str):
+            options = json.loads(options)
+        if isinstance(options, dict):
+            options = [opt.get("text", "") for opt in options.get("options", [])]
+        await conn.execute(update(TgPoll.__table__).where(TgPoll.id == poll_id).values(options=options))
+
+
+async def _rollup_spans(conn):
+    """
+    Отрезки конспектов уникальны по (чат, начало, конец): узкий период
+    сохраняет свой отрезок рядом с более длинным из широкого.
+    """
+    await conn.execute(text("DROP INDEX IF EXISTS uq_summary_rollups_chat_bucket"))
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_summary_rollups_chat_span "
+        "ON summary_rollups (chat_id, bucket_start, bucket_end)"
+    ))
+
+
+# (версия, описание, функция). Версия 1 — схема, созданная до появления миграций.
+MIGRATIONS = [
+    (2, 'индексы для выборок по чату/дате, ответов, пользователей и саммари', _hot_path_indexes),
+    (3, 'таблица конспектов по временным корзинам', _summary_rollups),
+    (4, 'число токенов в messages.token_count', _message_token_count),
+    (5, 'полнотекстовый индекс по сообщениям', _full_text_search),
+    (6, 'счётчики статистики по чатам', _chat_stats),
+    (7, 'архив старых месяцев истории', _archived_periods),
+    (8, 'реакции как счётчики по эмодзи', _aggregated_reactions),
+    (9, 'голоса в опросах и ссылка опроса на сообщение', _poll_votes),
+    (10, 'отрезки конспектов уникальны по началу и концу', _rollup_spans),
+]
+# Объекты схемы, которых нет в моделях: создаются и для новой БД
+SCHEMA_EXTRAS = [_full_text_search]
+LATEST_VERSION = MIGRATIONS[-1][0] if MIGRATIONS else 1
+
+
+def _table_names(sync_conn) -> set[str]:
+    return set(inspect(sync_conn).get_table_names())
+
+
+async def _set_version(conn, version: int, name: str):
+    await conn.execute(
+        text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+        {"v": version, "n": name, "t": dt.datetime.utcnow()}
+    )
+
+
+async def current_version() -> Optional[int]:
+    """Версия схемы БД без изменений в ней; None — схема ещё не создана."""
+    async with engine.connect() as conn:
+        if 'schema_version' not in await conn.run_sync(_table_names):
+            return None
+        return (await conn.execute(text("SELECT MAX(version) FROM schema_version"))).scalar()
+
+
+async def migrate():
+    """Приводит схему БД к последней версии."""
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, name VARCHAR(256), applied_at TIMESTAMP)"
+        ))
+        version = (await conn.execute(text("SELECT MAX(version) FROM schema_version"))).scalar()
+        if version is None:
+            tables = await conn.run_sync(_table_names)
+            if 'messages' not in tables:
+                await conn.run_sync(Base.metadata.create_all)
+                for extra in SCHEMA_EXTRAS:
+                    await extra(conn)
+                await _set_version(conn, LATEST_VERSION, 'создание схемы по моделям')
+                logger.info(f'[migrations] Создана новая схема, версия {LATEST_VERSION}')
+                return
+            await _set_version(conn, 1, 'базовая схема')
+            version = 1
+        # Новые таблицы из моделей (без изменения существующих)
+        await conn.run_sync(Base.metadata.create_all)
+
+    for target, name, func in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info(f'[migrations] Применяем миграцию {target}: {name}')
+        async with engine.begin() as conn:
+            await func(conn)
+            await _set_version(conn, target, name)
+        version = target
+    logger.info(f'[migrations] Версия схемы: {version}')
+
+
+# Запросы горячего пути и индекс, который каждый из них обязан использовать
+HOT_PATH_QUERIES = [
+    (
+        'сообщения чата за период',
+        "SELECT id FROM messages WHERE chat_id = 1 AND date >= '2025-01-01' AND date < '2025-01-02' ORDER BY date",
+        'ix_messages_chat_date',
+    ),
+    (
+        'поиск сообщения для ответа/реакции',
+        "SELECT id FROM messages WHERE chat_id = 1 AND tg_message_id = 1",
+        'ix_messages_chat_tg_msg',
+    ),
+    (
+        'пользователь по tg_id',
+        "SELECT id FROM users WHERE tg_id = 1",
+        'uq_users_tg_id',
+    ),
+    (
+        'последнее саммари чата',
+        "SELECT id FROM summaries WHERE chat_id = 1 ORDER BY created_at DESC LIMIT 1",
+        'ix_summaries_chat_created',
+    ),
+]
+
+
+async def check_query_plans() -> list[tuple[str, bool, str]]:
+    """
+    Прогоняет EXPLAIN для запросов горячего пути.
+    Возвращает список (описание, индекс используется, план).
+    """
+    results = []
+    async with engine.connect() as conn:
+        is_sqlite = conn.dialect.name == 'sqlite'
+        if not is_sqlite:
+            # На маленьких таблицах PostgreSQL предпочтёт seq scan — запрещаем его
+            await conn.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, sql, index in HOT_PATH_QUERIES:
+            prefix = "EXPLAIN QUERY PLAN " if is_sqlite else "EXPLAIN "
+            rows = (await conn.execute(text(prefix + sql))).all()
+            plan = "\n".join(str(row[-1]) for row in rows)
+            results.append((name, index in plan, plan))
+    return results
+
+
+async def _main(check: bool):
+    try:
+        await migrate()
+        if check:
+            failed = False
+            for name, ok, plan in await check_query_plans():
+                print(f"{'OK  ' if ok else 'FAIL'} {name}\n    {plan.replace(chr(10), chr(10) + '    ')}")
+                failed = failed or not ok
+            if failed:
+                raise SystemExit(1)
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    import sys
+    from bot.config import setup_logging
+    setup_logging()
+    asyncio.run(_main('--check' in sys.argv))
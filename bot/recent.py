@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from collections import deque
+from bot.config import RECENT_MESSAGES_DEPTH, RECENT_MESSAGES_MAX_CHARS
+from bot.dbmap import MessageRow, get_last_messages
+
+logger = logging.getLogger(__name__)
+
+
+class ChatBuffer:
+    """Последние сообщения одного чата, не больше depth штук и max_chars символов."""
+
+    def __init__(self, depth: int, max_chars: int):
+        self.rows: deque[MessageRow] = deque()
+        self.depth = depth
+        self.max_chars = max_chars
+        self.chars = 0
+
+    def append(self, row: MessageRow):
+        self.rows.append(row)
+        self.chars += row.size()
+        # Самое свежее сообщение оставляем всегда, даже если оно одно больше лимита
+        while len(self.rows) > 1 and (len(self.rows) > self.depth or self.chars > self.max_chars):
+            self.chars -= self.rows.popleft().size()
+
+    def last(self, limit: int) -> list[MessageRow]:
+        if limit >= len(self.rows):
+            return list(self.rows)
+        return list(self.rows)[-limit:]
+
+
+class RecentMessages:
+    """
+    Кольцевые буферы последних сообщений по чатам.
+
+    Буфер чата прогревается из БД при первом обращении, дальше его
+    пополняет путь записи (enqueue_message), и контекст для ответов
+    бота берётся из памяти без запросов к БД.
+    """
+
+    def __init__(self, depth: int = RECENT_MESSAGES_DEPTH, max_chars: int = RECENT_MESSAGES_MAX_CHARS):
+        self.depth = depth
+        self.max_chars = max_chars
+        self._chats: dict[int, ChatBuffer] = {}
+        self._warm_locks: dict[int, asyncio.Lock] = {}
+        # Сообщения, пришедшие, пока буфер чата прогревается из БД
+        self._warming: dict[int, list[MessageRow]] = {}
+
+    def append(self, chat_id: int, row: MessageRow):
+        buffer = self._chats.get(chat_id)
+        if buffer is not None:
+            buffer.append(row)
+        elif chat_id in self._warming:
+            self._warming[chat_id].append(row)
+        # Непрогретые чаты не трогаем: при прогреве сообщение придёт из БД
+
+    async def _warm(self, chat_id: int) -> ChatBuffer:
+        from bot.ingest import ingest_queue
+        lock = self._warm_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            buffer = self._chats.get(chat_id)
+            if buffer is not None:
+                return buffer
+            self._warming[chat_id] = []
+            try:
+                # Сначала дописываем буфер записи, чтобы прогрев увидел свежие сообщения
+                await ingest_queue.flush()
+                buffer = ChatBuffer(self.depth, self.max_chars)
+                for m in await get_last_messages(chat_id, limit=self.depth):
+                    buffer.append(MessageRow.from_message(m))
+            finally:
+                pending = self._warming.pop(chat_id)
+            # Добавляем то, что пришло во время прогрева и ещё не попало в выборку
+            last_date = buffer.rows[-1].date if buffer.rows else None
+            for row in pending:
+                if last_date is None or row.date > last_date:
+                    buffer.append(row)
+            self._chats[chat_id] = buffer
+            self._warm_locks.pop(chat_id, None)
+            logger.debug(f"[recent] Буфер чата {chat_id} прогрет: {len(buffer.rows)} сообщений")
+            return buffer
+
+    async def get(self, chat_id: int, limit: int = 10) -> list[MessageRow]:
+        """Последние `limit` сообщений чата в хронологическом порядке."""
+        buffer = self._chats.get(chat_id)
+        if buffer is None:
+            buffer = await self._warm(chat_id)
+        return buffer.last(limit)
+
+
+recent_messages = RecentMessages()
@@ -0,0 +1,244 @@
+"""
+Многопроцессная обработка апдейтов (BOT_WORKERS > 1).
+
+Фронт-процесс только получает апдейты (long polling или вебхук) и раскладывает
+их по N процессам-обработчикам по chat_id. Все апдейты одного чата попадают
+в один процесс и там обрабатываются строго по очереди — от этого зависит
+разбор ответов и реакций при записи сообщений. Разные чаты обрабатываются
+параллельно и внутри процесса, и между процессами.
+
+Ответы на опросы (poll_answer) не содержат чата и раскладываются по poll_id.
+Кэши пользователей, буферы последних сообщений и очередь записи у каждого
+процесса свои; так как чат живёт в одном процессе, данные чата не расходятся.
+
+По SIGTERM/SIGINT фронт-процесс перестаёт получать апдейты и отправляет
+каждому обработчику метку остановки. Обработчик доделывает начатые апдейты,
+сбрасывает буфер записи, закрывает БД и завершается; фронт ждёт их не
+дольше SHUTDOWN_TIMEOUT (плюс время на сброс буфера).
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import time
+import zlib
+from typing import Optional
+from aiohttp import web
+from aiogram import Bot
+from bot.config import (
+    TG_TOKEN, BOT_MODE, METRICS_PORT, SHUTDOWN_TIMEOUT, setup_logging,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+)
+from bot.logs import start_log_receiver
+
+logger = logging.getLogger(__name__)
+
+# Поля апдейта, внутри которых лежит объект с chat
+CHAT_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "business_message", "edited_business_message",
+    "message_reaction", "message_reaction_count", "chat_member", "my_chat_member",
+    "chat_join_request", "chat_boost", "removed_chat_boost",
+)
+
+
+def shard_key(update: dict) -> int:
+    for name in CHAT_FIELDS:
+        obj = update.get(name)
+        if obj and "chat" in obj:
+            return obj["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"]["chat"]["id"]
+    for name in ("poll_answer", "poll"):
+        obj = update.get(name)
+        if obj:
+            return zlib.crc32(str(obj.get("poll_id") or obj.get("id")).encode())
+    for obj in update.values():
+        if isinstance(obj, dict) and "from" in obj:
+            return obj["from"]["id"]
+    return 0
+
+
+def shard_for(update: dict, workers: int) -> int:
+    return shard_key(update) % workers
+
+
+# --- Процесс-обработчик ---
+
+# Время на сброс буфера записи после обработки последних апдейтов
+FLUSH_TIMEOUT = 5
+
+
+def worker_main(index: int, queue, log_queue):
+    # Ctrl+C приходит всей группе процессов: обработчик останавливает только фронт меткой
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Процесс запущен через spawn: логирование настраивается заново, записи пишет фронт
+    setup_logging(log_queue)
+    asyncio.run(_worker(index, queue))
+
+
+async def _worker(index: int, queue):
+    from bot.bot import start_bot
+    from bot.ingest import ingest_queue
+    from bot.metrics import start_metrics_server
+    from bot.dbmap import close_db
+    from bot.tokens import load_encoding
+
+    # Словарь уже скачан фронтом; загрузка в потоке не держит цикл событий
+    await asyncio.to_thread(load_encoding)
+    bot, dp = await start_bot()
+    await ingest_queue.start()
+    # Фронт-процесс метрик не собирает, обработчики занимают следующие порты
+    metrics = await start_metrics_server(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    # Последняя задача каждого чата: следующая ждёт её завершения
+    tails: dict[int, asyncio.Task] = {}
+
+    async def process(key: int, update: dict, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.exception(f"[shard {index}] Ошибка обработки апдейта {update.get('update_id')}: {e}")
+        finally:
+            if tails.get(key) is asyncio.current_task():
+                del tails[key]
+
+    logger.info(f"[shard {index}] Обработчик запущен")
+    try:
+        while True:
+            raw = await asyncio.to_thread(queue.get)
+            if raw is None:
+                break
+            update = json.loads(raw)
+            key = shard_key(update)
+            tails[key] = asyncio.create_task(process(key, update, tails.get(key)))
+        if tails:
+            _, pending = await asyncio.wait(list(tails.values()), timeout=SHUTDOWN_TIMEOUT)
+            if pending:
+                logger.warning(f"[shard {index}] Не дождались {len(pending)} апдейтов за {SHUTDOWN_TIMEOUT}s")
+    finally:
+        await ingest_queue.stop()
+        if metrics:
+            await metrics.cleanup()
+        await bot.session.close()
+        await close_db()
+        logger.info(f"[shard {index}] Обработчик остановлен")
+
+
+# --- Фронт-процесс ---
+
+class ShardRouter:
+    def __init__(self, workers: int):
+        ctx = multiprocessing.get_context("spawn")
+        self.queues = [ctx.Queue() for _ in range(workers)]
+        self.log_queue = ctx.Queue()
+        self.log_receiver = None
+        self.processes = [
+            ctx.Process(target=worker_main, args=(i, q, self.log_queue), name=f"bot-shard-{i}", daemon=True)
+            for i, q in enumerate(self.queues)
+        ]
+
+    def start(self):
+        self.log_receiver = start_log_receiver(self.log_queue)
+        for process in self.processes:
+            process.start()
+        logger.info(f"Запущено процессов-обработчиков: {len(self.processes)}")
+
+    def dispatch(self, raw: str, update: dict):
+        index = shard_for(update, len(self.queues))
+        if not self.processes[index].is_alive():
+            logger.error(f"[shard {index}] Процесс-обработчик не работает, апдейт {update.get('update_id')} потерян")
+            return
+        self.queues[index].put(raw)
+
+    def stop(self, timeout: float = SHUTDOWN_TIMEOUT + FLUSH_TIMEOUT):
+        """Метка остановки каждому обработчику и ожидание их выхода (общий срок timeout)."""
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} не завершился за {timeout}s, останавливаем")
+                process.kill()
+        if self.log_receiver is not None:
+            self.log_receiver.stop()
+        logger.info("Процессы-обработчики остановлены")
+
+
+async def _poll(bot: Bot, shards: ShardRouter, allowed_updates: list[str]):
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.warning(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            data = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+            shards.dispatch(json.dumps(data, ensure_ascii=False), data)
+            offset = update.update_id + 1
+
+
+async def _serve_webhook(bot: Bot, shards: ShardRouter, allowed_updates: list[str]):
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401, text="Unauthorized")
+        raw = await request.text()
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return web.Response(status=400, text="Bad Request")
+        # Без update_id это не апдейт Telegram: 400, чтобы запрос не повторялся как при 500
+        if not isinstance(data, dict) or "update_id" not in data:
+            return web.Response(status=400, text="Bad Request")
+        shards.dispatch(raw, data)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT).start()
+    logger.info(f"Вебхук-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=allowed_updates,
+                drop_pending_updates=True,
+            )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_sharded(workers: int):
+    from bot.bot import build_dispatcher
+    from bot.webhook import wait_for_stop_signal
+    allowed_updates = build_dispatcher().resolve_used_update_types()
+    shards = ShardRouter(workers)
+    shards.start()
+    bot = Bot(token=TG_TOKEN)
+    if BOT_MODE == 'webhook':
+        serve = asyncio.create_task(_serve_webhook(bot, shards, allowed_updates))
+    else:
+        serve = asyncio.create_task(_poll(bot, shards, allowed_updates))
+    stop = asyncio.create_task(wait_for_stop_signal())
+    try:
+        await asyncio.wait([serve, stop], return_when=asyncio.FIRST_COMPLETED)
+        if serve.done():
+            serve.result()
+    finally:
+        # Сначала перестаём получать апдейты, затем останавливаем обработчики
+        for task in (serve, stop):
+            task.cancel()
+        await asyncio.gather(serve, stop, return_exceptions=True)
+        await bot.session.close()
+        await asyncio.to_thread(shards.stop)
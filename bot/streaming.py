@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import Optional
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from bot.config import STREAM_EDIT_INTERVAL, STREAM_EDIT_INTERVAL_GROUP
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины сообщения Telegram с запасом
+MESSAGE_LIMIT = 4000
+# Сколько раз повторять итоговую отрисовку, если Telegram просит подождать
+FINAL_RENDER_ATTEMPTS = 5
+
+
+class StreamingMessage:
+    """
+    Показывает ответ LLM по мере генерации, редактируя сообщение-заглушку
+    ("Дай подумать...", "Создаю саммари...").
+
+    push только дописывает кусок в буфер: слот llm_scheduler не ждёт Telegram.
+    Отрисовкой занимается фоновая задача — не чаще раза в STREAM_EDIT_INTERVAL
+    секунд (в группах — STREAM_EDIT_INTERVAL_GROUP), рисуется последнее
+    состояние буфера, промежуточные пропускаются. finish всегда рисует
+    итоговый текст. Когда текст перерастает одно сообщение, продолжение
+    уходит новым сообщением в тот же чат.
+
+        async with StreamingMessage(placeholder) as stream:
+            text = await get_character_reply(prompt, on_delta=stream.push)
+            await stream.finish(text)
+    """
+
+    def __init__(self, placeholder: Message, interval: Optional[float] = None):
+        if interval is None:
+            interval = STREAM_EDIT_INTERVAL
+            if placeholder.chat.type != "private":
+                interval = max(interval, STREAM_EDIT_INTERVAL_GROUP)
+        self.messages: list[Message] = [placeholder]
+        self.rendered: list[str] = [placeholder.text or ""]
+        self.interval = interval
+        self.text = ""
+        self._changed = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._renderer: Optional[asyncio.Task] = None
+
+    @property
+    def last_message(self) -> Message:
+        return self.messages[-1]
+
+    async def __aenter__(self) -> "StreamingMessage":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._stop()
+
+    async def push(self, delta: str):
+        """Колбэк для on_delta: дописывает кусок текста в буфер, не дожидаясь Telegram."""
+        self.text += delta
+        self._changed.set()
+        if self._renderer is None and not self._closing.is_set():
+            self._renderer = asyncio.create_task(self._render_loop())
+
+    async def finish(self, text: str | None = None):
+        """Итоговая отрисовка; text заменяет накопленное (например, текст ошибки)."""
+        await self._stop()
+        if text is not None:
+            self.text = text
+        for _ in range(FINAL_RENDER_ATTEMPTS):
+            retry_after = await self._render()
+            if retry_after is None:
+                return
+            await asyncio.sleep(retry_after)
+        logger.warning("[stream] Итоговый текст не отрисован: Telegram просит подождать")
+
+    async def _stop(self):
+        """Останавливает фоновую отрисовку, дав закончить начатую правку."""
+        self._closing.set()
+        if self._renderer is not None:
+            await self._renderer
+            self._renderer = None
+
+    async def _render_loop(self):
+        while not self._closing.is_set():
+            await self._changed.wait()
+            if self._closing.is_set():
+                return
+            self._changed.clear()
+            try:
+                await self._render()
+            except Exception as e:
+                logger.warning(f"[stream] Промежуточная отрисовка не удалась: {e}")
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _render(self) -> Optional[float]:
+        """Рисует текущий текст. Возвращает паузу, если Telegram попросил подождать."""
+        parts = [self.text[i:i + MESSAGE_LIMIT] for i in range(0, len(self.text), MESSAGE_LIMIT)]
+        for index, part in enumerate(parts):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                if index < len(self.messages):
+                    if self.rendered[index] != part:
+                        await self.messages[index].edit_text(part)
+                        self.rendered[index] = part
+                else:
+                    self.messages.append(await self.last_message.answer(part))
+                    self.rendered.append(part)
+            except TelegramRetryAfter as e:
+                # Не ждём: следующая отрисовка возьмёт свежий текст
+                logger.debug(f"[stream] Telegram просит подождать {e.retry_after}s")
+                return e.retry_after
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+        return None
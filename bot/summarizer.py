@@ -0,0 +1,264 @@
+"""
+Иерархическое (map-reduce) саммари для больших периодов.
+
+История режется на фрагменты по бюджету токенов, фрагменты конспектируются
+параллельно (не больше SUMMARY_PARALLELISM запросов одновременно), затем
+конспекты сворачиваются в итоговое саммари. Если конспекты сами не влезают
+в бюджет, они сворачиваются ещё одним уровнем тем же способом.
+
+Для /summary (summarize_range) история делится на временные корзины
+по SUMMARY_ROLLUP_MINUTES минут. Если весь период влезает в один запрос,
+саммари делается одним запросом без конспектов. Иначе соседние закрытые
+корзины склеиваются в отрезки до бюджета токенов, конспект каждого отрезка
+сохраняется в summary_rollups и переиспользуется следующими вызовами, так
+что заново конспектируются только отрезки, которых ещё нет в кэше, и края периода.
+"""
+import asyncio
+import bisect
+import logging
+import datetime as dt
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Awaitable
+from bot.config import SUMMARY_PARALLELISM, SUMMARY_ROLLUP_MINUTES, SUMMARY_CONTEXT_TOKENS
+from bot.ai import get_summary_llm, summarize_chunk, REDUCE_PROMPT
+from bot.dbmap import iter_messages_by_chat_and_range, get_rollups, save_rollup, rollup_bucket_start
+from bot.context import split_by_budget, row_tokens, ChunkPacker
+from bot.utils import format_history_row
+from bot.llm_scheduler import llm_scheduler, SchedulerBusy
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит параллельных запросов конспектирования на весь процесс
+_llm_slots = asyncio.Semaphore(SUMMARY_PARALLELISM)
+
+
+async def _map(chunks: list[str]) -> list[str]:
+    async def run(chunk: str) -> str:
+        async with _llm_slots:
+            return await summarize_chunk(chunk)
+
+    return await asyncio.gather(*(run(chunk) for chunk in chunks))
+
+
+async def _condense(chunks: list[str]) -> str:
+    """Сворачивает фрагменты истории в один конспект, влезающий в бюджет."""
+    while True:
+        partials = await _map(chunks)
+        if len(partials) == 1:
+            return partials[0]
+        chunks = split_by_budget(partials)
+
+
+async def _reduce(
+    chunks: list[str],
+    style: str,
+    chat_id: int,
+    start: dt.datetime,
+    end: dt.datetime,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
+    """
+    Сворачивает уже нарезанные по бюджету фрагменты уровнями, пока они
+    не влезут в один итоговый запрос. В on_delta стримится только итоговое саммари.
+    """
+    level = 0
+    while len(chunks) > 1:
+        level += 1
+        logger.info(f"[summary] Уровень {level}: конспектируем {len(chunks)} фрагментов")
+        chunks = split_by_budget(await _map(chunks))
+    return await get_summary_llm(chunks[0], style, chat_id, start, end, prompt=REDUCE_PROMPT, on_delta=on_delta)
+
+
+async def _summarize_chunks(
+    chunks: list[str],
+    style: str = "",
+    chat_id: int = 0,
+    start: dt.datetime = None,
+    end: dt.datetime = None,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
+    """Саммари по нарезанной истории. Короткая история уходит одним запросом, как раньше."""
+    if len(chunks) == 1:
+        return await get_summary_llm(chunks[0], style, chat_id, start, end, on_delta=on_delta)
+    try:
+        return await _reduce(chunks, style, chat_id, start, end, on_delta)
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к OpenAI: {e}")
+        return f"Ошибка при обращении к OpenAI: {e}"
+
+
+def _segments(start: dt.datetime, end: dt.datetime, now: dt.datetime) -> list[tuple[dt.datetime, dt.datetime, bool]]:
+    """
+    Делит [start, end) на отрезки (начало, конец, кэшируемый).
+    Кэшируемые — целые корзины, закончившиеся к моменту now; соседние
+    некэшируемые куски (края периода, текущая корзина) склеиваются.
+    """
+    step = dt.timedelta(minutes=SUMMARY_ROLLUP_MINUTES)
+    segments = []
+    cursor = start
+    while cursor < end:
+        bucket = rollup_bucket_start(cursor)
+        bucket_end = bucket + step
+        if bucket == cursor and bucket_end <= end and bucket_end <= now:
+            segments.append((bucket, bucket_end, True))
+            cursor = bucket_end
+            continue
+        seg_end = min(bucket_end, end)
+        if segments and not segments[-1][2]:
+            segments[-1] = (segments[-1][0], seg_end, False)
+        else:
+            segments.append((cursor, seg_end, False))
+        cursor = seg_end
+    return segments
+
+
+@dataclass
+class _Piece:
+    """Отрезок периода: готовый конспект из кэша или сообщения, которые надо законспектировать."""
+    start: dt.datetime
+    end: dt.datetime
+    cacheable: bool
+    blocks: list[tuple[str, int]] = field(default_factory=list)
+    text: Optional[str] = None
+
+
+def _pack(blocks: list[tuple[str, int]]) -> list[str]:
+    packer = ChunkPacker()
+    for block, tokens in blocks:
+        packer.add(block, tokens)
+    return packer.finish()
+
+
+def _cached_span(cached: dict, start: dt.datetime, ends: dict):
+    """Самый длинный сохранённый отрезок с началом start, кончающийся на границе отрезков периода."""
+    spans = [rollup for rollup in cached.get(start, []) if rollup.bucket_end in ends]
+    return max(spans, key=lambda rollup: rollup.bucket_end, default=None)
+
+
+def _pieces(
+    segments: list[tuple[dt.datetime, dt.datetime, bool]],
+    blocks: list[list[tuple[str, int]]],
+    cached: dict,
+    budget: int = SUMMARY_CONTEXT_TOKENS
+) -> list[_Piece]:
+    """
+    Раскладывает отрезки на готовые конспекты из кэша и новые отрезки для
+    конспектирования: соседние незакэшированные корзины склеиваются, пока
+    их история влезает в budget токенов. cached: {начало: [отрезки]}.
+    """
+    ends = {seg_end: index for index, (_, seg_end, _) in enumerate(segments)}
+    pieces = []
+    i = 0
+    while i < len(segments):
+        seg_start, seg_end, cacheable = segments[i]
+        rollup = _cached_span(cached, seg_start, ends) if cacheable else None
+        if rollup is not None:
+            pieces.append(_Piece(seg_start, rollup.bucket_end, True, text=rollup.text))
+            i = ends[rollup.bucket_end] + 1
+            continue
+        piece = _Piece(seg_start, seg_end, cacheable, list(blocks[i]))
+        tokens = sum(t for _, t in piece.blocks)
+        i += 1
+        while cacheable and i < len(segments) and segments[i][2] and _cached_span(cached, segments[i][0], ends) is None:
+            extra = sum(t for _, t in blocks[i])
+            if tokens + extra > budget:
+                break
+            piece.blocks += blocks[i]
+            piece.end = segments[i][1]
+            tokens += extra
+            i += 1
+        pieces.append(piece)
+    return pieces
+
+
+async def _piece_summary(chat_id: int, piece: _Piece) -> str:
+    chunks = _pack(piece.blocks)
+    text = await _condense(chunks) if chunks else ""
+    if piece.cacheable:
+        await save_rollup(chat_id, piece.start, piece.end, text, len(piece.blocks))
+    return text
+
+
+async def summarize_range(
+    chat_id: int,
+    start: dt.datetime,
+    end: dt.datetime,
+    style: str = "",
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str | None:
+    """
+    Саммари чата за период с переиспользованием конспектов корзин.
+    Возвращает None, если за период нет сообщений. Повторный /summary
+    того же периода, пока первый ещё считается, получает его результат.
+    """
+    return await llm_scheduler.coalesce(
+        ("summary", chat_id, start, end, style),
+        lambda: _summarize_range(chat_id, start, end, style, on_delta)
+    )
+
+
+async def _summarize_range(
+    chat_id: int,
+    start: dt.datetime,
+    end: dt.datetime,
+    style: str,
+    on_delta: Optional[Callable[[str], Awaitable[None]]]
+) -> str | None:
+    now = dt.datetime.now()
+    # Сообщения хранятся в наивном локальном времени
+    start = start.replace(tzinfo=None)
+    end = min(end.replace(tzinfo=None), now)
+    segments = _segments(start, end, now)
+
+    # Один проход по истории: строки раскладываются по отрезкам
+    starts = [seg_start for seg_start, _, _ in segments]
+    blocks: list[list[tuple[str, int]]] = [[] for _ in segments]
+    total = 0
+    async for row in iter_messages_by_chat_and_range(chat_id, start, end):
+        tokens = row_tokens(row)
+        blocks[bisect.bisect_right(starts, row.date) - 1].append((format_history_row(row), tokens))
+        total += tokens
+    if not total:
+        return None
+    if total <= SUMMARY_CONTEXT_TOKENS or not any(cacheable for _, _, cacheable in segments):
+        # Период влезает в один запрос или короче корзины — конспекты не нужны
+        return await _summarize_chunks(
+            _pack([b for seg_blocks in blocks for b in seg_blocks]), style, chat_id, start, end, on_delta
+        )
+
+    cached = {}
+    for rollup in await get_rollups(chat_id, start, end):
+        cached.setdefault(rollup.bucket_start, []).append(rollup)
+    pieces = _pieces(segments, blocks, cached)
+    missing = [piece for piece in pieces if piece.text is None]
+    logger.info(
+        f"[summary] Чат {chat_id}: {len(segments)} корзин, {len(pieces)} отрезков, "
+        f"из кэша {len(pieces) - len(missing)}, конспектируем {len(missing)}"
+    )
+
+    try:
+        fresh = await asyncio.gather(*(_piece_summary(chat_id, piece) for piece in missing))
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к OpenAI: {e}")
+        return f"Ошибка при обращении к OpenAI: {e}"
+    for piece, text in zip(missing, fresh):
+        piece.text = text
+
+    partials = [
+        f"[{piece.start.strftime('%d-%m-%Y %H:%M')} — {piece.end.strftime('%d-%m-%Y %H:%M')}]\n{piece.text}\n"
+        for piece in pieces if piece.text
+    ]
+    if not partials:
+        return None
+
+    try:
+        return await _reduce(split_by_budget(partials), style, chat_id, start, end, on_delta)
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к OpenAI: {e}")
+        return f"Ошибка при обращении к OpenAI: {e}"
@@ -0,0 +1,65 @@
+"""
+Подсчёт токенов.
+
+Если установлен tiktoken, считаем точно кодировкой модели; иначе (или если
+словарь кодировки не удалось загрузить) — грубой оценкой по длине текста.
+Для сообщений чата счёт делается один раз при записи и хранится
+в messages.token_count. Кодировка загружается при старте (load_encoding).
+"""
+import logging
+from functools import lru_cache
+from typing import Optional
+from bot.config import OPENAI_MODEL
+
+logger = logging.getLogger(__name__)
+
+# Грубая оценка для смешанного русско-английского текста
+CHARS_PER_TOKEN = 3
+
+# Накладные расходы на заголовок сообщения в истории: дата, username, имя
+HEADER_TOKENS = 12
+# Цитата сообщения, на которое дан ответ (до 300 символов)
+REPLY_EXCERPT_TOKENS = 100
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"[tokens] Не удалось загрузить кодировку tiktoken, считаем приблизительно: {e}")
+        return None
+
+
+def load_encoding() -> Optional[str]:
+    """
+    Загружает кодировку заранее, при старте: в первый раз tiktoken скачивает
+    словарь из сети, и в обработчике это остановило бы цикл событий.
+    Возвращает имя кодировки или None, если счёт будет приблизительным.
+    """
+    encoding = _encoding()
+    return encoding.name if encoding is not None else None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Обрезает текст примерно до budget токенов."""
+    encoding = _encoding()
+    if encoding is None:
+        return text[:budget * CHARS_PER_TOKEN] + "..."
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:budget]) + "..."
@@ -1,8 +1,9 @@
 import random
-from datetime import datetime, time, timezone
+import re
+from datetime import datetime, time, timezone, timedelta
 from bot.ai import get_character_reply
 from bot.config import GENNADY_PERSONA
-from bot.dbmap import get_last_messages
+from bot.recent import recent_messages
 
 def parse_datetime_args(args: list[str]) -> tuple[datetime, datetime] | None:
     try:
@@ -19,17 +20,47 @@ def parse_datetime_args(args: list[str]) -> tuple[datetime, datetime] | None:
     except Exception:
         return None
 
-def build_history_text(messages):
-    history_lines = []
-    for m in messages:
-        user = m.messages_from_user
-        if user is None:
-            continue
-        dt_str = m.date.strftime("%d-%m-%Y %H:%M")
-        username = user.username or "no_username"
-        full_name = f"{user.last_name or ''} {user.first_name or ''}".strip()
-        history_lines.append(f"{dt_str} {username} {full_name}:\n{m.text.strip()}\n")
-    return "\n".join(history_lines)
+PERIOD_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+def parse_search_args(args: list[str]) -> tuple[str, datetime | None, datetime | None]:
+    """
+    Аргументы /search: запрос и необязательный период в конце —
+    либо относительный (12h, 7d, 2w), либо как в /summary (дата время дата время).
+    """
+    start = end = None
+    if args and (m := re.fullmatch(r"(\d+)([hdw])", args[-1].lower())):
+        start = datetime.now() - timedelta(**{PERIOD_UNITS[m.group(2)]: int(m.group(1))})
+        args = args[:-1]
+    elif len(args) > 4 and (parsed := parse_datetime_args(args[-4:])):
+        start, end = (d.replace(tzinfo=None) for d in parsed)
+        args = args[:-4]
+    return " ".join(args), start, end
+
+def format_history_row(m) -> str:
+    """Текстовый блок истории для одного MessageRow."""
+    dt_str = m.date.strftime("%d-%m-%Y %H:%M")
+    username = m.username or "no_username"
+    full_name = f"{m.last_name or ''} {m.first_name or ''}".strip()
+    line = f"{dt_str} {username} {full_name}:\n"
+    # Проверим, является ли сообщение ответом
+    if m.reply_text:
+        original_text = m.reply_text.strip()
+        short_original = (original_text[:300] + "...") if len(original_text) > 300 else original_text
+        line += f"*это ответ на это сообщение:* '{short_original}':\n"
+    line += f"{m.text.strip()}\n"
+    if m.poll_results:
+        line += f"Итоги опроса: {m.poll_results}\n"
+    if m.reactions:
+        line += f"Реакции: {m.reactions}\n"
+    return line
+
+def build_history_blocks(rows) -> list[str]:
+    """По одному текстовому блоку на каждый MessageRow."""
+    return [format_history_row(m) for m in rows]
+
+def build_history_text(rows):
+    """Текст контекста из MessageRow (см. recent_messages)."""
+    return "\n".join(build_history_blocks(rows))
 
 def get_text_for_message(msg):
     if hasattr(msg, 'text') and msg.text:
@@ -38,14 +69,13 @@ def get_text_for_message(msg):
         return msg.caption
     return None
 
-async def maybe_bot_reply(msg, *, probability: float = 0.05, recent_limit: int = 15):
-    from bot import bot, bot_username
+async def maybe_bot_reply(msg, bot, bot_username: str, *, probability: float = 0.05, recent_limit: int = 15):
     chat_id = msg.chat.id
-    recent_messages = get_last_messages(chat_id, limit=recent_limit)
-    if any(m.messages_from_user.username == bot_username for m in recent_messages):
+    recent = await recent_messages.get(chat_id, limit=recent_limit)
+    if any((m.username or '').lower() == bot_username for m in recent):
         return
     if random.random() < probability:
-        messages = get_last_messages(chat_id, limit=10)
-        history_text = build_history_text(messages)
+        from bot.context import reply_context
+        history_text = build_history_text(reply_context(recent))
         reply_text = await get_character_reply(f'Придумай сообщение для чата\nКонтекст:\n{history_text}', persona=GENNADY_PERSONA)
         await bot.send_message(chat_id=chat_id, text=reply_text) 
\ No newline at end of file
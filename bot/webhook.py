@@ -0,0 +1,111 @@
+"""
+Режим вебхука: встроенный aiohttp-сервер вместо long polling.
+
+Telegram получает ответ 200 сразу, а апдейт обрабатывается в отдельной
+задаче (handle_in_background), поэтому апдейты разных чатов идут
+параллельно. Заголовок X-Telegram-Bot-Api-Secret-Token сверяется
+с WEBHOOK_SECRET. По SIGTERM/SIGINT (docker stop, Ctrl+C) сервер перестаёт
+принимать запросы и дожидается апдейтов, которые ещё обрабатываются,
+после чего bot.main сбрасывает буфер записи.
+
+Если WEBHOOK_URL не задан, вебхук в Telegram не регистрируется — сервер
+можно гонять локально, отправляя ему записанные апдейты:
+    python -m bot.webhook replay updates.jsonl [http://127.0.0.1:8080/webhook]
+"""
+import asyncio
+import logging
+import signal
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from bot.config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, SHUTDOWN_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+async def wait_for_stop_signal():
+    """Ждёт SIGTERM или SIGINT."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = (signal.SIGTERM, signal.SIGINT)
+    for sig in signals:
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in signals:
+            loop.remove_signal_handler(sig)
+    logger.info("Получен сигнал остановки")
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """При остановке сервера дожидается апдейтов, обрабатываемых в фоне."""
+
+    async def close(self):
+        tasks = self._background_feed_update_tasks
+        if tasks:
+            logger.info(f"Ждём обработки {len(tasks)} апдейтов")
+            _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+            if pending:
+                logger.warning(f"Не дождались {len(pending)} апдейтов за {SHUTDOWN_TIMEOUT}s")
+        await super().close()
+
+
+def build_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    app = web.Application()
+    DrainingRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Поднимает сервер и работает до SIGTERM/SIGINT (или пока задачу не отменят)."""
+    runner = web.AppRunner(build_app(bot, dp))
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=True,
+            )
+            logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL}")
+        else:
+            logger.warning("WEBHOOK_URL не задан — вебхук в Telegram не регистрируется (локальный режим)")
+        await wait_for_stop_signal()
+    finally:
+        # Сначала закрывается порт, затем DrainingRequestHandler дожидается начатых апдейтов
+        await runner.cleanup()
+
+
+async def replay(path: str, url: str):
+    """Отправляет апдейты из JSONL-файла (по одному JSON на строку) на вебхук."""
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+    async with ClientSession() as http:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                async with http.post(url, data=line.encode(), headers=headers) as response:
+                    print(response.status, line[:80])
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3 or sys.argv[1] != 'replay':
+        print(__doc__)
+        raise SystemExit(1)
+    target = sys.argv[3] if len(sys.argv) > 3 else f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    asyncio.run(replay(sys.argv[2], target))
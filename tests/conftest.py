@@ -0,0 +1,79 @@
+import atexit
+import os
+import shutil
+import sqlite3
+import tempfile
+import pytest
+
+# Путь к SQLite (db/db.sqlite3) фиксируется при импорте bot.dbmap относительно
+# текущего каталога, поэтому переходим во временный каталог до импорта бота
+WORKDIR = tempfile.mkdtemp(prefix="chat_mix_bot-")
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+os.chdir(WORKDIR)
+os.makedirs("db")
+os.makedirs("logs")
+DB_PATH = os.path.join(WORKDIR, "db", "db.sqlite3")
+
+# Схема БД до появления миграций (версия 1): без schema_version и новых таблиц
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+    tg_id INTEGER,
+    username VARCHAR(128),
+    first_name VARCHAR(128),
+    last_name VARCHAR(128)
+);
+CREATE TABLE messages (
+    id INTEGER NOT NULL PRIMARY KEY,
+    from_user INTEGER REFERENCES users (id),
+    chat_id INTEGER,
+    text TEXT,
+    date DATETIME,
+    tg_message_id INTEGER,
+    reply_to_message_id INTEGER REFERENCES messages (id)
+);
+CREATE TABLE summaries (
+    id INTEGER NOT NULL PRIMARY KEY,
+    chat_id INTEGER,
+    author VARCHAR(128),
+    text TEXT,
+    created_at DATETIME,
+    range_start DATETIME,
+    range_end DATETIME,
+    style TEXT
+);
+CREATE TABLE tg_polls (
+    id INTEGER NOT NULL PRIMARY KEY,
+    poll_id VARCHAR NOT NULL UNIQUE,
+    chat_id INTEGER,
+    question VARCHAR NOT NULL,
+    options JSON NOT NULL
+);
+"""
+
+
+def _remove_db():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+
+
+@pytest.fixture
+def fresh_db():
+    """Пустой каталог db/: схема создаётся по моделям при первом migrate()."""
+    _remove_db()
+    yield DB_PATH
+    _remove_db()
+
+
+@pytest.fixture
+def baseline_db():
+    """
+    Чистая БД базовой схемы на месте db/db.sqlite3.
+    Возвращает sqlite3-соединение для наполнения и проверок.
+    """
+    _remove_db()
+    conn = sqlite3.connect(DB_PATH)
+    conn.executescript(BASELINE_SCHEMA)
+    yield conn
+    conn.close()
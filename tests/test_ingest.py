@@ -0,0 +1,104 @@
+import asyncio
+import datetime as dt
+from aiogram.types import User
+from sqlalchemy import select
+from bot.dbmap import init_db, close_db, get_user, ReadSession, TgMessage, TgMessageReaction
+from bot.ingest import IngestQueue, MessageRecord, ReactionRecord
+
+CHAT_ID = -200
+
+
+def run(scenario):
+    async def main():
+        await init_db()
+        user = await get_user(User(id=9, is_bot=False, first_name="a", username="a"))
+        try:
+            return await scenario(user)
+        finally:
+            await close_db()
+    return asyncio.run(main())
+
+
+def message(user, tg_message_id: int, reply_to: int = None) -> MessageRecord:
+    return MessageRecord(
+        user.id, CHAT_ID, f"сообщение {tg_message_id}", tg_message_id=tg_message_id,
+        reply_to_tg_msg_id=reply_to, date=dt.datetime(2025, 3, 10, 12, tg_message_id)
+    )
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "не дождались сброса"
+        await asyncio.sleep(0.01)
+
+
+async def stored() -> list[tuple[int, int]]:
+    async with ReadSession() as session:
+        return (await session.execute(
+            select(TgMessage.tg_message_id, TgMessage.reply_to_message_id)
+            .where(TgMessage.chat_id == CHAT_ID).order_by(TgMessage.id)
+        )).all()
+
+
+def test_flush_when_batch_is_full(fresh_db):
+    async def scenario(user):
+        queue = IngestQueue(batch_size=3, flush_interval=60)
+        await queue.start()
+        try:
+            queue.put(message(user, 1))
+            queue.put(message(user, 2))
+            await asyncio.sleep(0.05)
+            # Неполный пакет ждёт интервала
+            assert queue.flushed_total == 0
+            queue.put(message(user, 3))
+            await wait_for(lambda: queue.flushed_total == 3)
+            return queue.batches_total, len(await stored())
+        finally:
+            await queue.stop()
+    assert run(scenario) == (1, 3)
+
+
+def test_flush_on_interval(fresh_db):
+    async def scenario(user):
+        queue = IngestQueue(batch_size=100, flush_interval=0.05)
+        await queue.start()
+        try:
+            queue.put(message(user, 1))
+            await wait_for(lambda: queue.flushed_total == 1)
+            return len(await stored())
+        finally:
+            await queue.stop()
+    assert run(scenario) == 1
+
+
+def test_stop_writes_the_rest(fresh_db):
+    async def scenario(user):
+        queue = IngestQueue(batch_size=100, flush_interval=60)
+        await queue.start()
+        queue.put(message(user, 1))
+        queue.put(message(user, 2))
+        await queue.stop()
+        return queue.depth, len(await stored())
+    assert run(scenario) == (0, 2)
+
+
+def test_reply_and_reaction_resolve_within_one_batch(fresh_db):
+    async def scenario(user):
+        queue = IngestQueue(batch_size=100, flush_interval=60)
+        queue.put(message(user, 1))
+        queue.put(message(user, 2, reply_to=1))
+        queue.put_reaction(ReactionRecord(CHAT_ID, 1, added=["👍"], removed=[]))
+        await queue.stop()
+        rows = await stored()
+        async with ReadSession() as session:
+            reactions = (await session.execute(
+                select(TgMessage.tg_message_id, TgMessageReaction.emoji, TgMessageReaction.count)
+                .join(TgMessage, TgMessage.id == TgMessageReaction.message_id)
+            )).all()
+        return rows, reactions
+    rows, reactions = run(scenario)
+    (first, _), (second, reply_to) = rows
+    assert (first, second) == (1, 2)
+    assert reply_to is not None
+    assert reactions == [(1, "👍", 1)]
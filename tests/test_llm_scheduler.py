@@ -0,0 +1,110 @@
+import asyncio
+import httpx
+import openai
+import pytest
+from bot.llm_scheduler import LLMScheduler, SchedulerBusy, PRIORITY_INTERACTIVE, PRIORITY_SUMMARY
+
+
+def run(scenario):
+    """Запускает сценарий со свежим планировщиком и гасит его воркеры."""
+    async def main():
+        scheduler = LLMScheduler(concurrency=1, queue_limit=10, retries=2, backoff_base=0)
+        try:
+            return await scenario(scheduler)
+        finally:
+            for worker in scheduler._workers:
+                worker.cancel()
+            await asyncio.gather(*scheduler._workers, return_exceptions=True)
+    return asyncio.run(main())
+
+
+async def started(scheduler: LLMScheduler, release: asyncio.Event, log: list):
+    """Занимает единственный слот, пока не будет release."""
+    async def blocker():
+        log.append("blocker")
+        await release.wait()
+        return "blocker"
+
+    task = asyncio.ensure_future(scheduler.submit(blocker))
+    while scheduler.in_progress == 0:
+        await asyncio.sleep(0)
+    return task
+
+
+def answer(log: list, name: str):
+    async def factory():
+        log.append(name)
+        await asyncio.sleep(0)
+        return name
+    return factory
+
+
+def test_identical_keys_are_coalesced():
+    async def scenario(scheduler):
+        log = []
+        results = await asyncio.gather(*(
+            scheduler.submit(answer(log, "саммари"), key=("summary", 1)) for _ in range(3)
+        ))
+        return results, log, scheduler.coalesced_total
+    results, log, coalesced = run(scenario)
+    assert results == ["саммари"] * 3
+    assert log == ["саммари"]
+    assert coalesced == 2
+
+
+def test_mentions_overtake_summaries():
+    async def scenario(scheduler):
+        log, release = [], asyncio.Event()
+        blocker = await started(scheduler, release, log)
+        summary = asyncio.ensure_future(scheduler.submit(answer(log, "саммари"), priority=PRIORITY_SUMMARY))
+        await asyncio.sleep(0)
+        mention = asyncio.ensure_future(scheduler.submit(answer(log, "упоминание"), priority=PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, summary, mention)
+        return log
+    assert run(scenario) == ["blocker", "упоминание", "саммари"]
+
+
+def test_transient_errors_are_retried_up_to_the_limit():
+    error = openai.APIConnectionError(request=httpx.Request("POST", "http://llm.local"))
+
+    async def scenario(scheduler):
+        calls = []
+
+        async def flaky():
+            calls.append(len(calls))
+            if len(calls) < 3:
+                raise error
+            return "ответ"
+
+        async def broken():
+            calls.append(len(calls))
+            raise error
+
+        assert await scheduler.submit(flaky) == "ответ"
+        calls.clear()
+        with pytest.raises(openai.APIConnectionError):
+            await scheduler.submit(broken)
+        return len(calls), scheduler.retried_total
+    attempts, retried = run(scenario)
+    # retries=2: первая попытка и два повтора
+    assert attempts == 3
+    assert retried == 4
+
+
+def test_full_queue_rejects_with_scheduler_busy():
+    async def scenario(scheduler):
+        scheduler.queue_limit = 2
+        log, release = [], asyncio.Event()
+        blocker = await started(scheduler, release, log)
+        queued = [asyncio.ensure_future(scheduler.submit(answer(log, f"саммари {i}"))) for i in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy):
+            await scheduler.submit(answer(log, "лишнее"))
+        release.set()
+        await asyncio.gather(blocker, *queued)
+        return log, scheduler.rejected_total
+    log, rejected = run(scenario)
+    assert "лишнее" not in log
+    assert rejected == 1
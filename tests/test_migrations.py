@@ -0,0 +1,137 @@
+import asyncio
+import json
+import pytest
+from bot.dbmap import close_db
+from bot.migrations import migrate, current_version, check_query_plans, HOT_PATH_QUERIES, LATEST_VERSION
+
+
+def run_migrations():
+    async def run():
+        try:
+            await migrate()
+            return await current_version()
+        finally:
+            await close_db()
+    return asyncio.run(run())
+
+
+def run_query_plans():
+    async def run():
+        try:
+            await migrate()
+            return await check_query_plans()
+        finally:
+            await close_db()
+    return asyncio.run(run())
+
+
+def insert_messages(conn, rows):
+    """rows: (id, from_user, chat_id, text, date, reply_to_message_id)."""
+    conn.executemany(
+        "INSERT INTO messages (id, from_user, chat_id, text, date, tg_message_id, reply_to_message_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(id, user, chat, text, date, id, reply) for id, user, chat, text, date, reply in rows]
+    )
+    conn.commit()
+
+
+def test_baseline_reaches_latest_version(baseline_db):
+    assert run_migrations() == LATEST_VERSION
+    # Повторный запуск ничего не меняет
+    assert run_migrations() == LATEST_VERSION
+    versions = [v for v, in baseline_db.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versions == list(range(1, LATEST_VERSION + 1))
+
+
+@pytest.mark.parametrize("db", ["fresh_db", "baseline_db"])
+def test_hot_path_queries_use_indexes(db, request):
+    request.getfixturevalue(db)
+    results = run_query_plans()
+    assert [name for name, _, _ in results] == [name for name, _, _ in HOT_PATH_QUERIES]
+    for (name, ok, plan), (_, _, index) in zip(results, HOT_PATH_QUERIES):
+        assert ok, f"{name}: нет {index} в плане\n{plan}"
+    assert {index for _, _, index in HOT_PATH_QUERIES} == {
+        'ix_messages_chat_date', 'ix_messages_chat_tg_msg', 'uq_users_tg_id', 'ix_summaries_chat_created'
+    }
+
+
+def test_duplicate_users_are_merged(baseline_db):
+    baseline_db.executemany(
+        "INSERT INTO users (id, tg_id, username) VALUES (?, ?, ?)",
+        [(1, 100, "first"), (2, 200, "other"), (3, 100, "dup")]
+    )
+    insert_messages(baseline_db, [
+        (1, 1, -1, "раз", "2025-01-05 12:00:00.000000", None),
+        (2, 3, -1, "два", "2025-01-05 12:01:00.000000", None),
+        (3, 2, -1, "три", "2025-01-05 12:02:00.000000", None),
+    ])
+    run_migrations()
+    users = baseline_db.execute("SELECT id, tg_id FROM users ORDER BY id").fetchall()
+    assert users == [(1, 100), (2, 200)]
+    authors = baseline_db.execute("SELECT id, from_user FROM messages ORDER BY id").fetchall()
+    assert authors == [(1, 1), (2, 1), (3, 2)]
+
+
+def test_reaction_rows_fold_into_counters(baseline_db):
+    baseline_db.executemany(
+        "INSERT INTO users (id, tg_id, username) VALUES (?, ?, ?)",
+        [(1, 100, "author"), (2, 200, "fan"), (3, 300, "critic")]
+    )
+    insert_messages(baseline_db, [
+        (1, 1, -1, "пост", "2025-01-05 12:00:00.000000", None),
+        # Каждая строка — весь текущий набор реакций пользователя
+        (2, 2, -1, "Реакция: 👍", "2025-01-05 12:01:00.000000", 1),
+        (3, 2, -1, "Реакция: 👍🔥", "2025-01-05 12:02:00.000000", 1),
+        (4, 3, -1, "Реакция: ❤️‍🔥👍", "2025-01-05 12:03:00.000000", 1),
+        (5, 3, -1, "ответ", "2025-01-05 12:04:00.000000", 1),
+    ])
+    run_migrations()
+    counts = dict(baseline_db.execute("SELECT emoji, count FROM message_reactions WHERE message_id = 1"))
+    assert counts == {"👍": 2, "🔥": 1, "❤️‍🔥": 1}
+    texts = [t for t, in baseline_db.execute("SELECT text FROM messages ORDER BY id")]
+    assert texts == ["пост", "ответ"]
+    assert baseline_db.execute("SELECT reply_to_message_id FROM messages WHERE id = 5").fetchone() == (1,)
+    assert baseline_db.execute("SELECT messages, reactions FROM chat_stats WHERE chat_id = -1").fetchone() == (2, 4)
+    received = dict(baseline_db.execute("SELECT user_id, reactions_received FROM chat_user_stats WHERE chat_id = -1"))
+    assert received[1] == 4
+
+
+def test_poll_options_are_normalized(baseline_db):
+    poll = {
+        "id": "p1",
+        "question": "Пицца?",
+        "options": [{"text": "да", "voter_count": 0}, {"text": "нет", "voter_count": 0}],
+    }
+    baseline_db.execute(
+        "INSERT INTO tg_polls (id, poll_id, chat_id, question, options) VALUES (1, 'p1', -1, 'Пицца?', ?)",
+        (json.dumps(json.dumps(poll, ensure_ascii=False)),)
+    )
+    baseline_db.commit()
+    run_migrations()
+    options, tg_message_id = baseline_db.execute("SELECT options, tg_message_id FROM tg_polls WHERE id = 1").fetchone()
+    assert json.loads(options) == ["да", "нет"]
+    assert tg_message_id is None
+
+
+def test_stats_are_backfilled(baseline_db):
+    baseline_db.executemany(
+        "INSERT INTO users (id, tg_id, username) VALUES (?, ?, ?)",
+        [(1, 100, "a"), (2, 200, "b")]
+    )
+    insert_messages(baseline_db, [
+        (1, 1, -1, "утро", "2025-01-05 09:10:00.000000", None),
+        (2, 1, -1, "ещё утро", "2025-01-05 09:20:00.000000", None),
+        (3, 2, -1, "вечер", "2025-01-05 21:00:00.000000", None),
+        (4, 2, -2, "другой чат", "2025-01-05 21:00:00.000000", None),
+    ])
+    baseline_db.execute("INSERT INTO summaries (chat_id, author, text) VALUES (-1, 'llm', 'итог')")
+    baseline_db.commit()
+    run_migrations()
+    chats = baseline_db.execute("SELECT chat_id, messages, reactions, summaries FROM chat_stats ORDER BY chat_id").fetchall()
+    assert chats == [(-2, 1, 0, 0), (-1, 3, 0, 1)]
+    users = baseline_db.execute(
+        "SELECT user_id, messages FROM chat_user_stats WHERE chat_id = -1 ORDER BY user_id"
+    ).fetchall()
+    assert users == [(1, 2), (2, 1)]
+    hours = baseline_db.execute("SELECT hour, messages FROM chat_hour_stats WHERE chat_id = -1 ORDER BY hour").fetchall()
+    assert hours == [(9, 2), (21, 1)]
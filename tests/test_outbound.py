@@ -0,0 +1,143 @@
+import asyncio
+import types
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage, EditMessageText
+import bot.middlewares.outbound as outbound
+from bot.middlewares.outbound import OutboundLimiter
+
+GROUP = -100
+PRIVATE = 100
+
+
+class Clock:
+    """Виртуальное время: sleep сдвигает часы, а не ждёт."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.now += max(delay, 0)
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(outbound, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(outbound, "asyncio", types.SimpleNamespace(sleep=clock.sleep, Lock=asyncio.Lock))
+    return clock
+
+
+class FakeTelegram:
+    """make_request: запоминает (время, метод, текст); ответы можно подменить по очереди."""
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.sent = []
+        self.failures = []
+
+    async def __call__(self, bot, method):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((self.clock.now - 1000.0, method.__api_method__, method.text))
+        await asyncio.sleep(0)
+        return True
+
+
+def send(chat_id, text):
+    return SendMessage(chat_id=chat_id, text=text)
+
+
+def edit(chat_id, text):
+    return EditMessageText(chat_id=chat_id, message_id=1, text=text)
+
+
+def test_parts_of_one_chat_go_out_in_order(clock):
+    async def run():
+        limiter = OutboundLimiter(global_per_sec=30, group_per_min=2)
+        telegram = FakeTelegram(clock)
+        await asyncio.gather(*(limiter(telegram, None, send(GROUP, f"часть {i}")) for i in range(5)))
+        return telegram.sent
+    sent = asyncio.run(run())
+    assert [text for _, _, text in sent] == [f"часть {i}" for i in range(5)]
+    # Не больше двух сообщений в минуту: остальные ждут окна
+    assert [t for t, _, _ in sent] == [0, 0, 60, 60, 120]
+
+
+def test_retry_after_freezes_the_chat(clock):
+    async def run():
+        limiter = OutboundLimiter(global_per_sec=30, group_per_min=20)
+        telegram = FakeTelegram(clock)
+        telegram.failures.append(TelegramRetryAfter(method=send(GROUP, "x"), message="flood", retry_after=5))
+        # Отправка повторяется после паузы
+        await limiter(telegram, None, send(GROUP, "первое"))
+        # Правка на 429 не повторяется, но замораживает чат
+        telegram.failures.append(TelegramRetryAfter(method=edit(GROUP, "x"), message="flood", retry_after=7))
+        with pytest.raises(TelegramRetryAfter):
+            await limiter(telegram, None, edit(GROUP, "правка"))
+        with pytest.raises(TelegramRetryAfter):
+            await limiter(telegram, None, edit(GROUP, "ещё правка"))
+        await limiter(telegram, None, send(GROUP, "второе"))
+        return telegram.sent
+    sent = asyncio.run(run())
+    assert [(t, text) for t, _, text in sent] == [(5, "первое"), (12, "второе")]
+
+
+def test_retry_after_gives_up_after_retries(clock):
+    async def run():
+        limiter = OutboundLimiter(global_per_sec=30, retries=2)
+        telegram = FakeTelegram(clock)
+        telegram.failures += [
+            TelegramRetryAfter(method=send(PRIVATE, "x"), message="flood", retry_after=1) for _ in range(3)
+        ]
+        with pytest.raises(TelegramRetryAfter):
+            await limiter(telegram, None, send(PRIVATE, "текст"))
+        return telegram
+    telegram = asyncio.run(run())
+    assert telegram.sent == [] and telegram.failures == []
+
+
+def test_edit_is_dropped_while_chat_is_busy(clock):
+    async def run():
+        limiter = OutboundLimiter(global_per_sec=30, group_per_min=20)
+        release = asyncio.Event()
+        calls = []
+
+        async def slow(bot, method):
+            calls.append(method.__api_method__)
+            if method.__api_method__ == "sendMessage":
+                await release.wait()
+            return True
+
+        sending = asyncio.ensure_future(limiter(slow, None, send(GROUP, "длинное саммари")))
+        await asyncio.sleep(0)
+        with pytest.raises(TelegramRetryAfter) as error:
+            await limiter(slow, None, edit(GROUP, "стрим"))
+        release.set()
+        await sending
+        # Чат освободился — правка проходит сразу
+        await limiter(slow, None, edit(GROUP, "стрим"))
+        return calls, error.value.retry_after
+    calls, retry_after = asyncio.run(run())
+    assert calls == ["sendMessage", "editMessageText"]
+    assert retry_after >= 1
+
+
+def test_edits_do_not_spend_the_group_window(clock):
+    async def run():
+        limiter = OutboundLimiter(global_per_sec=30, group_per_min=1)
+        telegram = FakeTelegram(clock)
+        await limiter(telegram, None, send(GROUP, "ответ"))
+        for i in range(3):
+            await limiter(telegram, None, edit(GROUP, f"правка {i}"))
+            clock.now += 3
+        await limiter(telegram, None, send(GROUP, "следующее"))
+        return telegram.sent
+    sent = asyncio.run(run())
+    assert [(t, text) for t, _, text in sent] == [
+        (0, "ответ"), (0, "правка 0"), (3, "правка 1"), (6, "правка 2"), (60, "следующее"),
+    ]
@@ -0,0 +1,93 @@
+import asyncio
+import datetime as dt
+import pytest
+from aiogram.types import User
+import bot.summarizer as summarizer
+from bot.context import HEADER_TOKENS
+from bot.dbmap import init_db, close_db, get_user, write_messages_batch
+from bot.ingest import MessageRecord
+
+CHAT_ID = -100
+DAY = dt.datetime(2025, 3, 10)
+
+
+@pytest.fixture
+def stub_llm(fresh_db, monkeypatch):
+    """Заглушка LLM; возвращает список законспектированных отрезков (начало, конец)."""
+    condensed = []
+
+    async def summarize_chunk(history_text, max_tokens=None):
+        return "конспект"
+
+    async def get_summary_llm(history_text, style="", chat_id=0, start=None, end=None, prompt=None, on_delta=None):
+        return "итог"
+
+    piece_summary = summarizer._piece_summary
+
+    async def spy(chat_id, piece):
+        condensed.append((piece.start.hour, 24 if piece.end.day != piece.start.day else piece.end.hour))
+        return await piece_summary(chat_id, piece)
+
+    monkeypatch.setattr(summarizer, "summarize_chunk", summarize_chunk)
+    monkeypatch.setattr(summarizer, "get_summary_llm", get_summary_llm)
+    monkeypatch.setattr(summarizer, "_piece_summary", spy)
+    return condensed
+
+
+async def _fill_day(hours=range(24)):
+    """По сообщению в час, каждое ровно на 1000 токенов истории."""
+    await init_db()
+    user = await get_user(User(id=7, is_bot=False, first_name="a", username="a"))
+    await write_messages_batch([
+        MessageRecord(user.id, CHAT_ID, f"сообщение {hour}", tg_message_id=hour + 1,
+                      token_count=1000 - HEADER_TOKENS, date=DAY.replace(hour=hour, minute=30))
+        for hour in hours
+    ])
+    return user
+
+
+async def _summary(start_hour, end_hour):
+    return await summarizer.summarize_range(
+        CHAT_ID, DAY + dt.timedelta(hours=start_hour), DAY + dt.timedelta(hours=end_hour)
+    )
+
+
+def test_narrow_range_reuses_and_caches_spans(stub_llm):
+    async def run():
+        try:
+            await _fill_day()
+            assert await _summary(0, 24) == "итог"
+            assert stub_llm == [(0, 12), (12, 24)]
+
+            # Узкий период: 00–12 берётся из кэша, 12–18 конспектируется и сохраняется
+            stub_llm.clear()
+            assert await _summary(0, 18) == "итог"
+            assert stub_llm == [(12, 18)]
+
+            stub_llm.clear()
+            assert await _summary(0, 18) == "итог"
+            assert await _summary(0, 24) == "итог"
+            assert stub_llm == []
+        finally:
+            await close_db()
+    asyncio.run(run())
+
+
+def test_late_message_invalidates_only_its_span(stub_llm):
+    async def run():
+        try:
+            user = await _fill_day()
+            await _summary(0, 18)
+            assert stub_llm == [(0, 12), (12, 18)]
+
+            stub_llm.clear()
+            await write_messages_batch([
+                MessageRecord(user.id, CHAT_ID, "опоздавшее", tg_message_id=100, token_count=1,
+                              date=DAY.replace(hour=5, minute=10))
+            ])
+            await _summary(0, 18)
+            # Заново конспектируется только отрезок 00–12 (он мог перерасти бюджет и разделиться)
+            assert stub_llm[0][0] == 0 and stub_llm[-1][1] == 12
+        finally:
+            await close_db()
+    asyncio.run(run())